@@ -9,11 +9,13 @@ setup(
     author="yuan",
     author_email="yuan.zhao@stonybrook.edu",
     description="variational Latent Gaussian Process",
-    python_requires=">=3.5.0",
-    install_requires=["numpy", "scipy", "scikit-learn", "click"],
+    python_requires=">=3.7.0",
+    install_requires=["numpy", "scipy", "scikit-learn", "click", "threadpoolctl"],
     entry_points="""
     [console_scripts]
     vlgp=vlgp.__main__:cli
+    vlgp-sweep=vlgp.__main__:sweep_cli
+    vlgp-batch=vlgp.__main__:batch_cli
     """,
     classifiers=[
         # Trove classifiers
@@ -21,6 +23,6 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.7",
     ],
 )
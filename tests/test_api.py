@@ -30,3 +30,73 @@ def test_fit():
 
     data = make_toy_data()
     fit(data, n_factors=2)
+
+
+def test_fit_converged():
+    from vlgp.api import fit
+
+    data = make_toy_data()[:5]
+    runtime = fit(data, n_factors=2, max_iter=20, elbo_tol=1e-2, verbose=False)["config"]["runtime"]
+    assert runtime["converged"] and runtime["it"] < 20
+
+    data = make_toy_data()[:5]
+    runtime = fit(data, n_factors=2, max_iter=2, min_iter=1, elbo_tol=None, verbose=False)["config"]["runtime"]
+    assert not runtime["converged"] and runtime["it"] == 2
+
+
+def test_fit_unequal_lengths():
+    import numpy as np
+    from vlgp.api import fit
+
+    data = make_toy_data()
+    for trial, length in zip(data, [100, 80, 60, 75] * 5):
+        trial["y"] = trial["y"][:length]
+
+    result = fit(data, n_factors=2, max_iter=2, min_iter=1, bucket_size=32)
+    for trial in result["trials"]:
+        length = trial["y"].shape[0]
+        assert trial["mu"].shape == (length, 2)
+        assert np.all(np.isfinite(trial["mu"]))
+    assert set(result["params"]["cholesky"]) == {64, 96, 128}
+
+
+def test_fit_async():
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from vlgp import api
+    from vlgp.api import fit_async
+
+    class NoExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            raise AssertionError("progress must not hold threads of the default executor")
+
+    async def drive(executor):
+        asyncio.get_running_loop().set_default_executor(NoExecutor())
+        done = fit_async(make_toy_data(), 2, executor, max_iter=3, min_iter=3)
+        cancelled = fit_async(make_toy_data(), 2, executor, max_iter=50, min_iter=50)
+
+        events = [event async for event in done.progress()]
+        async for event in cancelled.progress():
+            if event["event"] == "iteration":
+                cancelled.cancel()
+        return events, await done.result(), await cancelled.result()
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        events, result, checkpoint = asyncio.run(drive(executor))
+
+    assert [event["it"] for event in events[:-1]] == [1, 2, 3]
+    assert events[-1]["event"] == "done"
+    assert not result["cancelled"]
+    assert checkpoint["cancelled"]
+    assert checkpoint["config"]["runtime"]["it"] < 50
+
+    api.shutdown_manager()
+    assert api._manager is None
+
+
+def test_fit_no_iteration():
+    from vlgp.api import fit
+
+    result = fit(make_toy_data()[:2], 2, max_iter=0, min_iter=0, verbose=False)
+    assert not result["cancelled"]
+    assert result["config"]["runtime"]["it"] == 0
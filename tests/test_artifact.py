@@ -0,0 +1,35 @@
+def test_write_read(tmp_path):
+    import numpy as np
+    from vlgp import artifact
+
+    sections = {
+        "params": {
+            "a": np.random.randn(2, 5),
+            "likelihood": np.array(["poisson"] * 4 + ["gaussian"]),
+            "cholesky": {np.int64(100): np.random.randn(2, 100, 10)},
+            "zdim": np.int64(2),
+        },
+        "config": {"omega_bound": (1e-3, 5e-2), "callbacks": [print], "tol": float("nan")},
+        "trials": [{"y": np.arange(6).reshape(3, 2), "id": i, "empty": np.zeros((0, 2))} for i in range(3)],
+    }
+    file = tmp_path / "result.vlgp"
+    artifact.write(file, sections)
+    assert artifact.is_artifact(file)
+
+    for mmap in (True, False):
+        result = artifact.read(file, mmap=mmap)
+        params = result["params"]
+        assert np.array_equal(params["a"], sections["params"]["a"])
+        assert np.array_equal(params["likelihood"], sections["params"]["likelihood"])
+        assert np.array_equal(params["cholesky"][100], sections["params"]["cholesky"][100])
+        assert params["zdim"] == 2
+        assert result["config"]["omega_bound"] == (1e-3, 5e-2)
+        assert result["config"]["callbacks"] == []
+        assert np.isnan(result["config"]["tol"])
+        assert [trial["id"] for trial in result["trials"]] == [0, 1, 2]
+        assert result["trials"][0]["empty"].shape == (0, 2)
+
+    # only the requested sections are read, and the arrays are writable without touching the file
+    params = artifact.read(file, sections=["params"])["params"]
+    params["a"][:] = 0
+    assert not np.allclose(artifact.read(file, sections=["params"])["params"]["a"], 0)
@@ -8,3 +8,66 @@ def test_save_load(tmp_path):
 
     model2 = VLGP.load(file)
     assert model1 == model2
+
+
+def test_partial_fit():
+    import numpy as np
+    from test_core import make_toy_data
+
+    trials = make_toy_data(ntrial=6)
+    model = VLGP(n_factors=2)
+    model.fit(trials[:4], max_iter=2, min_iter=1)
+    weight = np.copy(model.weight)
+
+    new_trials = model.partial_fit(trials[4:], max_iter=2)
+    assert all(trial["mu"].shape == (100, 2) for trial in new_trials)
+    assert not np.allclose(model.weight, weight)
+
+    inferred = model.infer([{"y": trials[0]["y"]}])
+    assert np.all(np.isfinite(inferred[0]["mu"]))
+
+
+def test_partial_fit_options(capsys):
+    from test_core import make_toy_data
+
+    trials = make_toy_data(ntrial=6)
+    model = VLGP(n_factors=2)
+    model.fit(trials[:4], max_iter=2, min_iter=1)
+    config = dict(model._config)
+    capsys.readouterr()
+
+    # the options apply to the update only, which stops once converged
+    model.partial_fit(trials[4:], max_iter=10, verbose=False, elbo_tol=1.0)
+    assert capsys.readouterr().out == ""
+    assert model._config == config
+
+    model.partial_fit(make_toy_data(ntrial=1), max_iter=10, elbo_tol=1.0)
+    output = capsys.readouterr().out
+    assert "Converged after 2 iterations" in output
+
+
+def test_save_load_fitted(tmp_path):
+    import pickle
+    import numpy as np
+    from test_core import make_toy_data
+
+    trials = make_toy_data(ntrial=4)
+    model1 = VLGP(n_factors=2)
+    model1.fit(trials, max_iter=2, min_iter=1)
+    file = tmp_path / "model.vlgp"
+    model1.save(file)
+
+    model2 = VLGP.load(file)
+    assert model1 == model2
+    assert "_trials" not in vars(model2)  # loaded on first access
+    assert np.allclose(model2._trials[0]["mu"], trials[0]["mu"])
+
+    inferred1 = model1.infer([{"y": trials[0]["y"]}])
+    inferred2 = model2.infer([{"y": trials[0]["y"]}])
+    assert np.allclose(inferred1[0]["mu"], inferred2[0]["mu"])
+    assert len(pickle.loads(pickle.dumps(VLGP.load(file)))._trials) == 4
+
+    # legacy pickles
+    with open(tmp_path / "model.pk", "wb") as fout:
+        pickle.dump(model1, fout)
+    assert VLGP.load(tmp_path / "model.pk") == model1
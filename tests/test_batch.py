@@ -0,0 +1,100 @@
+import copy
+
+import numpy as np
+from scipy.linalg import toeplitz
+
+from test_core import make_toy_data
+
+
+def test_fit():
+    from vlgp import api, batch
+
+    datasets = [make_toy_data(ntrial=4), make_toy_data(ntrial=3)]
+    datasets[1] = [{"y": trial["y"][:, :4]} for trial in datasets[1]]  # fewer neurons
+    datasets[0].append({"y": datasets[0][0]["y"][:30]})  # shorter than the window
+    options = dict(max_iter=3, min_iter=3, Hstep=False, random_state=0, verbose=False)
+
+    np.random.seed(0)
+    results = batch.fit(copy.deepcopy(datasets), 2, **options)
+    np.random.seed(0)
+    expected = [api.fit(copy.deepcopy(trials), 2, **options) for trials in datasets]
+
+    assert len(results) == len(datasets)
+    for result, reference in zip(results, expected):
+        assert result["params"]["a"].shape == reference["params"]["a"].shape
+        assert np.allclose(result["params"]["a"], reference["params"]["a"], atol=1e-4)
+        assert np.allclose(result["params"]["b"], reference["params"]["b"], atol=1e-4)
+        # the reference infers under the incomplete Cholesky factors, the batched fit under its own
+        for trial, ref_trial in zip(result["trials"], reference["trials"]):
+            assert np.allclose(trial["mu"], ref_trial["mu"], atol=1e-3)
+        runtime = result["config"]["runtime"]
+        assert runtime["it"] == 3
+        assert np.allclose(runtime["elbo"], reference["config"]["runtime"]["elbo"], rtol=1e-5)
+
+
+def test_infer_models_prior():
+    from vlgp import batch
+    from vlgp.core import infer, update_w, update_v
+    from vlgp.util import pad_trials, unpad_trials
+
+    datasets = [make_toy_data(ntrial=3), make_toy_data(ntrial=2)]
+    datasets[0].append({"y": datasets[0][0]["y"][:30]})
+    results = batch.fit(datasets, 2, max_iter=2, min_iter=2, random_state=0, verbose=False)
+    trials_list = [copy.deepcopy(result["trials"]) for result in results]
+    params_list = [copy.deepcopy(result["params"]) for result in results]
+    batch.infer_models(trials_list, params_list, results[0]["config"])
+
+    # the same as the E step of every model under the prior factors of the fit
+    for result, trials, params in zip(results, trials_list, params_list):
+        prior, _ = batch.prior_factors(params["sigma"][np.newaxis], params["omega"][np.newaxis], 100, params["rank"])
+        assert np.allclose(params["cholesky"][100][..., :prior.shape[-1]], prior[0])
+        expected = copy.deepcopy(result["trials"])
+        config = result["config"]
+        buckets = pad_trials(expected, config["bucket_size"])
+        update_w(buckets, params, config)
+        update_v(buckets, params, config)
+        infer(buckets, params, config)
+        unpad_trials(expected, buckets)
+        for trial, ref_trial in zip(trials, expected):
+            assert np.allclose(trial["mu"], ref_trial["mu"], atol=1e-8)
+            assert np.allclose(trial["v"], ref_trial["v"], atol=1e-8)
+
+
+def test_hstep():
+    from vlgp.batch import hstep
+    from vlgp.gp import whittle
+
+    length = 100
+    sigma = np.array([0.8, 0.5])
+    omega = np.array([0.01, 0.005])
+    n_items = 200
+
+    mu = []
+    for s, o in zip(sigma, omega):
+        K = s ** 2 * toeplitz(np.exp(-o * np.arange(length) ** 2))
+        L = np.linalg.cholesky(K + 1e-6 * np.eye(length))
+        mu.append(L @ np.random.randn(n_items, length, 1))
+    stack = {
+        "mu": np.concatenate(mu),
+        "v": np.zeros((2 * n_items, length, 1)),
+        "model": np.repeat(np.arange(2), n_items),
+        "a": np.zeros((2, 1, 1)),
+        "sigma": np.ones((2, 1)),
+        "omega": np.full((2, 1), 0.03),
+        "gp_noise": np.full(2, 1e-4),
+    }
+    hstep(stack, None, {"chunk_size": 5000, "omega_bound": (5e-4, 5e-2)})
+
+    assert np.allclose(stack["sigma"][:, 0], sigma, rtol=0.1)
+    assert np.allclose(stack["omega"][:, 0], omega, rtol=0.2)
+
+    # the same as fitting the models one at a time
+    for m in range(2):
+        trials = [
+            {"y": np.zeros((length, 1)), "mu": mu, "v": np.zeros((length, 1))}
+            for mu in stack["mu"][stack["model"] == m]
+        ]
+        params = {"zdim": 1, "sigma": np.ones(1), "omega": np.full(1, 0.03), "gp_noise": 1e-4}
+        whittle(trials, params, {"method": "MAP", "omega_bound": (5e-4, 5e-2)})
+        assert np.allclose(stack["sigma"][m], params["sigma"], rtol=1e-4)
+        assert np.allclose(stack["omega"][m], params["omega"], rtol=1e-4)
@@ -0,0 +1,363 @@
+def make_toy_data(ntrial=10, length=100):
+    import numpy as np
+
+    ydim = 5
+    zdim = 2
+
+    a = np.random.randn(zdim, ydim)
+    b = -2
+
+    trials = []
+    for i in range(ntrial):
+        z = np.column_stack(
+            (
+                np.sin(np.linspace(0, 8 * np.pi, length)),
+                np.cos(np.linspace(0, 8 * np.pi, length)),
+            )
+        )
+        y = np.random.poisson(np.exp(z @ a + b))
+        trials.append({"y": y, "id": i})
+
+    return trials
+
+
+def prepare(trials, zdim=2, **kwargs):
+    from vlgp.preprocess import get_config, get_params, initialize, fill_params, fill_trials
+    from vlgp.gp import make_cholesky
+    from vlgp.core import update_w, update_v
+
+    config = get_config(**kwargs)
+    kwargs["omega_bound"] = config["omega_bound"]
+    params = get_params(trials, zdim, **kwargs)
+    initialize(trials, params, config)
+    fill_params(params)
+    fill_trials(trials)
+    make_cholesky(trials, params, config)
+    update_w(trials, params, config)
+    update_v(trials, params, config)
+    return params, config
+
+
+def test_estep_updates_latents_in_turn():
+    import numpy as np
+    from vlgp.core import estep
+
+    trials = make_toy_data(ntrial=1)
+    params, config = prepare(trials, method="VB", Eniter=1, dmu_bound=np.inf)
+    trial = trials[0]
+    a = params["a"]
+    eta_offset = np.einsum("ijk, jk -> ik", trial["x"], params["b"])
+    vterm = 0.5 * trial["v"] @ a ** 2
+
+    # Newton step of every latent in turn, each seeing the mean updated by the previous ones
+    mu = trial["mu"].copy()
+    for l, G in enumerate(params["cholesky"][mu.shape[0]]):
+        r = np.exp(np.minimum(mu @ a + eta_offset + vterm, 10))
+        w = r @ a[l] ** 2
+        K = G @ G.T
+        u = K @ ((trial["y"] - r) @ a[l]) - mu[:, l]
+        mu[:, l] += np.linalg.solve(np.eye(len(w)) + K * w, u)
+
+    estep(trials, params, config)
+    assert np.allclose(trial["mu"], mu)
+
+
+def test_trunc_exp():
+    import numpy as np
+    from vlgp.math import trunc_exp
+
+    assert np.isclose(trunc_exp(1.0), np.e)
+    assert np.isclose(trunc_exp(20), np.exp(10))
+    assert np.allclose(trunc_exp(np.array([0, 20])), [1, np.exp(10)])
+    out = np.empty(2)
+    x = np.array([1.0, 20.0])
+    assert trunc_exp(x, out=out) is out
+    assert np.allclose(out, [np.e, np.exp(10)]) and x[1] == 20
+
+
+def test_update_w_segments():
+    import numpy as np
+    from vlgp.core import update_w
+    from vlgp.util import Segments
+
+    trials = make_toy_data(ntrial=2)
+    params, config = prepare(trials)
+    update_w(trials, params, config)
+    expected = [trial["w"].copy() for trial in trials]
+    for trial in trials:
+        trial["w"][:] = 0
+
+    update_w(Segments(trials, 50, random_state=0), params, config)
+    for trial, w in zip(trials, expected):
+        assert np.allclose(trial["w"], w)
+
+
+def test_masked_channel_equals_dropped_channel():
+    import copy
+    import numpy as np
+    from vlgp.core import estep, mstep, update_w, update_v
+    from vlgp.preprocess import fill_trials
+
+    trials = make_toy_data(ntrial=3)
+    params, config = prepare(trials, Eniter=2, Mniter=2)
+
+    # drop the last channel
+    dropped = [
+        {
+            "y": trial["y"][:, :-1],
+            "x": trial["x"][..., :-1],
+            "mu": trial["mu"].copy(),
+            "v": trial["v"].copy(),
+        }
+        for trial in trials
+    ]
+    dropped_params = copy.deepcopy(params)
+    dropped_params.update(
+        ydim=4,
+        a=params["a"][:, :-1].copy(),
+        b=params["b"][:, :-1].copy(),
+        noise=params["noise"][:-1],
+        likelihood=params["likelihood"][:-1],
+    )
+    fill_trials(dropped)
+    update_w(dropped, dropped_params, config)
+    update_v(dropped, dropped_params, config)
+
+    # mask the last channel, with garbage in the missing entries
+    for trial in trials:
+        trial["y"] = trial["y"].astype(float)
+        trial["y"][:, -1] = np.nan
+        trial["mask"] = np.ones(trial["y"].shape, dtype=bool)
+        trial["mask"][:, -1] = False
+    fill_trials(trials)
+    update_w(trials, params, config)
+    update_v(trials, params, config)
+
+    estep(trials, params, config)
+    estep(dropped, dropped_params, config)
+    for trial, other in zip(trials, dropped):
+        assert np.allclose(trial["mu"], other["mu"])
+        assert np.allclose(trial["v"], other["v"])
+
+    mstep(trials, params, config)
+    mstep(dropped, dropped_params, config)
+    assert np.allclose(params["a"][:, :-1], dropped_params["a"])
+    assert np.allclose(params["b"][:, :-1], dropped_params["b"])
+
+
+def test_joint_estep(caplog):
+    import copy
+    import logging
+    import numpy as np
+    from vlgp.core import estep
+
+    for method in ("MAP", "VB"):
+        trials = make_toy_data(ntrial=3)
+        params, config = prepare(trials, method=method, Eniter=200)
+        joint_trials = copy.deepcopy(trials)
+
+        estep(trials, params, config)
+        estep(joint_trials, params, dict(config, estep="joint", Eniter=20, cg_tol=1e-10))
+        for trial, joint_trial in zip(trials, joint_trials):
+            assert np.allclose(trial["mu"], joint_trial["mu"])
+            assert np.allclose(trial["v"], joint_trial["v"])
+
+    # nearly collinear loading, the latents are coupled in the posterior
+    rng = np.random.RandomState(0)
+    length = 100
+    a = 0.5 * rng.randn(2, 30)
+    a[1] = a[0] + 0.1 * a[1]
+    z = np.column_stack((np.sin(np.linspace(0, 8 * np.pi, length)), np.cos(np.linspace(0, 8 * np.pi, length))))
+    trials = [{"y": rng.poisson(np.exp(z @ a + 1))}]
+    params, config = prepare(trials, method="MAP", Eniter=1)
+    params["a"] = a
+    joint_trials = copy.deepcopy(trials)
+    tol = 1e-8
+
+    # coordinate passes until the means change less than tol
+    passes = 0
+    while True:
+        mu = trials[0]["mu"].copy()
+        estep(trials, params, config)
+        passes += 1
+        if np.linalg.norm(trials[0]["mu"] - mu) <= tol * np.linalg.norm(mu):
+            break
+
+    with caplog.at_level(logging.DEBUG, logger="vlgp.core"):
+        estep(joint_trials, params, dict(config, estep="joint", Eniter=100, tol=tol, cg_tol=1e-10))
+    (record,) = [record for record in caplog.records if record.msg.startswith("Joint E step")]
+    joint_passes, cg_iterations = record.args
+
+    assert np.allclose(joint_trials[0]["mu"], trials[0]["mu"], atol=1e-4)
+    assert joint_passes < 100 and 10 * joint_passes < passes
+    assert cg_iterations < passes
+
+
+def test_cg_solver():
+    import copy
+    import numpy as np
+    import pytest
+    from vlgp.core import estep
+
+    trials = make_toy_data(ntrial=3)
+    params, config = prepare(trials, method="MAP", Eniter=50)
+    cg_trials = copy.deepcopy(trials)
+
+    estep(trials, params, config)
+    estep(cg_trials, params, dict(config, solver="cg", cg_tol=1e-10))
+    for trial, cg_trial in zip(trials, cg_trials):
+        assert np.allclose(trial["mu"], cg_trial["mu"], atol=1e-3)
+
+    with pytest.raises(ValueError):
+        estep(cg_trials, params, dict(config, method="VB", solver="cg"))
+
+
+def test_squarem(monkeypatch):
+    import numpy as np
+    from vlgp import core
+    from vlgp.api import fit
+
+    passes = []
+    vem_step = core.vem_step
+
+    def counted_step(*args):
+        passes.append(None)
+        return vem_step(*args)
+
+    monkeypatch.setattr(core, "vem_step", counted_step)
+
+    np.random.seed(0)
+    trials = make_toy_data(ntrial=3)
+    plain = fit(trials, n_factors=2, max_iter=20, min_iter=20, monotone=True, random_state=0, verbose=False)
+    target = plain["config"]["runtime"]["elbo"][-1]
+    assert len(passes) == 20
+
+    # passes taken by the end of every iteration, including those of the rejected extrapolations
+    del passes[:]
+    counts = []
+    np.random.seed(0)
+    trials = make_toy_data(ntrial=3)
+    accelerated = fit(
+        trials,
+        n_factors=2,
+        max_iter=20,
+        min_iter=20,
+        accelerate="squarem",
+        monotone=True,
+        random_state=0,
+        verbose=False,
+        callbacks=[lambda *args: counts.append(len(passes))],
+    )
+    elbo = np.array(accelerated["config"]["runtime"]["elbo"])
+    assert np.all(np.diff(elbo) >= -1e-8 * np.abs(elbo[1:]))
+    assert elbo[-1] >= target
+    assert counts[np.argmax(elbo >= target)] < 20
+
+
+def test_unpack_state_clips_hyperparameters():
+    import numpy as np
+    from vlgp.core import pack_state, unpack_state, squarem_extrapolate
+
+    trials = make_toy_data(ntrial=2)
+    params, config = prepare(trials)
+    theta = pack_state(trials, params)
+    # an overshooting extrapolation of the log hyperparameters
+    step = np.zeros_like(theta)
+    start = params["a"].size + params["b"].size
+    step[start:start + 2 * params["zdim"]] = [5, -5, 5, -5]
+    unpack_state(squarem_extrapolate(theta, theta + step, theta + 3 * step), trials, params, config)
+
+    assert np.all(params["sigma"] ** 2 <= 1)
+    assert np.all((params["omega"] >= config["omega_bound"][0]) & (params["omega"] <= config["omega_bound"][1]))
+
+
+def test_estep_lower_bound():
+    import numpy as np
+    from vlgp.core import estep, elbo
+
+    trials = make_toy_data(ntrial=3)
+    params, config = prepare(trials, Eniter=3)
+    assert np.isclose(estep(trials, params, config), elbo(trials, params, config))
+
+
+def test_constrain_loading_keeps_lower_bound():
+    import numpy as np
+    from vlgp.core import constrain_loading, elbo
+
+    trials = make_toy_data(ntrial=3)
+    params, config = prepare(trials, monotone=True)
+    lower_bound = elbo(trials, params, config)
+    constrain_loading(trials, params, config)
+    assert np.isclose(np.linalg.norm(params["a"]), 1)
+    assert np.isclose(elbo(trials, params, config), lower_bound)
+
+
+def test_elbo_increases():
+    import numpy as np
+    from vlgp.api import fit
+
+    np.random.seed(0)
+    trials = make_toy_data()
+    result = fit(trials, n_factors=2, max_iter=15, min_iter=15, monotone=True, random_state=0, verbose=False)
+    lower_bound = np.array(result["config"]["runtime"]["elbo"])
+    assert lower_bound.size == 15
+    assert np.all(np.diff(lower_bound) >= -1e-8 * np.abs(lower_bound[1:]))
+
+
+def test_line_search_mstep():
+    import copy
+    import numpy as np
+    from vlgp.core import estep, mstep
+
+    trials = make_toy_data(ntrial=3)
+    params, config = prepare(trials)
+    estep(trials, params, config)
+    clipped = copy.deepcopy(params)
+    initial = copy.deepcopy(params)
+
+    mstep(trials, params, config)
+    mstep(trials, clipped, dict(config, line_search=False, Mniter=200))
+    assert np.allclose(params["a"], clipped["a"], atol=1e-4)
+    assert np.allclose(params["b"], clipped["b"], atol=1e-4)
+
+    # the changes by the whole M step, not the last Newton step
+    assert np.allclose(params["da"], params["a"] - initial["a"])
+    assert np.allclose(params["db"], params["b"] - initial["b"])
+
+
+def test_sample_posterior(tmp_path):
+    import h5py
+    import numpy as np
+    from vlgp.core import estep, sample_posterior
+
+    trials = make_toy_data(ntrial=2)
+    params, config = prepare(trials, Eniter=3)
+    estep(trials, params, config)
+
+    samples = sample_posterior(trials, params, 2000, random_state=0)
+    for trial, sample in zip(trials, samples):
+        assert sample.shape == (2000,) + trial["mu"].shape
+        assert np.allclose(sample.mean(axis=0), trial["mu"], atol=0.1)
+        assert np.allclose(sample.var(axis=0), trial["v"], rtol=0.2)
+
+    path = tmp_path / "samples.h5"
+    assert sample_posterior(trials, params, 30, path=path.as_posix(), batch_size=8) is None
+    with h5py.File(path.as_posix(), "r") as fin:
+        assert fin["trial_1"].shape == (30,) + trials[1]["mu"].shape
+
+
+def test_streaming_mstep():
+    import copy
+    import numpy as np
+    from vlgp.core import estep, mstep
+
+    trials = make_toy_data(ntrial=3)
+    trials[1]["mask"] = np.random.rand(*trials[1]["y"].shape) > 0.2
+    params, config = prepare(trials)
+    estep(trials, params, config)
+    whole = copy.deepcopy(params)
+
+    mstep(trials, params, dict(config, chunk_size=1))
+    mstep(trials, whole, config)
+    for key in ("a", "b", "noise"):
+        assert np.allclose(params[key], whole[key])
@@ -0,0 +1,44 @@
+from test_core import make_toy_data
+
+
+def run(tmp_path, **kwargs):
+    import copy
+    import multiprocessing
+    import numpy as np
+    from vlgp.api import fit
+    from vlgp.distributed import fit as fit_distributed, serve
+
+    trials = make_toy_data(ntrial=6)
+    options = dict(
+        initialization="pca", hstep_method="whittle", max_iter=3, min_iter=3, random_state=0
+    )
+    options.update(kwargs)
+    local = fit(copy.deepcopy(trials), 2, **options)
+
+    authkey = b"vlgp"
+    addresses = [(tmp_path / "worker{}".format(i)).as_posix() for i in range(2)]
+    workers = [
+        multiprocessing.Process(target=serve, args=(address, authkey, trials[i::2]))
+        for i, address in enumerate(addresses)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        result = fit_distributed(addresses, 2, authkey, **options)
+    finally:
+        for worker in workers:
+            worker.join(timeout=10)
+
+    for key in ("a", "b", "sigma", "omega"):
+        assert np.allclose(result["params"][key], local["params"][key], atol=1e-6)
+    assert np.allclose(result["trials"][1][0]["mu"], local["trials"][1]["mu"], atol=1e-5)
+    assert len(result["config"]["runtime"]["elbo"]) == 3
+
+
+def test_fit(tmp_path):
+    run(tmp_path)
+
+
+def test_fit_one_newton_step(tmp_path):
+    # the latents are rescaled along with the loading from the first iteration on
+    run(tmp_path, Eniter=1)
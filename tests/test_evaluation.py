@@ -0,0 +1,51 @@
+from test_core import make_toy_data
+
+
+def test_evaluate(tmp_path):
+    import h5py
+    import numpy as np
+    from vlgp.api import fit
+    from vlgp.evaluation import evaluate, evaluate_hdf5, predict
+    from vlgp.util import dict_to_hdf5
+
+    result = fit(make_toy_data(ntrial=4), 2, max_iter=5, min_iter=1)
+    trials = result["trials"]
+    params = result["params"]
+
+    scores = evaluate(trials, params)
+    assert np.all(scores["pseudo_r2"] <= 1)
+    assert np.all(scores["bits_per_spike"] > 0)
+
+    chunked = evaluate(trials, params, chunk_size=1)
+    for key, value in scores.items():
+        assert np.allclose(value, chunked[key])
+
+    rates = predict(trials, params, neurons=[0, 2], chunk_size=150)
+    assert [rate.shape for rate in rates] == [(100, 2)] * 4
+
+    path = tmp_path / "fit.h5"
+    with h5py.File(path, "w") as fout:
+        dict_to_hdf5(
+            {
+                "params": {k: v for k, v in params.items() if k != "cholesky"},
+                "trials": [{k: trial[k] for k in ("y", "x", "mu", "v")} for trial in trials],
+            },
+            fout,
+        )
+    assert np.allclose(evaluate_hdf5(path.as_posix())["loglik"], scores["loglik"])
+
+
+def test_log_likelihood_gaussian():
+    import warnings
+    import numpy as np
+    from scipy.stats import norm, poisson
+    from vlgp.evaluation import log_likelihood
+
+    y = np.array([[1.0, -0.5], [0.0, 2.0]])
+    mean = np.array([[2.0, -1.0], [0.5, 0.0]])
+    noise = np.array([1.0, 0.5])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ll = log_likelihood(y, mean, np.array(["poisson", "gaussian"]), noise)
+    assert np.allclose(ll[0], np.sum(poisson.logpmf(y[:, 0], mean[:, 0])))
+    assert np.allclose(ll[1], np.sum(norm.logpdf(y[:, 1], mean[:, 1], np.sqrt(noise[1]))))
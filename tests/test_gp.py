@@ -0,0 +1,49 @@
+import numpy as np
+from scipy.linalg import toeplitz
+
+
+def test_whittle():
+    from vlgp.gp import whittle
+
+    length = 100
+    sigma = 0.8
+    omega = 0.01
+    K = sigma ** 2 * toeplitz(np.exp(-omega * np.arange(length) ** 2))
+    L = np.linalg.cholesky(K + 1e-6 * np.eye(length))
+    trials = [
+        {
+            "y": np.zeros((length, 1)),
+            "mu": L @ np.random.randn(length, 1),
+            "v": np.zeros((length, 1)),
+        }
+        for i in range(200)
+    ]
+    params = {"zdim": 1, "sigma": np.ones(1), "omega": np.full(1, 0.03), "gp_noise": 1e-4}
+    whittle(trials, params, {"method": "MAP", "omega_bound": (5e-4, 5e-2)})
+
+    assert np.isclose(params["sigma"][0], sigma, rtol=0.1)
+    assert np.isclose(params["omega"][0], omega, rtol=0.2)
+
+
+def test_optimize_sums_lengths():
+    from vlgp.gp import optimize
+
+    sigma = 1.0
+    omega = 0.01
+    trials = []
+    for length, count in ((100, 20), (40, 10)):
+        K = sigma ** 2 * toeplitz(np.exp(-omega * np.arange(length) ** 2))
+        L = np.linalg.cholesky(K + 1e-6 * np.eye(length))
+        trials += [
+            {"y": np.zeros((length, 1)), "mu": L @ np.random.randn(length, 1), "w": np.full((length, 1), 1e-6)}
+            for i in range(count)
+        ]
+    config = {"hstep_method": "elbo", "omega_bound": (5e-4, 5e-2)}
+
+    def fit(trials):
+        params = {"zdim": 1, "rank": 50, "dt": 1, "sigma": np.ones(1), "omega": np.full(1, 0.03), "gp_noise": 1e-4}
+        optimize(trials, params, config)
+        return params["omega"][0]
+
+    # the short trials are not dropped
+    assert not np.isclose(fit(trials), fit(trials[:20]))
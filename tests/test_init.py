@@ -0,0 +1,43 @@
+import subprocess
+import sys
+
+# budget of the cumulative time of `import vlgp` in microseconds, far above the few milliseconds it takes
+IMPORT_BUDGET = 100000
+HEAVY_MODULES = ("numpy", "scipy", "h5py", "click", "sklearn")
+
+
+def run(code):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_time():
+    process = run("import sys, vlgp; print(sorted(sys.modules))")
+    loaded = {name.split(".")[0] for name in eval(process.stdout)}
+    assert loaded.isdisjoint(HEAVY_MODULES)
+
+    # lines of "import time: self [us] | cumulative | name"
+    times = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:") and line.count("|") == 2 and "cumulative" not in line
+    }
+    assert times["vlgp"] < IMPORT_BUDGET
+
+
+def test_lazy_dependencies():
+    process = run("import sys, vlgp.core, vlgp.server; print(sorted(sys.modules))")
+    loaded = {name for name in eval(process.stdout)}
+    assert loaded.isdisjoint(["h5py", "click", "sklearn", "scipy.optimize", "scipy.ndimage"])
+
+
+def test_lazy_attributes():
+    import vlgp
+
+    assert callable(vlgp.fit)
+    assert issubclass(vlgp.core.VLGP, vlgp.base.Model)
+    assert "distributed" in dir(vlgp)
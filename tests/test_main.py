@@ -0,0 +1,64 @@
+def test_batch_cli(tmp_path):
+    import numpy as np
+    from click.testing import CliRunner
+    from vlgp.__main__ import batch_cli
+    from test_core import make_toy_data
+
+    for name in ("a", "b"):
+        np.save(tmp_path / "{}.npy".format(name), make_toy_data(), allow_pickle=True)
+    output_dir = tmp_path / "out"
+    args = [
+        (tmp_path / "*.npy").as_posix(),
+        "--output_dir", output_dir.as_posix(),
+        "--n_factors", "2",
+        "--n_jobs", "2",
+        "--threads", "1",
+        "--max_iter", "5",
+        "--omega_bound", "(1e-3, 5e-2)",
+        "--Hstep", "False",
+    ]
+
+    result = CliRunner().invoke(batch_cli, args)
+    assert result.exit_code == 0, result.output
+    assert (output_dir / "a.npy").exists()
+    assert (output_dir / "b.npy").exists()
+    fit = np.load(output_dir / "a.npy", allow_pickle=True).item()
+    assert fit["config"]["max_iter"] == 5
+    assert not fit["config"]["Hstep"]
+
+    summary = (output_dir / "summary.tsv").read_text().splitlines()
+    assert len(summary) == 3
+    assert all("\tdone\t" in row for row in summary[1:])
+
+    # complete outputs are skipped
+    result = CliRunner().invoke(batch_cli, args)
+    assert result.exit_code == 0, result.output
+    summary = (output_dir / "summary.tsv").read_text().splitlines()
+    assert all("\tskipped" in row for row in summary[1:])
+
+
+def test_batch_cli_outputs(tmp_path):
+    import numpy as np
+    from click.testing import CliRunner
+    from vlgp.__main__ import batch_cli
+    from test_core import make_toy_data
+
+    # inputs of the same name in different directories
+    for name in ("x", "y"):
+        (tmp_path / name).mkdir()
+        np.save(tmp_path / name / "a.npy", make_toy_data(ntrial=2), allow_pickle=True)
+    output_dir = tmp_path / "out"
+    args = ["--output_dir", output_dir.as_posix(), "--n_factors", "2", "--max_iter", "2", "--min_iter", "1"]
+
+    result = CliRunner().invoke(batch_cli, [(tmp_path / "*" / "a.npy").as_posix()] + args)
+    assert result.exit_code == 0, result.output
+    assert (output_dir / "x" / "a.npy").exists()
+    assert (output_dir / "y" / "a.npy").exists()
+    summary = (output_dir / "summary.tsv").read_text().splitlines()
+    header = summary[0].split("\t")
+    assert all(row.split("\t")[header.index("converged")] == "False" for row in summary[1:])
+
+    # the same input twice
+    result = CliRunner().invoke(batch_cli, [(tmp_path / "x" / "a.npy").as_posix()] * 2 + args)
+    assert result.exit_code != 0
+    assert "same outputs" in result.output
@@ -28,3 +28,21 @@ def test_rectify():
     n = 5000
     x = np.random.randn(n)
     assert np.array_equal(rectify(x), np.maximum(0, x))
+
+
+def test_toeplitz_matvec():
+    from vlgp.math import toeplitz_spectrum, toeplitz_matvec
+
+    c = np.exp(-0.1 * np.arange(50) ** 2)
+    x = np.random.randn(50)
+    assert np.allclose(toeplitz_matvec(toeplitz_spectrum(c), x), toeplitz(c) @ x)
+
+
+def test_pcg():
+    from vlgp.math import pcg
+
+    n = 50
+    A = toeplitz(np.exp(-0.1 * np.arange(n) ** 2)) + np.eye(n)
+    b = np.random.randn(n)
+    x, _ = pcg(lambda p: A @ p, b, precond=1 / np.diag(A), tol=1e-10)
+    assert np.allclose(A @ x, b)
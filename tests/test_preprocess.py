@@ -0,0 +1,44 @@
+def test_streaming_pca():
+    import numpy as np
+    from scipy.linalg import subspace_angles
+    from sklearn.decomposition import PCA
+    from vlgp.preprocess import get_config, get_params, initialize
+
+    zdim = 2
+    a = np.random.randn(zdim, 10)
+    trials = []
+    for i in range(5):
+        z = np.random.randn(100, zdim)
+        trials.append({"y": z @ a + 0.1 * np.random.randn(100, 10)})
+
+    config = get_config(initialization="pca")
+    params = get_params(trials, zdim, omega_bound=config["omega_bound"])
+    initialize(trials, params, config)
+
+    y = np.concatenate([trial["y"] for trial in trials])
+    pca = PCA(n_components=zdim).fit(y)
+    assert np.all(subspace_angles(params["a"].T, pca.components_.T) < 1e-3)
+    for trial in trials:
+        assert trial["mu"].shape == (100, zdim)
+        assert trial["x"].shape == (100, 1, 10)
+
+
+def test_initialize_latents_in_chunks():
+    import numpy as np
+    from vlgp.preprocess import initialize_latents
+
+    params = {"zdim": 2, "xdim": 1, "ydim": 3}
+    chunks = []
+
+    def transform(y, mask):
+        chunks.append(y.shape[0])
+        return np.where(mask, y, 0)[:, :2]
+
+    trials = [{"y": np.random.randn(length, 3)} for length in (30, 50, 20, 40)]
+    trials[1]["mask"] = np.random.rand(50, 3) > 0.5
+    initialize_latents(trials, params, transform, chunk_size=60)
+
+    assert chunks == [80, 60]
+    for trial in trials:
+        assert np.array_equal(trial["mu"], np.where(trial.get("mask", True), trial["y"], 0)[:, :2])
+        assert trial["v"].shape == trial["w"].shape == (trial["y"].shape[0], 2)
@@ -0,0 +1,104 @@
+from test_core import make_toy_data
+
+
+def test_server(tmp_path):
+    import copy
+    import threading
+    import numpy as np
+    from vlgp.api import fit
+    from vlgp.core import infer_trials
+    from vlgp.server import InferenceServer, InferenceClient
+
+    result = fit(make_toy_data(ntrial=4), 2, max_iter=2, min_iter=1)
+    params = result["params"]
+    config = result["config"]
+
+    trials = make_toy_data(ntrial=8)
+    expected = [{"y": trial["y"], "mu": np.zeros((100, 2)), "x": np.ones((100, 1, 5))} for trial in trials]
+    infer_trials(expected, copy.deepcopy(params), config)
+
+    address = (tmp_path / "server").as_posix()
+    authkey = b"vlgp"
+    with InferenceServer(params, config, address, authkey, max_wait=0.05):
+        outputs = [None] * len(trials)
+
+        def request(i):
+            with InferenceClient(address, authkey) as client:
+                outputs[i] = client.infer({"y": trials[i]["y"]})
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(trials))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with InferenceClient(address, authkey) as client:
+            metrics = client.metrics()
+
+    assert metrics["requests"] == len(trials)
+    assert metrics["batches"] < len(trials)
+    assert metrics["latency_p99"] > 0
+    for output, trial in zip(outputs, expected):
+        assert np.allclose(output["mu"], trial["mu"])
+        assert np.allclose(output["v"], trial["v"])
+
+
+def test_server_failures(tmp_path):
+    import threading
+    import numpy as np
+    import pytest
+    from vlgp.api import fit
+    from vlgp.server import InferenceServer, InferenceClient
+
+    result = fit(make_toy_data(ntrial=4), 2, max_iter=2, min_iter=1)
+
+    class FaultyServer(InferenceServer):
+        def infer(self, trials):
+            if any(trial.get("faulty") for trial in trials):
+                raise RuntimeError("faulty trial")
+            super().infer(trials)
+
+    trials = make_toy_data(ntrial=6)
+    address = (tmp_path / "server").as_posix()
+    authkey = b"vlgp"
+    with FaultyServer(result["params"], result["config"], address, authkey, max_wait=0.05, max_priors=1) as server:
+        with InferenceClient(address, authkey) as client:
+            with pytest.raises(RuntimeError, match="shape"):
+                client.infer({"y": np.zeros((100, 3))})
+            with pytest.raises(RuntimeError, match="mask"):
+                client.infer({"y": trials[0]["y"], "mask": np.ones((10, 5))})
+
+        # the faulty trial shares the length and the micro-batch of the others
+        outputs = [None] * len(trials)
+
+        def request(i):
+            with InferenceClient(address, authkey) as client:
+                try:
+                    outputs[i] = client.infer({"y": trials[i]["y"], "faulty": i == 0})
+                except RuntimeError as e:
+                    outputs[i] = e
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(trials))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the least recently used prior factors are dropped
+        server.infer([{"y": trial["y"][:length]} for trial, length in zip(trials, (50, 60))])
+        assert list(server.params["cholesky"]) == [50, 60]
+        server.infer([{"y": trials[0]["y"][:70]}])
+        assert list(server.params["cholesky"]) == [70]
+
+        with InferenceClient(address, authkey) as client:
+            client.conn.send(("metrics", 0, None))  # a reply the client does not wait for
+            with pytest.raises(RuntimeError, match="waiting for"):
+                client.metrics()
+
+        with InferenceClient(address, authkey) as client:
+            metrics = client.metrics()
+
+    assert isinstance(outputs[0], RuntimeError)
+    assert all(output["mu"].shape == (100, 2) for output in outputs[1:])
+    assert metrics["invalid"] == 2
+    assert metrics["failed"] == 1
@@ -6,3 +6,66 @@ def test_save():
     save(fit, fit["config"]["path"])
     path = pathlib.Path(fit["config"]["path"])
     path.unlink()
+
+
+def test_pad_trials():
+    import numpy as np
+    from vlgp.util import pad_trials, unpad_trials
+
+    trials = [
+        {"y": np.ones((10, 3)), "mu": np.ones((10, 2))},
+        {"y": np.ones((16, 3)), "mu": np.ones((16, 2))},
+    ]
+    padded = pad_trials(trials, 8)
+    assert padded[0]["y"].shape == (16, 3)
+    assert not padded[0]["mask"][10:].any() and padded[0]["mask"][:10].all()
+    assert padded[1] is trials[1]
+
+    for trial in padded:
+        for key in ("w", "v", "dmu"):
+            trial[key] = np.zeros_like(trial["mu"])
+    unpad_trials(trials, padded)
+    assert trials[0]["v"].shape == (10, 2)
+
+
+def test_segments():
+    import numpy as np
+    from vlgp.util import Segments
+
+    trials = [{"y": np.arange(120).reshape(-1, 1)}, {"y": np.arange(50).reshape(-1, 1)}]
+    segments = Segments(trials, 50, random_state=0)
+
+    assert segments.table.shape == (4, 2)
+    assert np.all(segments.table[:, 1] - segments.table[:, 0] == 50)
+    assert list(segments.index) == [0, 0, 0, 1]
+    first = segments[0]["y"]
+    assert np.shares_memory(first, trials[0]["y"])
+    assert segments[2]["y"][-1, 0] == 119
+
+    table = segments.table.copy()
+    assert np.array_equal(Segments(trials, 50, random_state=0).table, table)
+
+    # a trial shorter than the window is a segment of its own
+    trials.append({"y": np.arange(30).reshape(-1, 1)})
+    segments = Segments(trials, 50, random_state=0)
+    assert len(segments) == 5
+    assert np.array_equal(segments[4]["y"], trials[2]["y"])
+
+
+def test_check_random_state():
+    import numpy as np
+    import pytest
+    from vlgp.util import check_random_state
+
+    assert check_random_state(0).rand() == np.random.RandomState(0).rand()
+    random_state = np.random.RandomState(1)
+    assert check_random_state(random_state) is random_state
+
+    # the global state of numpy
+    np.random.seed(2)
+    value = check_random_state(None).rand()
+    np.random.seed(2)
+    assert np.random.rand() == value
+
+    with pytest.raises(ValueError):
+        check_random_state("seed")
@@ -0,0 +1,64 @@
+from test_core import make_toy_data
+
+
+def test_cv(tmp_path):
+    import h5py
+    from vlgp.validation import cv
+
+    trials = make_toy_data(ntrial=6, length=100)
+    path = tmp_path / "cv.h5"
+    results = cv(trials, 2, nfold=2, n_jobs=2, path=path, random_state=0, max_iter=2, min_iter=1)
+
+    assert len(results) == 2
+    for result in results:
+        assert len(result["trials"]) == len(result["test"])
+        assert result["trials"][0]["mu"].shape == (100, 2)
+    with h5py.File(path, "r") as fin:
+        assert set(fin.keys()) == {"fold_0", "fold_1"}
+        assert fin["fold_0/params/a"].shape == (2, 5)
+
+
+def test_leave_out():
+    import numpy as np
+    from vlgp.api import fit
+    from vlgp.validation import leave_out
+
+    result = fit(make_toy_data(ntrial=6), 2, max_iter=2, min_iter=1)
+    test_trials = make_toy_data(ntrial=2)
+    outputs = leave_out(test_trials, result, leave=1)
+
+    assert len(outputs) == 5
+    for output in outputs:
+        assert output["rate"][0].shape == (100, 1)
+        assert np.all(np.isfinite(output["loglik"]))
+
+
+def test_cosmooth():
+    import numpy as np
+    from vlgp.api import fit
+    from vlgp.validation import cosmooth
+
+    result = fit(make_toy_data(ntrial=6), 2, max_iter=2, min_iter=1)
+    test_trials = [{"y": trial["y"]} for trial in make_toy_data(ntrial=2)]
+    masks = np.eye(5, dtype=bool)[:3]
+
+    outputs = cosmooth(test_trials, result, masks)
+    assert all(set(trial) == {"y"} for trial in test_trials)
+
+    # the same as one mask at a time
+    for mask, output in zip(masks, outputs):
+        (expected,) = cosmooth(test_trials, result, mask)
+        assert np.allclose(output["loglik"], expected["loglik"])
+        for rate, expected_rate in zip(output["rate"], expected["rate"]):
+            assert np.allclose(rate, expected_rate)
+
+
+def test_sweep():
+    from vlgp.validation import sweep
+
+    trials = make_toy_data(ntrial=5)
+    candidates = sweep(trials, [1, 2], random_state=0, max_iter=2, min_iter=1)
+
+    assert [candidate["n_factors"] for candidate in candidates] == [1, 2]
+    assert candidates[1]["params"]["a"].shape == (2, 5)
+    assert all(candidate["loglik"] < 0 for candidate in candidates)
@@ -1,5 +1,4 @@
-from .api import *
-
+import importlib
 import sys
 import logging
 import warnings
@@ -10,6 +9,39 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-if sys.version_info[0] < 3 or sys.version_info[1] < 5:
+if sys.version_info < (3, 7):
     logger.warning(str(sys.version_info))
-    warnings.warn("Python 3.5 or later is required.")
+    warnings.warn("Python 3.7 or later is required.")
+
+# the submodules and their dependencies are imported on first use
+__all__ = ["fit", "fit_async", "sample_posterior"]
+
+SUBMODULES = (
+    "api",
+    "artifact",
+    "batch",
+    "base",
+    "callback",
+    "core",
+    "distributed",
+    "evaluation",
+    "gp",
+    "math",
+    "preprocess",
+    "server",
+    "simulation",
+    "util",
+    "validation",
+)
+
+
+def __getattr__(name):
+    if name in __all__:
+        return getattr(importlib.import_module(".api", __name__), name)
+    if name in SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(SUBMODULES))
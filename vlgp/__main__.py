@@ -1,6 +1,20 @@
+import ast
+import glob
+import logging
+import os
+import pathlib
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import click
 
-from . import api, util
+from .preprocess import get_config
+
+logger = logging.getLogger(__name__)
+
+# options of get_config that are not values
+HOOKS = ("callbacks", "cancel", "verbose")
 
 
 @click.command()
@@ -11,6 +25,8 @@ from . import api, util
 @click.option("--min_iter", type=click.INT, default=5, help="Minimum number of iterations")
 def cli(fin, fout, n_factors, max_iter, min_iter):
     """variational Latent Gaussian Process (vLGP)"""
+    from . import api, util
+
     click.echo("Loading {}".format(fin))
     trials = util.load(fin)
     click.secho("{} loaded".format(fin), fg="green")
@@ -22,5 +38,181 @@ def cli(fin, fout, n_factors, max_iter, min_iter):
     click.secho("{} saved".format(fout), fg="green")
 
 
+@click.command()
+@click.argument("fin", type=click.Path(exists=True), metavar='<path to input file>')
+@click.argument("fout", type=click.Path(), metavar='<path to output file>')
+@click.option("--min_factors", type=click.INT, default=1, help="Least number of factors")
+@click.option("--max_factors", type=click.INT, default=10, help="Most number of factors")
+@click.option("--omega_bound", "omega_bounds", type=(float, float), multiple=True, help="Bounds of lengthscale, repeatable")
+@click.option("--test_size", type=click.FLOAT, default=0.2, help="Fraction of held-out trials")
+@click.option("--n_jobs", type=click.INT, default=1, help="Number of worker processes")
+@click.option("--max_iter", type=click.INT, default=20, help="Maximum number of iterations")
+@click.option("--min_iter", type=click.INT, default=5, help="Minimum number of iterations")
+def sweep_cli(fin, fout, min_factors, max_factors, omega_bounds, test_size, n_jobs, max_iter, min_iter):
+    """Select the number of factors and the bounds of lengthscale by held-out co-smoothing"""
+    from . import util, validation
+
+    click.echo("Loading {}".format(fin))
+    trials = util.load(fin)
+    click.secho("{} loaded".format(fin), fg="green")
+
+    candidates = validation.sweep(
+        trials,
+        range(min_factors, max_factors + 1),
+        omega_bounds=list(omega_bounds) or None,
+        test_size=test_size,
+        n_jobs=n_jobs,
+        max_iter=max_iter,
+        min_iter=min_iter,
+    )
+
+    click.echo("{:>9} {:>22} {:>14} {:>14} {:>10}".format("n_factors", "omega_bound", "loglik", "bits/spike", "pseudo-R2"))
+    for candidate in candidates:
+        click.echo(
+            "{:>9d} {:>22} {:>14.2f} {:>14.4f} {:>10.4f}".format(
+                candidate["n_factors"],
+                "({:g}, {:g})".format(*candidate["omega_bound"]),
+                candidate["loglik"],
+                candidate["bits_per_spike"],
+                candidate["pseudo_r2"],
+            )
+        )
+
+    click.echo("Saving {}".format(fout))
+    util.save({"candidates": candidates}, fout)
+    click.secho("{} saved".format(fout), fg="green")
+
+
+def parse_value(value):
+    """Python literal of an option value, or the string itself"""
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def config_options(command):
+    """Add every option of get_config to a command"""
+    for key, default in reversed(list(get_config().items())):
+        if key in HOOKS:
+            continue
+        command = click.option(
+            "--{}".format(key),
+            key,
+            default=None,
+            metavar="VALUE",
+            help="default {!r}".format(default),
+        )(command)
+    return command
+
+
+def limit_threads(threads):
+    """Initializer of worker processes that limits the threads of BLAS and OpenMP"""
+    if threads is None:
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.warning("threadpoolctl is not installed, the number of threads is not limited")
+        return
+    global _limits
+    _limits = threadpool_limits(limits=threads)
+
+
+def run_job(fin, fout, n_factors, options):
+    """Fit one input file and save the result atomically"""
+    from . import api, util
+
+    tick = time.perf_counter()
+    summary = {"input": fin, "output": fout.as_posix(), "status": "done"}
+    try:
+        trials = util.load(fin)
+        result = api.fit(trials, n_factors, verbose=False, **options)
+        # save to a temporary name first so that a partial output is never taken as complete
+        with tempfile.TemporaryDirectory(dir=fout.parent.as_posix()) as tmpdir:
+            tmp = pathlib.Path(tmpdir) / fout.name
+            util.save(result, tmp)
+            os.replace(tmp.as_posix(), fout.as_posix())
+        runtime = result["config"]["runtime"]
+        summary.update(
+            trials=len(trials),
+            iterations=runtime["it"],
+            converged=runtime["converged"],
+            elbo=runtime["elbo"][-1] if runtime["elbo"] else None,
+        )
+    except Exception as e:
+        logger.exception(repr(e), exc_info=True)
+        summary["status"] = "failed: {!r}".format(e)
+    summary["elapsed"] = time.perf_counter() - tick
+    return summary
+
+
+def output_paths(paths, output_dir):
+    """Output of every input under output_dir, at its path relative to the common directory of the inputs"""
+    if not paths:
+        return []
+    paths = [pathlib.Path(os.path.abspath(path)) for path in paths]
+    common = pathlib.Path(os.path.commonpath([path.parent.as_posix() for path in paths]))
+    return [output_dir / path.relative_to(common).with_suffix(".npy") for path in paths]
+
+
+@click.command()
+@click.argument("inputs", nargs=-1, metavar='<input files or glob patterns>')
+@click.option("--manifest", type=click.Path(exists=True), help="File listing an input file per line")
+@click.option("--output_dir", type=click.Path(file_okay=False), default=".", help="Directory of outputs, at the paths of the inputs relative to their common directory")
+@click.option("--n_factors", type=click.INT, required=True, help="Number of factors")
+@click.option("--n_jobs", type=click.INT, default=1, help="Number of worker processes")
+@click.option("--threads", type=click.INT, default=None, help="Threads of BLAS per worker process")
+@click.option("--overwrite", is_flag=True, help="Refit inputs whose outputs exist")
+@click.option("--summary", type=click.Path(dir_okay=False), default=None, help="Summary table, <output_dir>/summary.tsv by default")
+@config_options
+def batch_cli(inputs, manifest, output_dir, n_factors, n_jobs, threads, overwrite, summary, **options):
+    """Fit many input files in a pool of worker processes
+
+    The options of fitting take Python literals, e.g. --omega_bound "(1e-3, 5e-2)" --Hstep False.
+    """
+    paths = []
+    for pattern in inputs:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    if manifest is not None:
+        with open(manifest) as fin:
+            paths.extend(line.strip() for line in fin if line.strip() and not line.startswith("#"))
+
+    options = {k: parse_value(v) for k, v in options.items() if v is not None}
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    outputs = output_paths(paths, output_dir)
+    duplicates = sorted({fout.as_posix() for fout in outputs if outputs.count(fout) > 1})
+    if duplicates:
+        raise click.UsageError("Inputs map to the same outputs: {}".format(", ".join(duplicates)))
+
+    jobs = []
+    summaries = []
+    for path, fout in zip(paths, outputs):
+        fout.parent.mkdir(parents=True, exist_ok=True)
+        if fout.exists() and not overwrite:
+            summaries.append({"input": path, "output": fout.as_posix(), "status": "skipped"})
+        else:
+            jobs.append((path, fout))
+    click.echo("{} jobs, {} skipped".format(len(jobs), len(summaries)))
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=limit_threads, initargs=(threads,)) as executor:
+        futures = [executor.submit(run_job, path, fout, n_factors, options) for path, fout in jobs]
+        for future in futures:
+            result = future.result()
+            click.echo("{status}: {input}".format(**result))
+            summaries.append(result)
+
+    columns = ("input", "output", "status", "trials", "iterations", "converged", "elbo", "elapsed")
+    summary = summary or (output_dir / "summary.tsv").as_posix()
+    with open(summary, "w") as fout:
+        fout.write("\t".join(columns) + "\n")
+        for row in summaries:
+            fout.write("\t".join(str(row.get(column, "")) for column in columns) + "\n")
+    click.secho("Summary saved to {}".format(summary), fg="green")
+
+
 if __name__ == "__main__":
     cli()
@@ -1,15 +1,13 @@
 import copy
 import logging
 
-import click
-
 from .preprocess import get_params, get_config, fill_trials, fill_params, initialize
 from .callback import Saver, show
-from .core import vem, update_w, update_v, infer
+from .core import vem, infer_trials, sample_posterior
 from .util import cut_trials
 from .gp import make_cholesky
 
-__all__ = ["fit"]
+__all__ = ["fit", "fit_async", "sample_posterior"]
 
 logger = logging.getLogger(__name__)
 
@@ -40,38 +38,159 @@ def fit(trials, n_factors, **kwargs):
     params = get_params(trials, n_factors, **kwargs)
 
     # initialization
-    click.echo("Initializing")
+    echo(config, "Initializing")
     initialize(trials, params, config)
-    click.secho("Initialized", fg="green")
+    echo(config, "Initialized", fg="green")
 
     # fill arrays
     fill_params(params)
 
-    fill_trials(trials)
-    make_cholesky(trials, params, config)
-    update_w(trials, params, config)
-    update_v(trials, params, config)
+    infer_trials(trials, params, config, run_estep=False)
 
     subtrials = cut_trials(trials, params, config)
     make_cholesky(subtrials, params, config)
 
-    fill_trials(subtrials)
-
     params["initial"] = copy.deepcopy(params)
 
     # VEM
-    click.echo("Fitting")
+    echo(config, "Fitting")
     vem(subtrials, params, config)
 
+    if config.get("runtime", {}).get("cancelled", False):
+        # checkpoint of the last whole iteration
+        echo(config, "Cancelled", fg="yellow")
+        return {"trials": trials, "params": params, "config": config, "cancelled": True}
+
     # E step only for inference given above estimated parameters and hyperparameters
-    make_cholesky(trials, params, config)
-    update_w(trials, params, config)
-    update_v(trials, params, config)
-    click.echo("Inferring")
-    infer(trials, params, config)
+    echo(config, "Inferring")
+    infer_trials(trials, params, config)
+
+    echo(config, "Done", fg="green")
+
+    result = {"trials": trials, "params": params, "config": config, "cancelled": False}
+
+    return result
+
+
+def echo(config, message, **styles):
+    if config["verbose"]:
+        import click
+
+        click.secho(message, **styles)
+
+
+# one manager process serves the queues and events of all asynchronous fits
+_manager = None
+
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        import atexit
+        import multiprocessing
+
+        _manager = multiprocessing.Manager()
+        atexit.register(shutdown_manager)
+    return _manager
+
 
-    click.secho("Done", fg="green")
+def shutdown_manager():
+    """Stop the manager process of asynchronous fits, a later fit_async starts a new one"""
+    global _manager
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None
 
-    result = {"trials": trials, "params": params, "config": config}
 
+class FitJob:
+    """Handle of an asynchronous fit, see fit_async"""
+
+    def __init__(self, future, events, cancel):
+        self.future = future
+        self.events = events
+        self._cancel = cancel
+
+    def cancel(self):
+        """Stop the fit after its current iteration, the result is the checkpoint of that iteration"""
+        self._cancel.set()
+
+    def done(self):
+        return self.future.done()
+
+    async def progress(self, interval=0.05):
+        """Asynchronous iterator of the progress events until the fit finishes
+
+        The queue of events is polled without blocking, so that no thread of the loop's executor is held.
+
+        :param interval: seconds between polls of an empty queue
+        """
+        import asyncio
+        import queue
+
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                if self.future.done() and self.events.empty():
+                    break  # died without its done event
+                await asyncio.sleep(interval)
+                continue
+            yield event
+            if event["event"] == "done":
+                break
+
+    async def result(self):
+        """Wait for the result of fit"""
+        import asyncio
+
+        return await asyncio.wrap_future(self.future)
+
+
+def fit_async(trials, n_factors, executor, path=None, **kwargs):
+    """Fit in a process pool without blocking
+
+    The fit runs silently in a worker process of the pool and streams a progress event per iteration,
+    dict of it, e_elapsed, m_elapsed, h_elapsed, em_elapsed, elbo and the relative changes dmu, da and db,
+    followed by a final event of done.
+    Cancellation is cooperative, the fit stops at the end of its current iteration with consistent parameters
+    and latents.
+
+    :param trials: list of trials
+    :param n_factors: number of latent factors
+    :param executor: concurrent.futures.ProcessPoolExecutor shared by fits
+    :param path: file to which the result (or the checkpoint if cancelled) is saved
+    :param kwargs: options of fit
+    :return: FitJob
+    """
+    manager = get_manager()
+    events = manager.Queue()
+    cancel = manager.Event()
+    future = executor.submit(run_fit, trials, n_factors, events, cancel, path, kwargs)
+    return FitJob(future, events, cancel)
+
+
+def run_fit(trials, n_factors, events, cancel, path, kwargs):
+    """Worker of fit_async"""
+    from .util import save
+
+    def report(trials, params, config):
+        runtime = config["runtime"]
+        event = {"event": "iteration", "it": runtime["it"]}
+        for key in ("e_elapsed", "m_elapsed", "h_elapsed", "em_elapsed", "elbo", "dmu", "da", "db"):
+            event[key] = runtime[key][-1]
+        events.put(event)
+
+    kwargs = dict(kwargs, callbacks=[report], cancel=cancel, verbose=False)
+    try:
+        result = fit(trials, n_factors, **kwargs)
+    finally:
+        events.put({"event": "done"})
+
+    # the hooks do not leave the worker
+    config = result["config"]
+    config["callbacks"] = []
+    config["cancel"] = None
+
+    if path is not None:
+        save(result, path)
     return result
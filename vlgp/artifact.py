@@ -0,0 +1,191 @@
+"""
+Single-file artifact of models and results
+
+Layout of a file::
+
+    magic (8 bytes) | version, index offset, index length (little-endian uint32, uint64, uint64) |
+    arrays, each aligned to ALIGNMENT bytes | JSON tree of every section | JSON index of the sections
+
+A section is a nested structure of dicts, lists, tuples, JSON values and arrays, e.g. the params of a fit.
+The tree of a section refers to its arrays by offset, dtype and shape, hence an array is read, or memory-mapped,
+only when its section is loaded. Objects that are neither, e.g. callbacks, are not saved.
+"""
+import json
+import logging
+import numbers
+import os
+import pathlib
+import struct
+
+import numpy as np
+
+__all__ = ["write", "read", "is_artifact", "Artifact"]
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"\x93VLGP\r\n\x1a"
+VERSION = 1
+HEADER = struct.Struct("<IQQ")
+ALIGNMENT = 64
+
+
+def is_artifact(file):
+    """Whether the file begins with the magic string of artifacts"""
+    with open(file, "rb") as fid:
+        return fid.read(len(MAGIC)) == MAGIC
+
+
+class Writer:
+    def __init__(self, fid):
+        self.fid = fid
+        self.start = fid.tell()
+
+    def tell(self):
+        return self.fid.tell() - self.start
+
+    def align(self):
+        self.fid.write(b"\0" * (-self.tell() % ALIGNMENT))
+
+    def array(self, arr):
+        self.align()
+        offset = self.tell()
+        self.fid.write(np.ascontiguousarray(arr).tobytes())
+        return {"offset": offset, "dtype": arr.dtype.str, "shape": list(arr.shape)}
+
+    def encode(self, obj):
+        """Tree of an object with its arrays written, None for objects that cannot be saved"""
+        if isinstance(obj, np.ndarray) and obj.dtype.hasobject:
+            obj = obj.tolist()
+        if isinstance(obj, np.ndarray):
+            return {"array": self.array(obj)}
+        if isinstance(obj, np.generic):
+            obj = obj.item()
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return {"value": obj}
+        if isinstance(obj, dict):
+            items = []
+            for key, value in obj.items():
+                if isinstance(key, numbers.Integral):
+                    key = int(key)
+                elif not isinstance(key, str):
+                    logger.warning("Key {!r} is not saved".format(key))
+                    continue
+                node = self.encode(value)
+                if node is not None:
+                    items.append([key, node])
+            return {"dict": items}
+        if isinstance(obj, (list, tuple)):
+            nodes = [node for node in map(self.encode, obj) if node is not None]
+            return {"tuple" if isinstance(obj, tuple) else "list": nodes}
+        logger.warning("{} is not saved".format(type(obj).__name__))
+        return None
+
+    def write(self, sections):
+        self.fid.write(MAGIC)
+        self.fid.write(HEADER.pack(0, 0, 0))  # patched at the end
+
+        trees = {name: self.encode(section) for name, section in sections.items()}
+        index = {}
+        for name, tree in trees.items():
+            blob = json.dumps(tree).encode()
+            index[name] = {"offset": self.tell(), "length": len(blob)}
+            self.fid.write(blob)
+
+        blob = json.dumps(index).encode()
+        offset = self.tell()
+        self.fid.write(blob)
+        end = self.fid.tell()
+        self.fid.seek(self.start + len(MAGIC))
+        self.fid.write(HEADER.pack(VERSION, offset, len(blob)))
+        self.fid.seek(end)
+
+
+def write(file, sections):
+    """Write sections to an artifact
+
+    :param file: path or seekable binary file
+    :param sections: dict of sections
+    """
+    if isinstance(file, (str, pathlib.Path)):
+        # replace rather than overwrite the file that may be memory-mapped
+        tmp = "{}.tmp".format(file)
+        with open(tmp, "wb") as fid:
+            Writer(fid).write(sections)
+        os.replace(tmp, file)
+    else:
+        Writer(file).write(sections)
+
+
+class Artifact:
+    """Reader of an artifact
+
+    :param file: path of the artifact
+    :param mmap: memory-map the arrays copy-on-write, otherwise read them into memory
+    """
+
+    def __init__(self, file, mmap=True):
+        self.file = pathlib.Path(file)
+        self.mmap = mmap
+        self.buffer = None
+
+        with open(self.file, "rb") as fid:
+            if fid.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not an artifact".format(self.file))
+            version, offset, length = HEADER.unpack(fid.read(HEADER.size))
+            if version > VERSION:
+                raise ValueError(
+                    "{} is of version {} newer than {}".format(self.file, version, VERSION)
+                )
+            fid.seek(offset)
+            self.index = json.loads(fid.read(length).decode())
+        self.version = version
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, name):
+        """Load a section"""
+        entry = self.index[name]
+        with open(self.file, "rb") as fid:
+            fid.seek(entry["offset"])
+            tree = json.loads(fid.read(entry["length"]).decode())
+            return self.decode(tree, fid)
+
+    def array(self, spec, fid):
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        count = int(np.prod(shape))
+        if self.mmap and count > 0:
+            if self.buffer is None:
+                self.buffer = np.asarray(np.memmap(self.file, dtype=np.uint8, mode="c"))
+            start = spec["offset"]
+            return self.buffer[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+        fid.seek(spec["offset"])
+        return np.frombuffer(fid.read(count * dtype.itemsize), dtype=dtype).reshape(shape).copy()
+
+    def decode(self, node, fid):
+        (kind, content), = node.items()
+        if kind == "array":
+            return self.array(content, fid)
+        if kind == "value":
+            return content
+        if kind == "dict":
+            return {key: self.decode(value, fid) for key, value in content}
+        if kind == "tuple":
+            return tuple(self.decode(value, fid) for value in content)
+        return [self.decode(value, fid) for value in content]
+
+
+def read(file, sections=None, mmap=True):
+    """Read sections of an artifact
+
+    :param file: path of the artifact
+    :param sections: names of the sections to read, all if None
+    :param mmap: memory-map the arrays copy-on-write, otherwise read them into memory
+    :return: dict of sections
+    """
+    artifact = Artifact(file, mmap)
+    return {name: artifact[name] for name in (artifact if sections is None else sections)}
@@ -1,29 +1,64 @@
 from abc import ABCMeta, abstractmethod
+import importlib
 import pickle
-from pathlib import Path
+
+from . import artifact
 
 
 class Model(metaclass=ABCMeta):
+    # attributes that are loaded on first access, e.g. the training trials
+    _lazy_attributes = ()
+
     @abstractmethod
     def fit(self, *args, **kwargs):
         pass
 
+    def __getstate__(self):
+        state = dict(vars(self))
+        state.pop("_artifact", None)
+        for name in self._lazy_attributes:
+            if name not in state:
+                state[name] = getattr(self, name)
+        return state
+
     def save(self, file):
-        own_fid = False
-        if isinstance(file, str) or isinstance(file, Path):
-            fid = open(file, "wb")
-            own_fid = True
-        else:
-            fid = file
-
-        try:
-            pickle.dump(self, fid)
-        finally:
-            if own_fid:
-                fid.close()
+        """Save the model as an artifact of its attributes, see artifact"""
+        cls = type(self)
+        sections = {"__class__": "{}:{}".format(cls.__module__, cls.__qualname__)}
+        sections.update(self.__getstate__())
+        artifact.write(file, sections)
 
     @staticmethod
-    def load(file):
-        with open(file, "rb") as f:
-            model = pickle.load(f)
+    def load(file, mmap=True):
+        """Load a model
+
+        :param file: artifact saved by Model.save, or a legacy pickle
+        :param mmap: memory-map the arrays copy-on-write
+        """
+        if not artifact.is_artifact(file):
+            with open(file, "rb") as f:
+                model = pickle.load(f)
+            return model
+
+        reader = artifact.Artifact(file, mmap)
+        module, name = reader["__class__"].split(":")
+        cls = importlib.import_module(module)
+        for attr in name.split("."):
+            cls = getattr(cls, attr)
+        if not (isinstance(cls, type) and issubclass(cls, Model)):
+            raise TypeError("{} is not a model".format(name))
+
+        model = cls.__new__(cls)
+        for section in reader:
+            if section != "__class__" and section not in cls._lazy_attributes:
+                setattr(model, section, reader[section])
+        model._artifact = reader
         return model
+
+    def __getattr__(self, name):
+        # only called for missing attributes
+        if name in type(self)._lazy_attributes and "_artifact" in self.__dict__:
+            value = self.__dict__["_artifact"][name]
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
@@ -0,0 +1,901 @@
+"""
+Batched fitting of many independent models
+
+Fitting small datasets (tens of neurons, few latents) one at a time leaves BLAS idle, since every step loops over
+trials and latents in Python with tiny matrices. Here the segments of all models are stacked along a leading item
+axis, and every step of vEM runs on the whole stack in batched array operations:
+
+- E step: the coordinate Newton steps of core.estep, for all segments at once in chunks of about chunk_size bins.
+- M step: the line search Newton of core.optimize_loading, with the statistics of every model reduced at once.
+- H step: Whittle likelihood (see gp.whittle) by batched Fisher scoring.
+- prior: the segments share one length, so the prior factors of all models are batched eigendecompositions.
+
+The neurons are padded to the largest model and masked as missing. Every model keeps its own convergence state and
+leaves the stack once converged. The segments are copied into the stack, hence a bin shared by overlapping segments
+is updated by each of them and the last one is kept.
+"""
+import copy
+import logging
+
+import numpy as np
+from numpy import einsum, identity
+from numpy.linalg import LinAlgError
+
+from .api import echo
+from .core import infer_trials, update_w
+from .evaluation import timer
+from .gp import sigma_bound
+from .math import trunc_exp
+from .preprocess import get_config, get_params, fill_params, fill_trials, initialize, observed_entries
+from .util import clip, cut_trials, pad_trial, pad_trials, unpad_trials
+
+__all__ = ["fit"]
+
+logger = logging.getLogger(__name__)
+
+# arrays along the item axis, the latents are written back to the trials
+ITEM_KEYS = ("y", "x", "obs", "mu", "v", "w", "dmu", "model")
+LATENT_KEYS = ("mu", "v", "w", "dmu")
+# arrays along the model axis, the parameters are written back to the models
+MODEL_KEYS = ("a", "b", "da", "db", "noise", "sigma", "omega", "gp_noise", "poisson", "gaussian", "valid")
+PARAM_KEYS = ("a", "b", "da", "db", "noise", "sigma", "omega")
+
+
+def fit(datasets, n_factors, **kwargs):
+    """Fit a model to each of many datasets in lockstep
+
+    :param datasets: list of lists of trials, one per model
+    :param n_factors: number of latent factors of every model
+    :param kwargs: options, see api.fit
+    :return: list of results per model, see api.fit
+    """
+    config = get_config(**kwargs)
+    if not config["window"]:
+        raise ValueError("Batched fitting needs the trials cut into windows")
+    if config["constrain_latent"] and config["constrain_latent"] != "none":
+        raise NotImplementedError("constrain_latent is not supported by batched fitting")
+    if config["constrain_loading"] == "svd":
+        raise NotImplementedError("constrain_loading svd is not supported by batched fitting")
+    if config["estep"] != "coordinate" or config["solver"] != "lowrank":
+        logger.warning("Batched fitting uses the low-rank coordinate E step")
+    if config["Hstep"] and config["hstep_method"] != "whittle":
+        logger.warning("Batched fitting uses Whittle H step")
+    if config["accelerate"] or config["resample_segments"] or config["callbacks"]:
+        logger.warning("Batched fitting ignores accelerate, resample_segments and callbacks")
+
+    # initialize every model, see api.fit
+    echo(config, "Initializing")
+    kwargs["omega_bound"] = config["omega_bound"]
+    models = []
+    for trials in datasets:
+        params = get_params(trials, n_factors, **kwargs)
+        initialize(trials, params, config)
+        fill_params(params)
+        infer_trials(trials, params, config, run_estep=False)
+        segments = list(cut_trials(trials, params, config))
+        if not segments:
+            raise ValueError("A dataset has no trials")
+        params["initial"] = copy.deepcopy(params)
+        models.append((trials, params, segments))
+    if len({params["xdim"] for _, params, _ in models}) > 1:
+        raise ValueError("The models must have the same number of regressors")
+    echo(config, "Initialized", fg="green")
+
+    ydim = max(params["ydim"] for _, params, _ in models)
+    members = [(m, segment) for m, (_, _, segments) in enumerate(models) for segment in segments]
+    # the trials shorter than the window are padded with missing bins
+    stack = stack_items([(m, pad_trial(segment, config["window"])) for m, segment in members], ydim)
+    stack.update(stack_params([params for _, params, _ in models], ydim))
+
+    runtimes = [new_runtime() for _ in models]
+    cancelled = vem(stack, runtimes, models[0][1]["rank"], config)
+
+    # copy back the parameters and the latents of segments
+    unstack_latents(stack, members)
+    for m, (trials, params, _) in enumerate(models):
+        unstack_params(stack, m, params)
+
+    if not cancelled:
+        echo(config, "Inferring")
+        infer_models([trials for trials, _, _ in models], [params for _, params, _ in models], config)
+        echo(config, "Done", fg="green")
+    else:
+        echo(config, "Cancelled", fg="yellow")
+
+    results = []
+    for (trials, params, _), runtime in zip(models, runtimes):
+        model_config = dict(config, runtime=runtime)
+        results.append({"trials": trials, "params": params, "config": model_config, "cancelled": cancelled})
+    return results
+
+
+def new_runtime():
+    return {
+        "it": 0,
+        "e_elapsed": [],
+        "m_elapsed": [],
+        "h_elapsed": [],
+        "em_elapsed": [],
+        "elbo": [],
+        "dmu": [],  # relative changes
+        "da": [],
+        "db": [],
+        "cancelled": False,
+        "converged": False,
+    }
+
+
+def vem(stack, runtimes, rank, config):
+    """Variational EM of all models in the stack, see core.vem
+
+    :param runtimes: runtime per model, updated in place
+    :param rank: rank of the prior factors
+    :return: whether cancelled
+    """
+    tol = config["tol"]
+    elbo_tol = config["elbo_tol"]
+    eps = config["eps"]
+    window = stack["y"].shape[1]
+
+    active = np.ones(stack["a"].shape[0], dtype=bool)
+    models = np.flatnonzero(active)
+    sub, items = subset(stack, models)
+    for it in range(config["max_iter"]):
+        n_models = len(models)
+        norm_mu = np.sqrt(per_model(np.sum(sub["mu"] ** 2, axis=(1, 2)), sub["model"], n_models))
+        norm_a = np.sqrt(np.sum(sub["a"] ** 2, axis=(1, 2)))
+        norm_b = np.sqrt(np.sum(sub["b"] ** 2, axis=(1, 2)))
+
+        with timer() as em_elapsed:
+            with timer() as estep_elapsed:
+                constrain_loading(sub, config)
+                prior, pinv = prior_factors(sub["sigma"], sub["omega"], window, rank)
+                lower_bound = estep(sub, prior, pinv, config)
+            with timer() as mstep_elapsed:
+                mstep(sub, config)
+            with timer() as hstep_elapsed:
+                if config["Hstep"] and config["monotone"]:
+                    guarded_hstep(sub, prior, rank, config)
+                elif config["Hstep"]:
+                    hstep(sub, prior if config["method"] == "VB" else None, config)
+
+        dmu = np.sqrt(per_model(np.sum(sub["dmu"] ** 2, axis=(1, 2)), sub["model"], n_models))
+        da = np.sqrt(np.sum(sub["da"] ** 2, axis=(1, 2)))
+        db = np.sqrt(np.sum(sub["db"] ** 2, axis=(1, 2)))
+
+        converged = np.zeros(n_models, dtype=bool)
+        for j, m in enumerate(models):
+            runtime = runtimes[m]
+            runtime["it"] += 1
+            runtime["e_elapsed"].append(estep_elapsed())
+            runtime["m_elapsed"].append(mstep_elapsed())
+            runtime["h_elapsed"].append(hstep_elapsed())
+            runtime["em_elapsed"].append(em_elapsed())
+            runtime["elbo"].append(lower_bound[j])
+            runtime["dmu"].append(dmu[j] / (norm_mu[j] + eps))
+            runtime["da"].append(da[j] / (norm_a[j] + eps))
+            runtime["db"].append(db[j] / (norm_b[j] + eps))
+
+            converged[j] = runtime["dmu"][-1] < tol and runtime["da"][-1] < tol and runtime["db"][-1] < tol
+            if elbo_tol is not None and len(runtime["elbo"]) > 1:
+                previous, current = runtime["elbo"][-2:]
+                converged[j] = converged[j] or abs(current - previous) < elbo_tol * abs(previous)
+
+        echo(
+            config,
+            "Iteration {:4d}, {} models, EM {:.2f}s".format(it + 1, n_models, em_elapsed()),
+        )
+
+        cancel = config["cancel"]
+        if cancel is not None and cancel.is_set():
+            update(stack, sub, models, items)
+            for m in models:
+                runtimes[m]["cancelled"] = True
+            return True
+
+        if it + 1 >= config["min_iter"] and np.any(converged):
+            # the converged models leave the stack
+            for m in models[converged]:
+                runtimes[m]["converged"] = True
+            update(stack, sub, models, items)
+            active[models[converged]] = False
+            if not np.any(active):
+                break
+            models = np.flatnonzero(active)
+            sub, items = subset(stack, models)
+    else:
+        update(stack, sub, models, items)
+
+    return False
+
+
+def stack_items(members, ydim):
+    """Stack trials or segments of equal length along the item axis
+
+    :param members: list of model index and trial
+    :param ydim: number of neurons the models are padded to
+    :return: dict of arrays (item, time, ...)
+    """
+    def pad(a, fill_value=0):
+        width = [(0, 0)] * (a.ndim - 1) + [(0, ydim - a.shape[-1])]
+        return np.pad(a, width, constant_values=fill_value)
+
+    obs = np.stack([pad(observed_entries(trial), False) for _, trial in members]).astype(float)
+    return {
+        "y": np.stack([pad(np.asarray(trial["y"], dtype=float)) for _, trial in members]) * obs,
+        "x": np.stack([pad(np.asarray(trial["x"], dtype=float)) for _, trial in members]),
+        "obs": obs,
+        "mu": np.stack([trial["mu"] for _, trial in members]).astype(float),
+        "v": np.stack([trial["v"] for _, trial in members]).astype(float),
+        "w": np.stack([trial["w"] for _, trial in members]).astype(float),
+        "dmu": np.stack([trial["dmu"] for _, trial in members]).astype(float),
+        "model": np.array([m for m, _ in members], dtype=int),
+    }
+
+
+def stack_params(params_list, ydim):
+    """Stack the parameters of models along the model axis, the padded neurons are zero"""
+    n_models = len(params_list)
+    zdim = params_list[0]["zdim"]
+    xdim = params_list[0]["xdim"]
+
+    stack = {
+        "a": np.zeros((n_models, zdim, ydim)),
+        "b": np.zeros((n_models, xdim, ydim)),
+        "da": np.zeros((n_models, zdim, ydim)),
+        "db": np.zeros((n_models, xdim, ydim)),
+        "noise": np.ones((n_models, ydim)),
+        "sigma": np.stack([params["sigma"] for params in params_list]).astype(float),
+        "omega": np.stack([params["omega"] for params in params_list]).astype(float),
+        "gp_noise": np.array([params["gp_noise"] for params in params_list], dtype=float),
+        "poisson": np.zeros((n_models, ydim), dtype=bool),
+        "gaussian": np.zeros((n_models, ydim), dtype=bool),
+        "valid": np.zeros((n_models, ydim), dtype=bool),
+    }
+    for m, params in enumerate(params_list):
+        n = params["ydim"]
+        for key in ("a", "b", "da", "db"):
+            stack[key][m, :, :n] = params[key]
+        stack["noise"][m, :n] = params["noise"]
+        stack["poisson"][m, :n] = params["likelihood"] == "poisson"
+        stack["gaussian"][m, :n] = params["likelihood"] == "gaussian"
+        stack["valid"][m, :n] = True
+    stack["noise"][~stack["valid"]] = 1
+    return stack
+
+
+def unstack_latents(stack, members):
+    """Copy the latents of the stack to the trials or segments, without the bins they were padded with"""
+    for k, (_, trial) in enumerate(members):
+        for key in LATENT_KEYS:
+            trial[key][...] = stack[key][k][:trial[key].shape[0]]
+
+
+def unstack_params(stack, m, params):
+    """Copy the parameters of a model from the stack"""
+    n = params["ydim"]
+    for key in ("a", "b", "da", "db"):
+        params[key] = stack[key][m, :, :n].copy()
+    params["noise"] = stack["noise"][m, :n].copy()
+    params["sigma"] = stack["sigma"][m].copy()
+    params["omega"] = stack["omega"][m].copy()
+
+
+def subset(stack, models):
+    """Stack of some of the models, which are renumbered
+
+    :param models: sorted indices of models
+    :return: stack and the indices of its items in the original stack
+    """
+    items = np.flatnonzero(np.isin(stack["model"], models))
+    sub = {key: stack[key][items] for key in ITEM_KEYS}
+    sub["model"] = np.searchsorted(models, stack["model"][items])
+    sub.update({key: stack[key][models] for key in MODEL_KEYS})
+    return sub, items
+
+
+def update(stack, sub, models, items):
+    """Copy the latents and parameters of a subset back to the stack"""
+    for key in LATENT_KEYS:
+        stack[key][items] = sub[key]
+    for key in PARAM_KEYS:
+        stack[key][models] = sub[key]
+
+
+def per_model(values, model, n_models):
+    """Sums of values (item, ...) over the items of every model"""
+    onehot = (model == np.arange(n_models)[:, np.newaxis]).astype(float)
+    return (onehot @ values.reshape(len(model), -1)).reshape((n_models,) + values.shape[1:])
+
+
+def chunks(stack, size):
+    """Slices of consecutive items of about size time bins"""
+    n_items, length = stack["mu"].shape[:2]
+    step = max(size // length, 1)
+    for start in range(0, n_items, step):
+        yield slice(start, start + step)
+
+
+def prior_factors(sigma, omega, length, rank, tol=1e-6):
+    """Low-rank factors of the prior covariance of every latent of every model
+
+    The factors are of the batched eigendecompositions of the covariance matrices. Like the incomplete Cholesky
+    factors (see gp.ichol_factor), a factor of unit variance has the fewest columns such that tr(K - GG') <= tol *
+    length, and the other columns are zero. The factors are truncated to the most columns kept by any of them.
+
+    :param sigma: (model, latent)
+    :param omega: (model, latent)
+    :return: factors (model, latent, time, rank) and their pseudo-inverses (model, latent, rank, time)
+    """
+    t = np.arange(length)
+    K = np.exp(-omega[..., np.newaxis, np.newaxis] * (t[:, np.newaxis] - t) ** 2)
+    s, U = np.linalg.eigh(K)  # ascending
+    s = np.maximum(s[..., ::-1][..., :rank], 0)
+    U = U[..., ::-1][..., :rank]
+
+    keep = length - (np.cumsum(s, axis=-1) - s) > tol * length
+    rank = max(np.max(np.sum(keep, axis=-1)), 1)
+    s, U, keep = s[..., :rank], U[..., :rank], keep[..., :rank]
+    sqrt_s = np.sqrt(s)
+    scale = sigma[..., np.newaxis, np.newaxis]
+    G = U * np.where(keep, sqrt_s, 0)[..., np.newaxis, :] * scale
+    pinv = np.swapaxes(U, -1, -2) * np.where(keep, 1 / np.where(keep, sqrt_s, 1), 0)[..., np.newaxis] / scale
+    return G, pinv
+
+
+def constrain_loading(stack, config):
+    """Normalize the loading matrices and rescale the latents alike, see core.constrain_loading"""
+    constraint = config["constrain_loading"]
+
+    if not constraint or constraint == "none":
+        return
+
+    eps = config["eps"]
+    a = stack["a"]
+    if constraint == "fro":
+        s = np.sqrt(np.sum(a ** 2, axis=(1, 2), keepdims=True)) + eps
+    else:
+        s = np.linalg.norm(a, ord=constraint, axis=2, keepdims=True) + eps
+    stack["a"] = a / s
+    s = np.swapaxes(s, 1, 2)  # (model, 1, latent)
+    stack["mu"] *= s[stack["model"]]
+    if not config["monotone"]:
+        return
+    stack["v"] *= s[stack["model"]] ** 2
+    stack["w"] /= s[stack["model"]] ** 2
+    stack["sigma"] = stack["sigma"] * s[:, 0, :]
+
+
+def estep(stack, prior, pinv, config):
+    """E step of all items in the stack, see core.estep
+
+    :param prior: prior factors (model, latent, time, rank)
+    :param pinv: pseudo-inverses of the prior factors, None not to evaluate the lower bound
+    :return: lower bound per model
+    """
+    n_models = stack["a"].shape[0]
+    lower_bound = np.zeros(n_models)
+    if config["Eniter"] < 1:
+        return lower_bound
+
+    for items in chunks(stack, config["chunk_size"]):
+        lower_bound += per_model(
+            estep_chunk(stack, items, prior, pinv, config), stack["model"][items], n_models
+        )
+    return lower_bound
+
+
+def estep_chunk(stack, items, prior, pinv, config):
+    """Coordinate E step of a chunk of items
+
+    :return: lower bound per item
+    """
+    niter = config["Eniter"]
+    method = config["method"]
+    dmu_bound = config["dmu_bound"]
+
+    model = stack["model"][items]
+    y = stack["y"][items]
+    x = stack["x"][items]
+    obs = stack["obs"][items]
+    # views, updated in place
+    mu = stack["mu"][items]
+    v = stack["v"][items]
+    w = stack["w"][items]
+    dmu = stack["dmu"][items]
+
+    a = stack["a"][model]
+    b = stack["b"][model]
+    noise = stack["noise"][model][:, np.newaxis, :]
+    poisson = stack["poisson"][model][:, np.newaxis, :]
+    asq = a ** 2
+    asqT = np.swapaxes(asq, 1, 2)
+    zdim = mu.shape[-1]
+    Ir = identity(prior.shape[-1])
+    xb = einsum("ktpn, kpn -> ktn", x, b)
+
+    for i in range(niter):
+        eta = mu @ a + xb
+        vterm = 0.5 * (v @ asq)
+        r = trunc_exp(eta + vterm)
+        U = np.where(poisson, r, 1 / noise) * obs
+        np.matmul(U, asqT, out=w)
+
+        for l in range(zdim):
+            G = prior[model, l]
+            Gt = np.swapaxes(G, 1, 2)
+
+            # working residuals
+            residual = np.where(poisson, y - r, (y - eta) / noise) * obs
+            wG = w[..., l, np.newaxis] * G
+            u = G @ (Gt @ (residual @ a[:, l, :, np.newaxis])) - mu[..., l, np.newaxis]
+            # (K^-1 + W)^-1 W u = G (I + G'WG)^-1 G'W u
+            delta_mu = (u - G @ np.linalg.solve(Ir + Gt @ wG, np.swapaxes(wG, 1, 2) @ u))[..., 0]
+            clip(delta_mu, dmu_bound)
+
+            dmu[..., l] = delta_mu
+            mu[..., l] += delta_mu
+
+            # rank-1 update of the linear predictor
+            eta += delta_mu[..., np.newaxis] * a[:, np.newaxis, l, :]
+            r = trunc_exp(eta + vterm)
+            U = np.where(poisson, r, 1 / noise) * obs
+            np.matmul(U, asqT, out=w)
+
+        if method == "VB" and i < niter - 1:
+            posterior_chunk(stack, items, prior, None, config)
+
+    return posterior_chunk(stack, items, prior, pinv, config)
+
+
+def elbo(stack, prior, pinv, config):
+    """Lower bound per model, with the posterior variance updated to the prior (VB), see core.elbo"""
+    n_models = stack["a"].shape[0]
+    total = np.zeros(n_models)
+    for items in chunks(stack, config["chunk_size"]):
+        total += per_model(posterior_chunk(stack, items, prior, pinv, config), stack["model"][items], n_models)
+    return total
+
+
+def posterior_chunk(stack, items, prior, pinv, config):
+    """Posterior variance (VB) and lower bound of a chunk of items given their means and weights, see core.elbo
+
+    :param pinv: pseudo-inverses of the prior factors, None not to evaluate the lower bound
+    :return: lower bound per item
+    """
+    from scipy.special import gammaln
+
+    method = config["method"]
+    model = stack["model"][items]
+    bound = np.zeros(len(model))
+    if method != "VB" and pinv is None:
+        return bound
+
+    y = stack["y"][items]
+    obs = stack["obs"][items]
+    mu = stack["mu"][items]
+    v = stack["v"][items]
+    w = stack["w"][items]
+    a = stack["a"][model]
+    Ir = identity(prior.shape[-1])
+
+    for l in range(mu.shape[-1]):
+        G = prior[model, l]
+        P = Ir + np.swapaxes(G, 1, 2) @ (w[..., l, np.newaxis] * G)
+        Pinv = np.linalg.inv(P)
+        if method == "VB":
+            # diag((K^-1 + W)^-1) = diag(G P^-1 G')
+            v[..., l] = np.sum(G * (G @ Pinv), axis=-1)
+        if pinv is not None:
+            m = (pinv[model, l] @ mu[..., l, np.newaxis])[..., 0]
+            logdet = 2 * np.sum(np.log(np.diagonal(np.linalg.cholesky(P), axis1=1, axis2=2)), axis=1)
+            # tr(P^-1 G'WG) = tr(I - P^-1)
+            trace = np.trace(Ir - Pinv, axis1=1, axis2=2)
+            bound -= 0.5 * (np.sum(m ** 2, axis=1) - trace + logdet)
+
+    if pinv is not None:
+        noise = stack["noise"][model][:, np.newaxis, :]
+        poisson = stack["poisson"][model][:, np.newaxis, :]
+        eta = mu @ a + einsum("ktpn, kpn -> ktn", stack["x"][items], stack["b"][model])
+        vterm = v @ a ** 2
+        r = trunc_exp(eta + 0.5 * vterm)
+        lik = np.where(
+            poisson,
+            y * eta - r - gammaln(y + 1),
+            -0.5 * (np.log(2 * np.pi * noise) + ((y - eta) ** 2 + vterm) / noise),
+        )
+        bound += np.sum(lik * obs, axis=(1, 2))
+    return bound
+
+
+def statistics(stack, name, *args, size=100000):
+    """Statistics of the M step summed over the items of every model, see chunk_statistics"""
+    n_models = stack["a"].shape[0]
+    total = None
+    for items in chunks(stack, size):
+        stats = chunk_statistics(stack, items, name, *args)
+        stats = tuple(per_model(s, stack["model"][items], n_models) for s in stats)
+        total = stats if total is None else tuple(t + s for t, s in zip(total, stats))
+    return total
+
+
+def chunk_statistics(stack, items, name, *args):
+    """Statistics of the M step of a chunk of items, see core.chunk_statistics
+
+    count: number of observed entries (item, neuron)
+    moments: the fixed moments of the least squares of Gaussian neurons
+    residual (a, b): sum and sum of squares of the residual
+    objective (a, b): negative expected log-likelihood of Poisson neurons up to constants
+    poisson (a, b): sums of the objective and of the rate weighted products of mu, v and x,
+        from which its gradient and Hessian follow given a (see poisson_derivatives)
+
+    :return: tuple of statistics (item, ..., neuron)
+    """
+    model = stack["model"][items]
+    y = stack["y"][items]
+    x = stack["x"][items]
+    obs = stack["obs"][items]
+    mu = stack["mu"][items]
+    v = stack["v"][items]
+
+    if name == "count":
+        return (obs.sum(axis=1),)
+    if name == "moments":
+        zdim = mu.shape[-1]
+        mm = einsum("ktj, ktl, ktn -> kjln", mu, mu, obs, optimize=True)
+        diag = np.arange(zdim)
+        mm[:, diag, diag] += einsum("ktj, ktn -> kjn", v, obs)
+        return (
+            mm,
+            einsum("ktj, ktn -> kjn", mu, y),
+            einsum("ktj, ktpn, ktn -> kjpn", mu, x, obs, optimize=True),
+            einsum("ktpn, ktqn, ktn -> kpqn", x, x, obs, optimize=True),
+            einsum("ktpn, ktn -> kpn", x, y),
+        )
+
+    a, b = (arg[model] for arg in args)
+    eta = mu @ a + einsum("ktpn, kpn -> ktn", x, b)
+    if name == "residual":
+        residual = (y - eta) * obs
+        return np.sum(residual, axis=1), np.sum(residual ** 2, axis=1)
+
+    r = trunc_exp(eta + 0.5 * (v @ a ** 2)) * obs
+    f = np.sum(r - y * eta, axis=1)
+    if name == "objective":
+        return (f,)
+    if name == "poisson":
+        return (
+            f,
+            einsum("ktj, ktn -> kjn", mu, r - y),
+            einsum("ktj, ktn -> kjn", v, r),
+            einsum("ktpn, ktn -> kpn", x, r - y),
+            einsum("ktj, ktl, ktn -> kjln", mu, mu, r, optimize=True),
+            einsum("ktj, ktl, ktn -> kjln", mu, v, r, optimize=True),
+            einsum("ktj, ktl, ktn -> kjln", v, v, r, optimize=True),
+            einsum("ktj, ktpn, ktn -> kjpn", mu, x, r, optimize=True),
+            einsum("ktj, ktpn, ktn -> kjpn", v, x, r, optimize=True),
+            einsum("ktpn, ktqn, ktn -> kpqn", x, x, r, optimize=True),
+        )
+    raise ValueError("unknown statistics {}".format(name))
+
+
+def poisson_derivatives(stats, a):
+    """Gradient and Hessian in theta = (a_n, b_n) of every neuron of every model, see core.poisson_stats
+
+    :param stats: poisson statistics per model
+    :return: objective (model, neuron), gradient (model, neuron, zdim + xdim),
+        Hessian (model, neuron, zdim + xdim, zdim + xdim)
+    """
+    f, mu_r, v_r, x_r, mm_r, mv_r, vv_r, mx_r, vx_r, xx_r = stats
+    zdim = a.shape[1]
+    a_j = a[:, :, np.newaxis, :]
+    a_l = a[:, np.newaxis, :, :]
+
+    # d eta / d a_j = mu_j + v_j a_j
+    grad = np.concatenate([mu_r + a * v_r, x_r], axis=1)
+    haa = mm_r + mv_r * a_l + np.swapaxes(mv_r, 1, 2) * a_j + vv_r * a_j * a_l
+    diag = np.arange(zdim)
+    haa[:, diag, diag] += v_r
+    hab = mx_r + vx_r * a_j
+    hess = np.concatenate(
+        [
+            np.concatenate([haa, hab], axis=2),
+            np.concatenate([np.swapaxes(hab, 1, 2), xx_r], axis=2),
+        ],
+        axis=1,
+    )
+    return f, np.moveaxis(grad, -1, 1), np.moveaxis(hess, -1, 1)
+
+
+def mstep(stack, config):
+    """M step of all models in the stack, see core.optimize_loading"""
+    niter = config["Mniter"]
+    if niter < 1:
+        return
+
+    grad_tol = config["grad_tol"]
+    size = config["chunk_size"]
+    valid = stack["valid"]
+    gaussian = stack["gaussian"]
+    active = stack["poisson"].copy()
+    a0 = np.copy(stack["a"])
+    b0 = np.copy(stack["b"])
+
+    (count,) = statistics(stack, "count", size=size)
+    count = np.maximum(count, 1)
+    if np.any(gaussian):
+        bm, n = np.nonzero(gaussian)
+        mm, my, mx, xx, xy = (
+            np.moveaxis(s, -1, 1)[bm, n] for s in statistics(stack, "moments", size=size)
+        )
+
+    for i in range(niter):
+        s1, s2 = statistics(stack, "residual", stack["a"], stack["b"], size=size)
+        noise = np.where(valid, (s2 - s1 ** 2 / count) / count, 1)  # MLE
+
+        if np.any(active):
+            converged = newton_poisson(stack, active, grad_tol * count, size)
+            active &= ~converged
+
+        if np.any(gaussian):
+            a = stack["a"]
+            b = stack["b"]
+            # least squares of Gaussian neurons, see core.optimize_loading
+            a[bm, :, n] = np.linalg.solve(mm, my - (mx @ b[bm, :, n, np.newaxis])[..., 0])
+            b[bm, :, n] = np.linalg.solve(
+                xx, xy - (np.swapaxes(mx, 1, 2) @ a[bm, :, n, np.newaxis])[..., 0]
+            )
+            b[bm, 1:, n] = 0
+
+        stack["noise"] = noise
+
+        if not np.any(active) and not np.any(gaussian):
+            break
+
+    # changes by the whole M step, see core.optimize_loading
+    stack["da"] = stack["a"] - a0
+    stack["db"] = stack["b"] - b0
+
+
+def newton_poisson(stack, active, gtol, size, max_backtrack=30):
+    """Newton step with backtracking line search of the active Poisson neurons, see core.newton_poisson
+
+    :param active: boolean array (model, neuron) of the neurons to update
+    :param gtol: gradient norm under which a neuron has converged (model, neuron)
+    :return: boolean array of converged neurons
+    """
+    a = stack["a"]
+    b = stack["b"]
+    zdim = a.shape[1]
+
+    stats = statistics(stack, "poisson", a, b, size=size)
+    f, grad, hess = poisson_derivatives(stats, a)
+    converged = np.linalg.norm(grad, axis=-1) < gtol
+    solvable = active & ~converged
+    grad[~solvable] = 0
+    hess[~solvable] = identity(hess.shape[-1])
+
+    try:
+        delta = -np.linalg.solve(hess, grad[..., np.newaxis])[..., 0]
+    except LinAlgError:
+        delta = np.empty_like(grad)
+        for index in np.ndindex(*grad.shape[:2]):
+            try:
+                delta[index] = -np.linalg.solve(hess[index], grad[index])
+            except LinAlgError as e:
+                logger.exception(repr(e), exc_info=True)
+                delta[index] = -grad[index]  # steepest descent
+
+    slope = np.sum(grad * delta, axis=-1)
+    ascent = solvable & ~(slope < 0)
+    delta[ascent] = -grad[ascent]
+    slope[ascent] = -np.sum(grad[ascent] ** 2, axis=-1)
+
+    def moved(step):
+        da = np.moveaxis(step[..., np.newaxis] * delta, 1, -1)
+        return a + da[:, :zdim], b + da[:, zdim:]
+
+    # Armijo condition
+    step = np.where(solvable, 1.0, 0.0)
+    pending = solvable.copy()
+    for _ in range(max_backtrack):
+        if not np.any(pending):
+            break
+        (f_new,) = statistics(stack, "objective", *moved(step), size=size)
+        accepted = f_new <= f + 1e-4 * step * slope
+        pending &= ~accepted
+        step[pending] *= 0.5
+    step[pending] = 0  # no decrease found
+
+    new_a, new_b = moved(step)
+    mask = active[:, np.newaxis, :]
+    stack["da"] = np.where(mask, new_a - a, stack["da"])
+    stack["db"] = np.where(mask, new_b - b, stack["db"])
+    stack["a"] = new_a
+    stack["b"] = new_b
+
+    return converged
+
+
+def hstep(stack, prior, config):
+    """Fit the hyperparameters of all models by Whittle likelihood, see gp.whittle_fit
+
+    :param prior: prior factors (model, latent, time, rank) of the E step, None for the posterior means only (MAP)
+    """
+    n_models = stack["a"].shape[0]
+    length = stack["mu"].shape[1]
+
+    # expected periodograms averaged over the segments of every model, see gp.periodogram
+    h = np.hanning(length + 2)[1:-1]
+    h *= np.sqrt(length / np.sum(h ** 2))
+    pgram = 0
+    for items in chunks(stack, config["chunk_size"]):
+        model = stack["model"][items]
+        chunk = np.abs(np.fft.rfft(h[:, np.newaxis] * stack["mu"][items], axis=1)) ** 2
+        if prior is not None:
+            G = prior[model]
+            Gt = np.swapaxes(G, -1, -2)
+            w = np.swapaxes(stack["w"][items], 1, 2)
+            P = Gt @ (w[..., np.newaxis] * G) + identity(G.shape[-1])
+            Bt = np.linalg.solve(np.linalg.cholesky(P), Gt)
+            chunk += np.swapaxes(np.sum(np.abs(np.fft.rfft(h * Bt, axis=-1)) ** 2, axis=2), 1, 2)
+        pgram = pgram + per_model(chunk / length, model, n_models)
+    count = per_model(np.ones(len(stack["model"])), stack["model"], n_models)
+    pgram = np.swapaxes(pgram, 1, 2) / count[:, np.newaxis, np.newaxis]  # (model, latent, frequency)
+
+    f = np.fft.rfftfreq(length)
+    weight = np.full(f.size, 2.0)  # conjugate frequencies
+    weight[0] /= 2
+    if length % 2 == 0:
+        weight[-1] /= 2  # Nyquist
+    weight = weight * count[:, np.newaxis, np.newaxis]
+
+    bounds = np.log((sigma_bound(config), config["omega_bound"]))  # see gp.whittle_fit
+    x = np.stack([np.log(stack["sigma"] ** 2), np.log(stack["omega"])], axis=-1)
+    x = whittle_scoring(x, pgram, weight, f, stack["gp_noise"][:, np.newaxis, np.newaxis], bounds)
+
+    sigmasq, omega = np.exp(x[..., 0]), np.exp(x[..., 1])
+    at_bound = np.isclose(omega, config["omega_bound"][0]) | np.isclose(omega, config["omega_bound"][1])
+    stack["omega"] = np.where(at_bound, stack["omega"], omega)
+    stack["sigma"] = np.where(at_bound & bool(config.get("monotone")), stack["sigma"], np.sqrt(sigmasq))
+
+
+def guarded_hstep(stack, prior, rank, config):
+    """H step of all models, safeguarded by backtracking per model, see core.hstep
+
+    :param prior: prior factors (model, latent, time, rank) of the E step
+    :param rank: rank of the prior factors
+    """
+    window = stack["mu"].shape[1]
+
+    def evaluate(hyperparameters):
+        stack["sigma"], stack["omega"] = hyperparameters
+        return elbo(stack, *prior_factors(*hyperparameters, window, rank), config)
+
+    current = (stack["sigma"], stack["omega"])
+    lower_bound = evaluate(current)
+    hstep(stack, prior if config["method"] == "VB" else None, config)
+    optimized = (stack["sigma"], stack["omega"])
+    accepted = backtrack_hyperparameters(current, optimized, evaluate, lower_bound)
+    evaluate(accepted)
+
+
+def backtrack_hyperparameters(current, optimized, evaluate, lower_bound, max_backtrack=5):
+    """Geometric backtracking of the hyperparameters of every model, see core.backtrack_hyperparameters
+
+    :param current: hyperparameters (model, latent)
+    :param optimized: hyperparameters (model, latent)
+    :param evaluate: lower bound per model of given hyperparameters
+    :param lower_bound: lower bound per model at the current hyperparameters
+    :return: the accepted hyperparameters of every model, the current ones of the models rejecting every step
+    """
+    accepted = tuple(np.copy(x) for x in current)
+    done = np.zeros(len(lower_bound), dtype=bool)
+    step = np.ones((len(lower_bound), 1))
+    for _ in range(max_backtrack):
+        hyperparameters = tuple(x ** (1 - step) * y ** step for x, y in zip(current, optimized))
+        better = ~done & (evaluate(hyperparameters) >= lower_bound)
+        for x, y in zip(accepted, hyperparameters):
+            x[better] = y[better]
+        done |= better
+        if np.all(done):
+            break
+        step[~done] /= 2
+    return accepted
+
+
+def whittle_scoring(x, pgram, weight, f, gp_noise, bounds, niter=50, max_backtrack=30, tol=1e-8):
+    """Minimize the Whittle likelihood of log sigma^2 and log omega by projected Fisher scoring
+
+    :param x: initial log sigma^2 and log omega (..., 2)
+    :param pgram: periodograms (..., frequency)
+    :param weight: weights of frequencies (..., frequency)
+    :param bounds: lower and upper bounds of x, ((lower, upper), (lower, upper))
+    :return: x at the minimum
+    """
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    fsq = np.pi ** 2 * f ** 2
+
+    def objective(x):
+        sigmasq = np.exp(x[..., 0, np.newaxis])
+        omega = np.exp(x[..., 1, np.newaxis])
+        se = sigmasq * np.sqrt(np.pi / omega) * np.exp(-fsq / omega)
+        S = se + gp_noise
+        return np.sum(weight * (np.log(S) + pgram / S), axis=-1), se, S, fsq / omega - 0.5
+
+    x = np.clip(x, lower, upper)
+    pending = np.ones(x.shape[:-1], dtype=bool)
+    for _ in range(niter):
+        ll, se, S, g = objective(x)
+        dS = weight * (1 - pgram / S) * se / S
+        grad = np.stack([dS.sum(axis=-1), np.sum(dS * g, axis=-1)], axis=-1)
+        # expected Hessian, at pgram = S
+        q = weight * (se / S) ** 2
+        fisher = np.stack(
+            [
+                np.stack([q.sum(axis=-1), np.sum(q * g, axis=-1)], axis=-1),
+                np.stack([np.sum(q * g, axis=-1), np.sum(q * g ** 2, axis=-1)], axis=-1),
+            ],
+            axis=-2,
+        )
+        fisher += 1e-10 * identity(2)
+        delta = -np.linalg.solve(fisher, grad[..., np.newaxis])[..., 0]
+
+        step = np.where(pending, 1.0, 0.0)
+        searching = pending.copy()
+        for _ in range(max_backtrack):
+            new_x = np.clip(x + step[..., np.newaxis] * delta, lower, upper)
+            accepted = objective(new_x)[0] <= ll
+            searching &= ~accepted
+            if not np.any(searching):
+                break
+            step[searching] *= 0.5
+        step[searching] = 0
+
+        new_x = np.clip(x + step[..., np.newaxis] * delta, lower, upper)
+        pending &= np.max(np.abs(new_x - x), axis=-1) > tol
+        x = new_x
+        if not np.any(pending):
+            break
+    return x
+
+
+def infer_models(trials_list, params_list, config):
+    """Infer the posterior of whole trials of all models, see core.infer_trials
+
+    The trials of all models of the same (bucket) length are inferred in one stack, under the prior factors of
+    the fit (see prior_factors), which are kept in params["cholesky"].
+    """
+    ydim = max(params["ydim"] for params in params_list)
+    rank = max(params["rank"] for params in params_list)
+    padded_list = []
+    groups = {}
+    for m, (trials, params) in enumerate(zip(trials_list, params_list)):
+        fill_trials(trials)
+        buckets = pad_trials(trials, config["bucket_size"])
+        params["cholesky"] = {}
+        update_w(buckets, params, config)
+        padded_list.append(buckets)
+        for trial in buckets:
+            groups.setdefault(trial["y"].shape[0], []).append((m, trial))
+
+    params_stack = stack_params(params_list, ydim)
+    for length, members in groups.items():
+        models = np.unique([m for m, _ in members])
+        stack = stack_items(members, ydim)
+        stack["model"] = np.searchsorted(models, stack["model"])
+        stack.update({key: params_stack[key][models] for key in MODEL_KEYS})
+        prior, _ = prior_factors(stack["sigma"], stack["omega"], length, rank)
+        for j, m in enumerate(models):
+            # zero columns up to the rank, like the incomplete Cholesky factors
+            params = params_list[m]
+            params["cholesky"][length] = np.zeros((params["zdim"], length, params["rank"]))
+            params["cholesky"][length][..., :prior.shape[-1]] = prior[j]
+        # the posterior variance under the prior before the E step, see core.update_v
+        for items in chunks(stack, config["chunk_size"]):
+            posterior_chunk(stack, items, prior, None, dict(config, method="VB"))
+        estep(stack, prior, None, config)
+        unstack_latents(stack, members)
+
+    for trials, buckets in zip(trials_list, padded_list):
+        unpad_trials(trials, buckets)
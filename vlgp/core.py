@@ -7,34 +7,64 @@ unequal trial ready
 import copy
 import logging
 
-import click
-
 import numpy as np
 from numpy import identity, einsum
-from scipy.linalg import solve, norm, svd, LinAlgError
+from scipy.linalg import (
+    solve,
+    norm,
+    svd,
+    LinAlgError,
+    cho_factor,
+    cho_solve,
+)
 
 from . import gp
 from .base import Model
 from .callback import Saver, show
-from .preprocess import get_config, get_params, fill_trials, fill_params, initialize
-from .util import cut_trials, clip
+from .preprocess import (
+    get_config,
+    get_params,
+    fill_trials,
+    fill_params,
+    initialize,
+    group_by_length,
+    observed_entries,
+    unobserved_entries,
+)
+from .util import (
+    cut_trials,
+    clip,
+    pad_trials,
+    unpad_trials,
+    sparse_prior,
+    check_random_state,
+)
 from .gp import make_cholesky
 from .evaluation import timer
-from .math import trunc_exp
+from .math import trunc_exp, pcg, toeplitz_matvec
 
 logger = logging.getLogger(__name__)
 
+HYPERPARAMETERS = ("sigma", "omega")
+
 
 def estep(trials, params, config):
-    """Update variational distribution q (E step)"""
+    """Update variational distribution q (E step)
+
+    :return: lower bound at the updated q
+    """
     niter = config["Eniter"]  # maximum number of iterations
     if niter < 1:
         return
 
+    if config["estep"] == "joint":
+        return joint_estep(trials, params, config)
+
     # See the explanation in mstep.
     # constrain_loading(trials, params, config)
 
     # dimenionalities
+    ydim = params["ydim"]
     zdim = params["zdim"]
     rank = params["rank"]  # rank of prior covariance
     likelihood = params["likelihood"]
@@ -43,6 +73,10 @@ def estep(trials, params, config):
     dmu_bound = config["dmu_bound"]
     tol = config["tol"]
     method = config["method"]
+    solver = config["solver"]
+    if solver == "cg" and method == "VB":
+        # the posterior variance and the bound are of the low-rank prior, inconsistent with the mean of the exact one
+        raise ValueError("The cg solver only supports MAP")
 
     poiss_mask = likelihood == "poisson"
     gauss_mask = likelihood == "gaussian"
@@ -52,90 +86,297 @@ def estep(trials, params, config):
     b = params["b"]
     noise = params["noise"]
     gauss_noise = noise[gauss_mask]
+    asq = a ** 2
 
     Ir = identity(rank)
     # boolean indexing creates copies
     # pull indexing out of the loop for performance
 
+    # work buffers shared by all trials and iterations
+    # trials of shorter length use the leading rows
+    maxlen = max(trial["y"].shape[0] for trial in trials)
+    eta_buf = np.empty((maxlen, ydim))
+    r_buf = np.empty((maxlen, ydim))
+    vterm_buf = np.empty((maxlen, ydim))
+    residual_buf = np.empty((maxlen, ydim))
+    U_buf = np.empty((maxlen, ydim))
+    step_buf = np.empty((maxlen, ydim))
+
+    # schedule the trials by length
+    # the trials in a bucket share the prior factors and work buffers
+    buckets = group_by_length(trials)
+    if solver == "cg":
+        spectra = gp.make_spectrum(buckets, params)
+
+    # the lower bound is accumulated from the quantities of the last iteration
+    loglik = 0.0
+    kl = 0.0
     for i in range(niter):
+        last = i == niter - 1
         # TODO: parallel trials ?
-        for trial in trials:
-            y = trial["y"]
-            x = trial["x"]
-            mu = trial["mu"]
-            w = trial["w"]
-            v = trial["v"]
-            dmu = trial["dmu"]
+        for length, bucket in buckets.items():
+            prior = params["cholesky"][length]
+            if last:
+                pinv = [np.linalg.pinv(G) for G in prior]
+
+            eta = eta_buf[:length]
+            r = r_buf[:length]
+            vterm = vterm_buf[:length]
+            residual = residual_buf[:length]
+            U = U_buf[:length]
+            step = step_buf[:length]
+
+            for trial in bucket:
+                y = trial["y"]
+                x = trial["x"]
+                mu = trial["mu"]
+                w = trial["w"]
+                v = trial["v"]
+                dmu = trial["dmu"]
+                unobserved = unobserved_entries(trial)
+
+                y_gauss = y[:, gauss_mask]
+
+                xb = einsum("ijk, jk -> ik", x, b)
+                np.matmul(mu, a, out=eta)
+                eta += xb
+                np.matmul(v, asq, out=vterm)
+                vterm *= 0.5
+                np.add(eta, vterm, out=r)
+                trunc_exp(r, out=r)
+                np.copyto(U, r, where=poiss_mask)
+                U[:, gauss_mask] = 1 / gauss_noise
+                if unobserved is not None:
+                    np.copyto(U, 0, where=unobserved)  # no likelihood of missing entries
+
+                for l in range(zdim):
+                    G = prior[l]
+                    # only the weights of the current latent, given the means updated so far
+                    np.matmul(U, asq[l], out=w[:, l])
+
+                    # working residuals
+                    # extensible to many other distributions
+                    # see GLM's working residuals
+                    # masks broadcast over time instead of copying the columns out
+                    np.subtract(y, r, out=residual, where=poiss_mask)
+                    residual[:, gauss_mask] = (
+                        y_gauss - eta[:, gauss_mask]
+                    ) / gauss_noise
+                    if unobserved is not None:
+                        np.copyto(residual, 0, where=unobserved)
+                    try:
+                        if solver == "cg":
+                            delta_mu = (
+                                cg_newton(
+                                    spectra[length][l],
+                                    params["sigma"][l] ** 2,
+                                    w[:, l],
+                                    w[:, l] * mu[:, l] + residual @ a[l, :],
+                                    mu[:, l] + dmu[:, l],  # extrapolate
+                                    config,
+                                )
+                                - mu[:, l]
+                            )
+                        else:
+                            WG = w[:, [l]] * G
+                            GtWG = G.T @ WG
+                            u = G @ (G.T @ (residual @ a[l, :])) - mu[:, l]
+                            WGtu = WG.T @ u
+                            M = solve(Ir + GtWG, WGtu, sym_pos=True)
+                            delta_mu = u - G @ WGtu + G @ (GtWG @ M)
+                        clip(delta_mu, dmu_bound)
+                    except Exception as e:
+                        logger.exception(repr(e), exc_info=True)
+                        delta_mu = 0
+
+                    dmu[:, l] = delta_mu
+                    mu[:, l] += delta_mu
+
+                    # rank-1 update of the linear predictor
+                    # so that the next latent sees the current mean
+                    np.outer(dmu[:, l], a[l], out=step)
+                    eta += step
+                    np.add(eta, vterm, out=r)
+                    trunc_exp(r, out=r)
+                    np.copyto(U, r, where=poiss_mask)
+                    if unobserved is not None:
+                        np.copyto(U, 0, where=unobserved)
+                np.matmul(U, asq.T, out=w)  # every latent's weights given the final means, for the variance
+
+                if method == "VB" or last:
+                    for l in range(zdim):
+                        G = prior[l]
+                        GtWG = G.T @ (w[:, l, np.newaxis] * G)
+                        try:
+                            factor = cho_factor(Ir + GtWG)
+                            M = cho_solve(factor, GtWG)
+                            if method == "VB":
+                                # diag((K^-1 + W)^-1) = diag(G P^-1 G') and P^-1 = I - M
+                                v[:, l] = np.sum(G * (G @ (Ir - M)), axis=1)
+                            if last:
+                                kl += rank_kl(factor, M, pinv[l] @ mu[:, l])
+                        except Exception as e:
+                            logger.exception(repr(e), exc_info=True)
+
+                if last:
+                    # eta is kept current by the rank-1 updates, only the variance has changed
+                    np.matmul(v, asq, out=vterm)
+                    trunc_exp(eta + 0.5 * vterm, out=r)
+                    loglik += expected_loglik(
+                        y,
+                        eta,
+                        r,
+                        vterm,
+                        likelihood,
+                        noise,
+                        None if unobserved is None else ~unobserved,
+                    )
 
-            prior = params["cholesky"][
-                y.shape[0]
-            ]  # TODO: adapt unequal lengths, move into trials
+        # center over all trials if not only infer posterior
+        # constrain_mu(model)
 
-            residual = np.empty_like(y, dtype=float)
-            U = np.empty_like(y, dtype=float)
+        # if norm(dmu) < tol * norm(mu):
+        #     break
 
-            y_poiss = y[:, poiss_mask]
-            y_gauss = y[:, gauss_mask]
+    return loglik - kl
 
-            xb = einsum("ijk, jk -> ik", x, b)
-            eta = mu @ a + xb
-            r = trunc_exp(eta + 0.5 * v @ (a ** 2))
 
-            # mean of y
-            mean_gauss = eta[:, gauss_mask]
-            mean_poiss = r[:, poiss_mask]
+def cg_newton(spectrum, variance, w, c, x0, config):
+    """Newton step of a latent by matrix-free conjugate gradient
 
-            for l in range(zdim):
-                G = prior[l]
+    The new mean x = (K^-1 + W)^-1 c, c = W mu + gradient, is
+    x = K (c - W^1/2 s) where s = W^1/2 x solves (I + W^1/2 K W^1/2) s = W^1/2 K c.
+    The system is symmetric positive definite with eigenvalues >= 1 and only needs products with K.
+    """
+    sqrtw = np.sqrt(w)
+
+    def matvec(s):
+        return s + sqrtw * toeplitz_matvec(spectrum, sqrtw * s)
+
+    precond = 1 / (1 + w * variance)  # Jacobi
+    s, _ = pcg(
+        matvec,
+        sqrtw * toeplitz_matvec(spectrum, c),
+        x0=sqrtw * x0,
+        precond=precond,
+        tol=config["cg_tol"],
+        maxiter=config["cg_maxiter"],
+    )
+    return toeplitz_matvec(spectrum, c - sqrtw * s)
+
+
+def joint_estep(trials, params, config):
+    """Update all latents of a trial jointly (E step)
+
+    The prior of the stacked latents is the sparse block-diagonal factor S = diag(G1, ..., Gq).
+    A Newton step solves (K^-1 + H) mu = H mu + g through the rank space, mu = S (I + S'HS)^-1 S'(H mu + g),
+    where the likelihood Hessian H couples the latents at the same time bin.
+    The rank-space system is solved by preconditioned conjugate gradient with sparse products only.
+    The posterior variance is of every latent given the others as in estep, see update_v.
+    """
+    from scipy import sparse
+    niter = config["Eniter"]
+
+    zdim = params["zdim"]
+    rank = params["rank"]
+    likelihood = params["likelihood"]
+
+    dmu_bound = config["dmu_bound"]
+    tol = config["tol"]
+    method = config["method"]
+
+    poiss_mask = likelihood == "poisson"
+    gauss_mask = likelihood == "gaussian"
+
+    a = params["a"]
+    b = params["b"]
+    noise = params["noise"]
+    gauss_noise = noise[gauss_mask]
+    asq = a ** 2
+
+    buckets = group_by_length(trials)
+    priors = dict(
+        zip(
+            buckets,
+            sparse_prior(params["sigma"], params["omega"], list(buckets), rank),
+        )
+    )
+    solutions = {}  # warm starts of conjugate gradient
+    cg_iterations = 0
+
+    for i in range(niter):
+        converged = True
+        for length, bucket in buckets.items():
+            S = priors[length]  # (zdim * length, zdim * rank)
+            Ssq = S.multiply(S).T.tocsr()
+            for j, trial in enumerate(bucket):
+                y = trial["y"]
+                x = trial["x"]
+                mu = trial["mu"]
+                v = trial["v"]
+                dmu = trial["dmu"]
+                unobserved = unobserved_entries(trial)
+
+                eta = mu @ a + einsum("ijk, jk -> ik", x, b)
+                r = trunc_exp(eta + 0.5 * v @ asq)
+
+                # working residuals and weights
+                residual = np.empty_like(r)
+                residual[:, poiss_mask] = y[:, poiss_mask] - r[:, poiss_mask]
+                residual[:, gauss_mask] = (y[:, gauss_mask] - eta[:, gauss_mask]) / gauss_noise
+                U = np.empty_like(r)
+                U[:, poiss_mask] = r[:, poiss_mask]
+                U[:, gauss_mask] = 1 / gauss_noise
+                if unobserved is not None:
+                    np.copyto(residual, 0, where=unobserved)
+                    np.copyto(U, 0, where=unobserved)
+
+                # latent-major stacking, z = [mu[:, 0]; mu[:, 1]; ...]
+                C = einsum("tn, kn, ln -> klt", U, a, a)
+                H = sparse.bmat(
+                    [[sparse.diags(C[k, l]) for l in range(zdim)] for k in range(zdim)],
+                    format="csr",
+                )
+                z = mu.T.ravel()
+                g = (residual @ a.T).T.ravel()
 
-                # working residuals
-                # extensible to many other distributions
-                # see GLM's working residuals
-                residual[:, poiss_mask] = y_poiss - mean_poiss
-                residual[:, gauss_mask] = (y_gauss - mean_gauss) / gauss_noise
-                wadj = w[:, [l]]  # keep dimension
-                GtWG = G.T @ (wadj * G)
+                def matvec(x):
+                    return x + S.T @ (H @ (S @ x))
 
-                u = G @ (G.T @ (residual @ a[l, :])) - mu[:, l]
+                precond = 1 / (1 + Ssq @ H.diagonal())  # Jacobi
                 try:
-                    M = solve(Ir + GtWG, (wadj * G).T @ u, sym_pos=True)
-                    delta_mu = u - G @ ((wadj * G).T @ u) + G @ (GtWG @ M)
+                    x, iterations = pcg(
+                        matvec,
+                        S.T @ (H @ z + g),
+                        x0=solutions.get((length, j)),
+                        precond=precond,
+                        tol=config["cg_tol"],
+                        maxiter=config["cg_maxiter"],
+                    )
+                    cg_iterations += iterations
+                    delta_mu = (S @ x - z).reshape(zdim, length).T
                     clip(delta_mu, dmu_bound)
                 except Exception as e:
                     logger.exception(repr(e), exc_info=True)
-                    delta_mu = 0
+                    continue
+                solutions[length, j] = x
 
-                dmu[:, l] = delta_mu
-                mu[:, l] += delta_mu
+                dmu[:] = delta_mu
+                mu += delta_mu
+                if norm(delta_mu) > tol * norm(mu):
+                    converged = False
 
-            # TODO: remove duplicated computation
-            eta = mu @ a + xb
-            r = trunc_exp(eta + 0.5 * v @ (a ** 2))
-            U[:, poiss_mask] = r[:, poiss_mask]
-            U[:, gauss_mask] = 1 / gauss_noise
-            w = U @ (a.T ** 2)
             if method == "VB":
-                for l in range(zdim):
-                    G = prior[l]
-                    GtWG = G.T @ (w[:, l, np.newaxis] * G)
-                    try:
-                        M = solve(Ir + GtWG, GtWG, sym_pos=True)
-                        v[:, l] = np.sum(G * (G - G @ GtWG + G @ (GtWG @ M)), axis=1)
-                    except Exception as e:
-                        logger.exception(repr(e), exc_info=True)
+                update_w(bucket, params, config)
+                update_v(bucket, params, config)
 
-            # make sure save all changes
-            # TODO: make inline modification
-            trial["mu"] = mu
-            trial["w"] = w
-            trial["v"] = v
-            trial["dmu"] = dmu
+        if converged:
+            break
 
-        # center over all trials if not only infer posterior
-        # constrain_mu(model)
+    logger.debug("Joint E step: %d passes, %d conjugate gradient iterations", i + 1, cg_iterations)
 
-        # if norm(dmu) < tol * norm(mu):
-        #     break
+    # keep the weights of the last update for the H step
+    update_w(trials, params, config)
 
 
 def mstep(trials, params, config):
@@ -175,18 +416,26 @@ def mstep(trials, params, config):
     method = config["method"]
     learning_rate = config["learning_rate"]
 
-    y = np.concatenate([trial["y"] for trial in trials], axis=0)
-    x = np.concatenate(
-        [trial["x"] for trial in trials], axis=0
-    )  # TODO: check dimensionality of x
-    mu = np.concatenate([trial["mu"] for trial in trials], axis=0)
-    v = np.concatenate([trial["v"] for trial in trials], axis=0)
+    if config["line_search"]:
+        # the data are never concatenated more than a chunk at a time
+        optimize_loading(params, config, stream_statistics(trials, config["chunk_size"]))
+        return
+
+    y, x, mu, v, obs = concatenate_trials(trials)
+    if obs is not None:
+        nobs = np.maximum(obs.sum(axis=0), 1)
 
     for i in range(niter):
         eta = mu @ a + einsum("ijk, jk -> ik", x, b)
         # (time, regression, neuron) x (regression, neuron) -> (time, neuron)  # TODO: use matmul broadcast
         r = trunc_exp(eta + 0.5 * v @ (a ** 2))
-        noise = np.var(y - eta, axis=0, ddof=0)  # MLE
+        if obs is None:
+            noise = np.var(y - eta, axis=0, ddof=0)  # MLE
+        else:
+            r *= obs
+            residual = obs * (y - eta)
+            residual -= obs * residual.sum(axis=0) / nobs
+            noise = np.sum(residual ** 2, axis=0) / nobs
 
         for n in range(ydim):
             if likelihood[n] == "poisson":
@@ -231,15 +480,21 @@ def mstep(trials, params, config):
             elif likelihood[n] == "gaussian":
                 # a's least squares solution for Gaussian channel
                 # (m'm + diag(j'v))^-1 m'(y - Hb)
-                M = mu.T @ mu
-                M[np.diag_indices_from(M)] += np.sum(v, axis=0)
-                a[:, n] = solve(M, mu.T @ (y[:, n] - x[..., n] @ b[:, n]), sym_pos=True)
+                # weighted by the observed entries if any missing
+                on = 1 if obs is None else obs[:, [n]]
+                M = mu.T @ (on * mu)
+                M[np.diag_indices_from(M)] += np.sum(on * v, axis=0)
+                a[:, n] = solve(
+                    M,
+                    (on * mu).T @ (y[:, n] - x[..., n] @ b[:, n]),
+                    sym_pos=True,
+                )
 
                 # b's least squares solution for Gaussian channel
                 # (H'H)^-1 H'(y - ma)
                 b[:, n] = solve(
-                    x[..., n].T @ x[..., n],
-                    x[..., n].T @ (y[:, n] - mu @ a[:, n]),
+                    x[..., n].T @ (on * x[..., n]),
+                    (on * x[..., n]).T @ (y[:, n] - mu @ a[:, n]),
                     sym_pos=True,
                 )
                 b[1:, n] = 0
@@ -259,18 +514,404 @@ def mstep(trials, params, config):
         #     break
 
 
+def concatenate_trials(trials):
+    """Concatenate the data and latents of trials into a chunk, see chunk_statistics"""
+    y = np.concatenate([np.asarray(trial["y"]) for trial in trials], axis=0)
+    x = np.concatenate(
+        [np.asarray(trial["x"]) for trial in trials], axis=0
+    )  # TODO: check dimensionality of x
+    mu = np.concatenate([trial["mu"] for trial in trials], axis=0)
+    v = np.concatenate([trial["v"] for trial in trials], axis=0)
+
+    # missing entries contribute zero likelihood
+    # weigh the entries by 1 (observed) or 0 (missing)
+    obs = None
+    if any(trial.get("mask") is not None for trial in trials):
+        obs = np.concatenate([observed_entries(trial) for trial in trials], axis=0)
+        y = np.where(obs, y, 0)
+        obs = obs.astype(float)
+
+    return y, x, mu, v, obs
+
+
+def trial_chunks(trials, size):
+    """Concatenate consecutive trials into chunks of at least size time bins, see concatenate_trials"""
+    batch = []
+    total = 0
+    for trial in trials:
+        batch.append(trial)
+        total += trial["y"].shape[0]
+        if total >= size:
+            yield concatenate_trials(batch)
+            batch = []
+            total = 0
+    if batch:
+        yield concatenate_trials(batch)
+
+
+def stream_statistics(trials, size):
+    """Reduction of optimize_loading that sums the statistics over chunks of trials
+
+    Only one chunk is in memory at a time. The trials are read again on every call,
+    hence their data can be lazy (e.g. memory-mapped).
+    """
+
+    def reduce(*args):
+        total = None
+        for chunk in trial_chunks(trials, size):
+            stats = chunk_statistics(chunk, *args)
+            total = stats if total is None else tuple(t + s for t, s in zip(total, stats))
+        return total
+
+    return reduce
+
+
+def optimize_loading(params, config, reduce):
+    """M step by the statistics of the data
+
+    The Poisson neurons take Newton steps with backtracking line search and leave the active set once converged.
+    The Gaussian neurons alternate between the least squares of a and b.
+    da and db are the changes of a and b by the whole M step, which the convergence check of vem takes.
+
+    :param reduce: function of the name and arguments of statistics that returns their sums over all trials,
+        see chunk_statistics
+    """
+    niter = config["Mniter"]
+    grad_tol = config["grad_tol"]
+
+    likelihood = params["likelihood"]
+    a = params["a"]
+    b = params["b"]
+    da = params["da"]
+    db = params["db"]
+
+    poiss_idx = np.flatnonzero(likelihood == "poisson")
+    gauss_idx = np.flatnonzero(likelihood == "gaussian")
+    active = np.ones(poiss_idx.size, dtype=bool)
+    a0 = np.copy(a)
+    b0 = np.copy(b)
+
+    count, mm, my, mx, xx, xy = reduce("moments", gauss_idx)
+    count = np.maximum(count, 1)
+
+    for i in range(niter):
+        s1, s2 = reduce("residual", a, b)
+        noise = (s2 - s1 ** 2 / count) / count  # MLE
+
+        if np.any(active):
+            idx = poiss_idx[active]
+            converged = newton_poisson(reduce, a, b, idx, da, db, grad_tol * count[idx])
+            active[active] = ~converged
+
+        for j, n in enumerate(gauss_idx):
+            # a's least squares solution for Gaussian channel
+            # (m'm + diag(j'v))^-1 m'(y - Hb)
+            a[:, n] = solve(mm[j], my[j] - mx[j] @ b[:, n], sym_pos=True)
+
+            # b's least squares solution for Gaussian channel
+            # (H'H)^-1 H'(y - ma)
+            b[:, n] = solve(xx[j], xy[j] - mx[j].T @ a[:, n], sym_pos=True)
+            b[1:, n] = 0
+
+        params["a"] = a
+        params["b"] = b
+        params["noise"] = noise
+
+        # the least squares of Gaussian neurons alternate between a and b
+        if not np.any(active) and gauss_idx.size == 0:
+            break
+
+    # the last Newton step of a converged neuron is zero
+    params["da"] = a - a0
+    params["db"] = b - b0
+
+
+def chunk_statistics(chunk, name, *args):
+    """Statistics of the M step summed over a chunk of time bins
+
+    The statistics are additive over chunks, so that they can be reduced over trials, chunks or processes.
+
+    moments (gaussian neurons): number of observed entries per neuron and the fixed moments of Gaussian neurons
+    residual (a, b): sum and sum of squares of the residual per neuron
+    poisson (neurons, a, b): objective, gradient and Hessian of Poisson neurons, see poisson_stats
+    objective (neurons, a, b): objective of Poisson neurons, see poisson_objective
+
+    :param chunk: y (zero where missing), x, mu, v and observed entries as weights (None if all observed)
+    :param name: name of statistics
+    :return: tuple of statistics
+    """
+    y, x, mu, v, obs = chunk
+
+    if name == "moments":
+        (idx,) = args
+        count = np.full(y.shape[1], float(y.shape[0])) if obs is None else obs.sum(axis=0)
+        return (count,) + gaussian_moments(
+            y[:, idx], x[..., idx], mu, v, None if obs is None else obs[:, idx]
+        )
+    elif name == "residual":
+        a, b = args
+        residual = y - mu @ a - einsum("ijk, jk -> ik", x, b)
+        if obs is not None:
+            residual *= obs
+        return np.sum(residual, axis=0), np.sum(residual ** 2, axis=0)
+    elif name in ("poisson", "objective"):
+        idx, a, b = args
+        data = (y[:, idx], x[..., idx], mu, v, a, b, None if obs is None else obs[:, idx])
+        if name == "poisson":
+            return poisson_stats(*data)
+        return (poisson_objective(*data),)
+    else:
+        raise ValueError("unknown statistics {}".format(name))
+
+
+def gaussian_moments(y, x, mu, v, obs=None):
+    """Moments of the least squares of Gaussian neurons weighted by the observed entries
+
+    :return: mu'mu + diag(sum v), mu'y, mu'x, x'x and x'y per neuron
+    """
+    on = np.ones_like(y) if obs is None else obs
+    mm = einsum("ij, ik, in -> njk", mu, mu, on)
+    diag = np.arange(mu.shape[1])
+    mm[:, diag, diag] += (v.T @ on).T
+    my = (mu.T @ (on * y)).T
+    mx = einsum("ij, ikn, in -> njk", mu, x, on)
+    xx = einsum("ijn, ikn, in -> njk", x, x, on)
+    xy = einsum("ijn, in -> nj", x, on * y)
+    return mm, my, mx, xx, xy
+
+
+def poisson_objective(y, x, mu, v, a, b, obs=None):
+    """Negative expected log-likelihood of Poisson neurons up to constants, summed over time
+
+    :param y: spike counts (time, neuron), zero where missing
+    :param obs: weights of entries (time, neuron), 1 observed and 0 missing
+    :return: (neuron,)
+    """
+    eta = mu @ a + einsum("ijk, jk -> ik", x, b)
+    r = trunc_exp(eta + 0.5 * v @ (a ** 2))
+    if obs is not None:
+        r *= obs
+    return np.sum(r - y * eta, axis=0)
+
+
+def poisson_stats(y, x, mu, v, a, b, obs=None):
+    """Negative expected log-likelihood of Poisson neurons with its gradient and Hessian
+
+    The derivatives are taken jointly in theta = (a_n, b_n) of every neuron.
+    All are sums over time so that the statistics of trials add up.
+
+    :return: objective (neuron,), gradient (neuron, zdim + xdim), Hessian (neuron, zdim + xdim, zdim + xdim)
+    """
+    zdim = mu.shape[1]
+
+    eta = mu @ a + einsum("ijk, jk -> ik", x, b)
+    r = trunc_exp(eta + 0.5 * v @ (a ** 2))
+    if obs is not None:
+        r *= obs
+    f = np.sum(r - y * eta, axis=0)
+
+    # d eta / d theta, (time, zdim + xdim, neuron)
+    phi = np.concatenate([mu[..., np.newaxis] + v[..., np.newaxis] * a, x], axis=1)
+    grad = einsum("ijk, ik -> kj", phi, r)
+    grad[:, :zdim] -= (mu.T @ y).T
+    grad[:, zdim:] -= einsum("ijk, ik -> kj", x, y)
+
+    hess = einsum("ijk, ilk, ik -> kjl", phi, phi, r, optimize=True)
+    diag = np.arange(zdim)
+    hess[:, diag, diag] += (v.T @ r).T
+
+    return f, grad, hess
+
+
+def newton_poisson(reduce, a, b, idx, da, db, gtol, max_backtrack=30):
+    """Newton step with backtracking line search of Poisson neurons
+
+    The neurons idx of a and b, and their steps in da and db are updated in place.
+
+    :param reduce: see optimize_loading
+    :param gtol: gradient norm under which a neuron has converged (neuron,)
+    :return: boolean array of converged neurons
+    """
+    zdim = a.shape[0]
+    a_idx = a[:, idx]
+    b_idx = b[:, idx]
+
+    f, grad, hess = reduce("poisson", idx, a_idx, b_idx)
+    converged = norm(grad, axis=1) < gtol
+
+    try:
+        delta = -np.linalg.solve(hess, grad[..., np.newaxis])[..., 0]
+    except LinAlgError:
+        delta = np.empty_like(grad)
+        for n in range(len(idx)):
+            try:
+                delta[n] = -solve(hess[n], grad[n], sym_pos=True)
+            except Exception as e:
+                logger.exception(repr(e), exc_info=True)
+                delta[n] = -grad[n]  # steepest descent
+
+    slope = np.sum(grad * delta, axis=1)
+    ascent = ~(slope < 0)
+    delta[ascent] = -grad[ascent]
+    slope[ascent] = -np.sum(grad[ascent] ** 2, axis=1)
+    delta[converged] = 0
+
+    # Armijo condition
+    step = np.ones(len(idx))
+    pending = ~converged
+    for _ in range(max_backtrack):
+        if not np.any(pending):
+            break
+        trial_a = a_idx[:, pending] + step[pending] * delta[pending, :zdim].T
+        trial_b = b_idx[:, pending] + step[pending] * delta[pending, zdim:].T
+        (f_new,) = reduce("objective", idx[pending], trial_a, trial_b)
+        accepted = f_new <= f[pending] + 1e-4 * step[pending] * slope[pending]
+        pending[np.flatnonzero(pending)[accepted]] = False
+        step[pending] *= 0.5
+    step[pending] = 0  # no decrease found
+
+    delta *= step[:, np.newaxis]
+    da[:, idx] = delta[:, :zdim].T
+    db[:, idx] = delta[:, zdim:].T
+    a[:, idx] += da[:, idx]
+    b[:, idx] += db[:, idx]
+
+    return converged
+
+
 def hstep(trials, params, config):
-    """Wrapper of hyperparameters tuning"""
+    """Wrapper of hyperparameters tuning, safeguarded by backtrack_hyperparameters under config["monotone"]"""
     if not config["Hstep"]:
         return
 
+    if not config["monotone"]:
+        gp.optimize(trials, params, config)
+        return
+
+    def evaluate(hyperparameters):
+        params.update({k: np.copy(value) for k, value in hyperparameters.items()})
+        make_cholesky(trials, params, config)
+        update_v(trials, params, config)
+        return elbo(trials, params, config)
+
+    current = {k: np.copy(params[k]) for k in HYPERPARAMETERS}
+    lower_bound = evaluate(current)
     gp.optimize(trials, params, config)
+    optimized = {k: np.copy(params[k]) for k in HYPERPARAMETERS}
+    if backtrack_hyperparameters(current, optimized, evaluate, lower_bound) is None:
+        evaluate(current)
+
+
+def backtrack_hyperparameters(current, optimized, evaluate, lower_bound, max_backtrack=5):
+    """Backtrack the optimized hyperparameters toward the current ones in log space
+
+    The H step optimizes a different objective (e.g. Whittle likelihood) from the lower bound, so its hyperparameters
+    are accepted only if the lower bound, with the posterior variance of the new prior, does not decrease.
+
+    :param evaluate: function of hyperparameters, that sets them and returns the lower bound
+    :param lower_bound: lower bound at the current hyperparameters
+    :return: accepted hyperparameters, None if none
+    """
+    step = 1.0
+    for _ in range(max_backtrack):
+        hyperparameters = {k: current[k] ** (1 - step) * optimized[k] ** step for k in current}
+        if evaluate(hyperparameters) >= lower_bound:
+            return hyperparameters
+        step /= 2
+    return None
 
 
 def infer(trials, params, config):
     estep(trials, params, config)
 
 
+def infer_trials(trials, params, config, run_estep=True):
+    """Infer the posterior of whole trials given the parameters and hyperparameters
+
+    The trials are padded into length buckets (see config["bucket_size"]).
+    A prior factor is made per bucket instead of per distinct length.
+    """
+    fill_trials(trials)
+    buckets = pad_trials(trials, config["bucket_size"])
+    make_cholesky(buckets, params, config)
+    update_w(buckets, params, config)
+    update_v(buckets, params, config)
+    if run_estep:
+        infer(buckets, params, config)
+    unpad_trials(trials, buckets)
+
+
+def sample_posterior(trials, params, n_samples, path=None, batch_size=100, random_state=None):
+    """Draw samples of the latents from the variational posterior
+
+    By the Woodbury identity on the low-rank prior GG', q(z) of a latent is N(mu, G P^-1 G') with P = I + G'WG.
+    A sample is z = mu + G L^-T e, e ~ N(0, I), where LL' = P, so no time-by-time covariance is formed.
+    Trials of the same length are sampled in batch.
+
+    :param trials: list of inferred trials
+    :param params: parameters
+    :param n_samples: number of samples per trial
+    :param path: HDF5 file to which the samples are streamed, one dataset "trial_<i>" per trial
+    :param batch_size: number of samples drawn at once when streaming
+    :param random_state: seed
+    :return: list of samples (n_samples, time, zdim) per trial, None if streamed to path
+    """
+    random_state = check_random_state(random_state)
+
+    zdim = params["zdim"]
+    rank = params["rank"]
+    sigma = params["sigma"]
+    omega = params["omega"]
+
+    buckets = {}
+    for i, trial in enumerate(trials):
+        buckets.setdefault(trial["mu"].shape[0], []).append(i)
+
+    if path is None:
+        fout = None
+        samples = [np.empty((n_samples,) + trial["mu"].shape) for trial in trials]
+        batch_size = n_samples
+    else:
+        import h5py
+
+        fout = h5py.File(path, "w")
+        samples = [
+            fout.create_dataset(
+                "trial_{}".format(i),
+                shape=(n_samples,) + trial["mu"].shape,
+                dtype=float,
+                chunks=(min(batch_size, n_samples),) + trial["mu"].shape,
+            )
+            for i, trial in enumerate(trials)
+        ]
+
+    try:
+        for length, indices in buckets.items():
+            prior = params["cholesky"].get(length)
+            if prior is None:
+                prior = np.array(
+                    [gp.ichol_factor(length, omega[l], rank) * sigma[l] for l in range(zdim)]
+                )
+
+            # factors of P, (trial, latent, rank, rank)
+            w = np.stack([trials[i]["w"] for i in indices])
+            P = einsum("ijk, lji, ijm -> likm", prior, w, prior, optimize=True)
+            P += identity(rank)
+            Lt = np.swapaxes(np.linalg.cholesky(P), -1, -2)
+
+            for start in range(0, n_samples, batch_size):
+                stop = min(start + batch_size, n_samples)
+                e = random_state.standard_normal((len(indices), zdim, rank, stop - start))
+                z = einsum("ijk, likm -> lmji", prior, np.linalg.solve(Lt, e))
+                for j, i in enumerate(indices):
+                    samples[i][start:stop] = trials[i]["mu"] + z[j]
+    finally:
+        if fout is not None:
+            fout.close()
+
+    return samples if fout is None else None
+
+
 def vem(trials, params, config):
     """Variational EM
     This function implements the algorithm.
@@ -279,12 +920,21 @@ def vem(trials, params, config):
     # the caller determines which to use
     # pass segments to speed up estimation and hyperparameter tuning
     # the caller gets runtime
+    import click
 
     callbacks = config["callbacks"]
 
     tol = config["tol"]
     niter = config["max_iter"]
 
+    # the constraints apply to the whole trials underneath segments
+    # otherwise the overlapping bins of segments would be changed repeatedly
+    whole_trials = getattr(trials, "trials", trials)
+
+    # SQUAREM extrapolates every third pass from the states before the two passes ahead of it
+    squarem = config["accelerate"] == "squarem"
+    history = []
+
     # profile and debug purpose
     # invalid every new run
     runtime = {
@@ -293,7 +943,14 @@ def vem(trials, params, config):
         "m_elapsed": [],
         "h_elapsed": [],
         "em_elapsed": [],
+        "elbo": [],
+        "dmu": [],  # relative changes
+        "da": [],
+        "db": [],
+        "cancelled": False,
+        "converged": False,  # whether stopped by the convergence check rather than max_iter
     }
+    config["runtime"] = runtime
 
     #######################
     # iterative algorithm #
@@ -302,6 +959,9 @@ def vem(trials, params, config):
     # disable gabbage collection during the iterative procedure
     for it in range(niter):
         runtime["it"] += 1
+        if it > 0 and config["resample_segments"] and hasattr(trials, "redraw"):
+            trials.redraw()
+            make_cholesky(trials, params, config)
         mu = np.concatenate([trial["mu"] for trial in trials], axis=0)
         a = params["a"]
         b = params["b"]
@@ -309,39 +969,52 @@ def vem(trials, params, config):
         norm_a = norm(a)
         norm_b = norm(b)
 
+        extrapolated = None
+        if squarem:
+            history.append(pack_state(whole_trials, params))
+            if len(history) == 3:
+                extrapolated = squarem_extrapolate(*history)
+                history = []
+
         with timer() as em_elapsed:
-            ##########
-            # E step #
-            ##########
-            with timer() as estep_elapsed:
-                constrain_loading(trials, params, config)
-                estep(trials, params, config)
-
-            ##########
-            # M step #
-            ##########
-            with timer() as mstep_elapsed:
-                constrain_latent(trials, params, config)
-                mstep(trials, params, config)
-
-            ###################
-            # H step #
-            ###################
-            with timer() as hstep_elapsed:
-                hstep(trials, params, config)
+            if extrapolated is not None:
+                fallback = snapshot_state(whole_trials, params)
+                elbo_fallback = elbo(trials, params, config)
+                unpack_state(extrapolated, whole_trials, params, config)
+                make_cholesky(trials, params, config)
+                _, elapsed = vem_step(trials, params, config)
+                # the bound of the accepted state, the one after the E step from the extrapolated state may be lower
+                lower_bound = elbo(trials, params, config)
+                if lower_bound < elbo_fallback:
+                    # the extrapolation overshot, take the plain step from the state before it instead
+                    logger.info("SQUAREM step rejected")
+                    restore_state(fallback, whole_trials, params)
+                    make_cholesky(trials, params, config)
+                    lower_bound, elapsed = vem_step(trials, params, config)
+            else:
+                lower_bound, elapsed = vem_step(trials, params, config)
 
+        estep_elapsed, mstep_elapsed, hstep_elapsed = elapsed
         runtime["e_elapsed"].append(estep_elapsed())
         runtime["m_elapsed"].append(mstep_elapsed())
         runtime["h_elapsed"].append(hstep_elapsed())
         runtime["em_elapsed"].append(em_elapsed())
+        if lower_bound is None:
+            lower_bound = elbo(trials, params, config)
+        runtime["elbo"].append(lower_bound)
 
-        config["runtime"] = runtime
-
-        click.echo(
-            "Iteration {:4d}, E-step {:.2f}s, M-step {:.2f}s".format(
-                runtime["it"], runtime["e_elapsed"][-1], runtime["m_elapsed"][-1]
+        dmu = np.concatenate([trial["dmu"] for trial in trials], axis=0)
+        eps = config["eps"]
+        runtime["dmu"].append(norm(dmu) / (norm_mu + eps))
+        runtime["da"].append(norm(params["da"]) / (norm_a + eps))
+        runtime["db"].append(norm(params["db"]) / (norm_b + eps))
+
+        if config["verbose"]:
+            click.echo(
+                "Iteration {:4d}, E-step {:.2f}s, M-step {:.2f}s".format(
+                    runtime["it"], runtime["e_elapsed"][-1], runtime["m_elapsed"][-1]
+                )
             )
-        )
 
         for callback in callbacks:
             try:
@@ -349,20 +1022,29 @@ def vem(trials, params, config):
             except:
                 logger.error("Callback {} failed".format(callback))
 
+        # cooperative cancellation at the end of a whole iteration
+        cancel = config["cancel"]
+        if cancel is not None and cancel.is_set():
+            runtime["cancelled"] = True
+            break
+
         #####################
         # convergence check #
         #####################
-        dmu = np.concatenate([trial["dmu"] for trial in trials], axis=0)
-        da = params["da"]
-        db = params["db"]
+        converged = runtime["dmu"][-1] < tol and \
+                    runtime["da"][-1] < tol and \
+                    runtime["db"][-1] < tol
 
-        converged = norm(dmu) < tol * norm_mu and \
-                    norm(da) < tol * norm_a and \
-                    norm(db) < tol * norm_b
+        # the bound is taken after the E-step, so it is not comparable across redrawn segments
+        elbo_tol = config["elbo_tol"]
+        if elbo_tol is not None and len(runtime["elbo"]) > 1 and not config["resample_segments"]:
+            previous, current = runtime["elbo"][-2:]
+            converged = converged or abs(current - previous) < elbo_tol * abs(previous)
 
         should_stop = converged and it + 1 >= config["min_iter"]
 
         if should_stop:
+            runtime["converged"] = True
             break
 
     ##############################
@@ -370,6 +1052,178 @@ def vem(trials, params, config):
     ##############################
 
 
+def vem_step(trials, params, config):
+    """One pass of E, M and H steps
+
+    :return: lower bound after the E step, and timers of the steps
+    """
+    # the constraints apply to the whole trials underneath segments
+    whole_trials = getattr(trials, "trials", trials)
+
+    ##########
+    # E step #
+    ##########
+    with timer() as estep_elapsed:
+        constrain_loading(whole_trials, params, config)
+        lower_bound = estep(trials, params, config)
+
+    ##########
+    # M step #
+    ##########
+    with timer() as mstep_elapsed:
+        constrain_latent(whole_trials, params, config)
+        mstep(trials, params, config)
+
+    ##########
+    # H step #
+    ##########
+    with timer() as hstep_elapsed:
+        hstep(trials, params, config)
+
+    return lower_bound, (estep_elapsed, mstep_elapsed, hstep_elapsed)
+
+
+def pack_state(trials, params):
+    """Stack the loading, regression, log hyperparameters and latent means into a vector"""
+    return np.concatenate(
+        [params["a"].ravel(), params["b"].ravel()]
+        + [np.log(params[k]).ravel() for k in HYPERPARAMETERS]
+        + [trial["mu"].ravel() for trial in trials]
+    )
+
+
+def unpack_state(theta, trials, params, config):
+    """Write a stacked vector back to the loading, regression, hyperparameters and latent means in place
+
+    The hyperparameters are clipped to the bounds of the H step (see gp.sigma_bound and config["omega_bound"]).
+    """
+    start = 0
+    for array in [params["a"], params["b"]] + [params[k] for k in HYPERPARAMETERS] + [trial["mu"] for trial in trials]:
+        stop = start + array.size
+        array[...] = theta[start:stop].reshape(array.shape)
+        start = stop
+    for k in HYPERPARAMETERS:
+        np.exp(params[k], out=params[k])
+    np.clip(params["sigma"], *np.sqrt(gp.sigma_bound(config)), out=params["sigma"])
+    np.clip(params["omega"], *config["omega_bound"], out=params["omega"])
+
+
+def snapshot_state(trials, params):
+    """Copy of everything a vEM pass changes"""
+    return {
+        "params": {
+            k: np.copy(params[k]) for k in ("a", "b", "noise", "sigma", "omega")
+        },
+        "trials": [
+            {k: np.copy(trial[k]) for k in ("mu", "v", "w")} for trial in trials
+        ],
+    }
+
+
+def restore_state(snapshot, trials, params):
+    params.update(snapshot["params"])
+    for trial, saved in zip(trials, snapshot["trials"]):
+        for k, value in saved.items():
+            trial[k][...] = value  # in place for the segments viewing the trial
+
+
+def squarem_extrapolate(theta0, theta1, theta2):
+    """SQUAREM (SqS3) extrapolation from three successive states of a fixed-point iteration
+
+    Varadhan and Roland, Scandinavian Journal of Statistics, 2008
+    """
+    r = theta1 - theta0
+    v = theta2 - theta1 - r
+    norm_v = norm(v)
+    if norm_v == 0:
+        return theta2
+    alpha = min(-norm(r) / norm_v, -1)  # alpha = -1 gives theta2
+    return theta0 - 2 * alpha * r + alpha ** 2 * v
+
+
+def elbo(trials, params, config):
+    """Evidence lower bound
+
+    The KL divergence of each latent is taken in the rank space of its prior factor,
+    z = Gc, c ~ N(0, I), where the posterior is q(c) = N(m, (I + G'WG)^-1) and Gm = mu.
+    """
+    zdim = params["zdim"]
+    rank = params["rank"]
+    likelihood = params["likelihood"]
+
+    a = params["a"]
+    b = params["b"]
+    noise = params["noise"]
+    asq = a ** 2
+
+    Ir = identity(rank)
+    lower_bound = 0.0
+    for length, bucket in group_by_length(trials).items():
+        prior = params["cholesky"][length]
+        pinv = [np.linalg.pinv(G) for G in prior]
+        for trial in bucket:
+            mu = trial["mu"]
+            w = trial["w"]
+
+            eta = mu @ a + einsum("ijk, jk -> ik", trial["x"], b)
+            vterm = trial["v"] @ asq
+            r = trunc_exp(eta + 0.5 * vterm)
+            lower_bound += expected_loglik(
+                trial["y"], eta, r, vterm, likelihood, noise, observed_entries(trial)
+            )
+
+            for l in range(zdim):
+                G = prior[l]
+                GtWG = G.T @ (w[:, [l]] * G)
+                try:
+                    factor = cho_factor(Ir + GtWG)
+                except LinAlgError:
+                    return -np.inf
+                lower_bound -= rank_kl(
+                    factor, cho_solve(factor, GtWG), pinv[l] @ mu[:, l]
+                )
+
+    return lower_bound
+
+
+def expected_loglik(y, eta, r, vterm, likelihood, noise, observed=None):
+    """Expected log-likelihood summed over the observed entries
+
+    :param eta: mean of the linear predictor
+    :param r: expected firing rate, E exp(eta)
+    :param vterm: variance of the linear predictor
+    """
+    from scipy.special import gammaln
+
+    poiss_mask = likelihood == "poisson"
+    gauss_mask = likelihood == "gaussian"
+
+    if observed is not None:
+        y = np.where(observed, y, 0)
+    lik = np.empty_like(eta)
+    lik[:, poiss_mask] = (
+        y[:, poiss_mask] * eta[:, poiss_mask]
+        - r[:, poiss_mask]
+        - gammaln(y[:, poiss_mask] + 1)
+    )
+    lik[:, gauss_mask] = -0.5 * (
+        np.log(2 * np.pi * noise[gauss_mask])
+        + ((y[:, gauss_mask] - eta[:, gauss_mask]) ** 2 + vterm[:, gauss_mask])
+        / noise[gauss_mask]
+    )
+    return np.sum(lik, where=True if observed is None else observed)
+
+
+def rank_kl(factor, M, m):
+    """KL divergence of a latent in the rank space of its prior factor
+
+    :param factor: Cholesky factor of P = I + G'WG
+    :param M: P^-1 G'WG, so that tr(P^-1) = rank - tr(M)
+    :param m: mean in the rank space, Gm = mu
+    """
+    return 0.5 * (m @ m - np.trace(M) + 2 * np.sum(np.log(np.diag(factor[0]))))
+
+
 def constrain_latent(trials, params, config):
     """Center and scale latent mean"""
     constraint = config["constrain_latent"]
@@ -397,7 +1251,12 @@ def constrain_latent(trials, params, config):
 
 
 def constrain_loading(trials, params, config):
-    """Normalize loading matrix"""
+    """Normalize loading matrix
+
+    Under config["monotone"], a norm constraint rescales the latents and their prior alike
+    (mu and sigma by s, v by s^2 and w by s^-2), so that the lower bound is unchanged.
+    Otherwise, and under the svd constraint, the lower bound changes.
+    """
     constraint = config["constrain_loading"]
 
     if not constraint or constraint == "none":
@@ -421,6 +1280,20 @@ def constrain_loading(trials, params, config):
         params["a"] /= s
         for trial in trials:
             trial["mu"] *= s.T
+        if not config["monotone"]:
+            return
+        for trial in trials:
+            if trial.get("v") is not None:
+                trial["v"] *= s.T ** 2
+            if trial.get("w") is not None:
+                trial["w"] /= s.T ** 2
+        scale = np.broadcast_to(s.ravel(), params["sigma"].shape)
+        params["sigma"] = params["sigma"] * scale
+        if "cholesky" in params:
+            params["cholesky"] = {
+                length: prior * scale[:, np.newaxis, np.newaxis]
+                for length, prior in params["cholesky"].items()
+            }
 
 
 def update_w(trials, params, config):
@@ -446,7 +1319,11 @@ def update_w(trials, params, config):
         U = np.empty_like(r)
         U[:, poiss_mask] = r[:, poiss_mask]
         U[:, gauss_mask] = 1 / gauss_noise
-        trial["w"] = U @ (a.T ** 2)
+        unobserved = unobserved_entries(trial)
+        if unobserved is not None:
+            U[unobserved] = 0
+        # in place, since a trial may be a segment of views of its parent trial
+        np.matmul(U, a.T ** 2, out=w)
 
 
 def update_v(trials, params, config):
@@ -479,11 +1356,16 @@ def update_v(trials, params, config):
 
 
 class VLGP(Model):
+    _lazy_attributes = ("_trials",)
+
     def __init__(self, n_factors, random_state=0, **kwargs):
         self.n_factors = n_factors
         self.random_state = random_state
         self._weight = None
         self._bias = None
+        self._params = None
+        self._config = None
+        self._trials = None
         self.setup(**kwargs)
 
     def fit(self, trials, **kwargs):
@@ -491,7 +1373,11 @@ class VLGP(Model):
         :param trials: list of trials
         :return: the trials containing the latent factors
         """
+        import click
+
         config = get_config(**kwargs)
+        if config["random_state"] is None:
+            config["random_state"] = self.random_state
 
         # add built-in callbacks
         callbacks = config["callbacks"]
@@ -500,6 +1386,7 @@ class VLGP(Model):
             callbacks.extend([show, saver.save])
         config["callbacks"] = callbacks
 
+        kwargs["omega_bound"] = config["omega_bound"]
         params = get_params(trials, self.n_factors, **kwargs)
 
         click.echo("Initializing...")
@@ -508,40 +1395,123 @@ class VLGP(Model):
         # fill arrays
         fill_params(params)
 
-        fill_trials(trials)
-        make_cholesky(trials, params, config)
-        update_w(trials, params, config)
-        update_v(trials, params, config)
+        infer_trials(trials, params, config, run_estep=False)
 
         subtrials = cut_trials(trials, params, config)
         make_cholesky(subtrials, params, config)
 
-        fill_trials(subtrials)
-
         params["initial"] = copy.deepcopy(params)
         # VEM
         click.echo("Fitting...")
         vem(subtrials, params, config)
         # E step only for inference given above estimated parameters and hyperparameters
-        make_cholesky(trials, params, config)
-        update_w(trials, params, config)
-        update_v(trials, params, config)
         click.echo("Inferring...")
-        infer(trials, params, config)
+        infer_trials(trials, params, config)
         click.echo("Done")
 
         self._weight = params["a"]
         self._bias = params["b"]
+        self._params = params
+        self._config = config
+        self._trials = trials
+
+        return trials
+
+    def partial_fit(self, trials, max_iter=5, reinfer=False, **kwargs):
+        """Update the fitted model with new trials
+
+        The latents of the new trials are inferred given the current parameters.
+        Then a few vEM iterations run the E step on the new trials only,
+        while the M and H steps use both the old trials, with their latents held fixed, and the new trials.
+        The iterations stop early by the convergence check of vem, without min_iter.
+
+        :param trials: list of new trials
+        :param max_iter: number of vEM iterations
+        :param reinfer: infer the latents of all trials after the update, otherwise only the new trials
+        :param kwargs: options of this update, the stored config is unchanged
+        :return: the new trials containing the latent factors
+        """
+        from .api import echo
+
+        self.check_fitted()
+
+        params = self._params
+        config = dict(self._config)
+        config.update({k: v for k, v in kwargs.items() if k in config})
+        tol = config["tol"]
+        elbo_tol = config["elbo_tol"]
+        eps = config["eps"]
+
+        echo(config, "Inferring new trials...")
+        self._infer(trials, config)
+
+        whole_trials = self._trials + trials
+        new_segments = list(cut_trials(trials, params, config))
+        all_segments = list(cut_trials(self._trials, params, config)) + new_segments
+
+        echo(config, "Updating...")
+        previous = None
+        for it in range(max_iter):
+            norm_mu = norm(np.concatenate([segment["mu"] for segment in new_segments], axis=0))
+            norm_a = norm(params["a"])
+            norm_b = norm(params["b"])
+
+            make_cholesky(all_segments, params, config)
+            constrain_loading(whole_trials, params, config)
+            estep(new_segments, params, config)
+            lower_bound = elbo(all_segments, params, config)
+            mstep(all_segments, params, config)
+            hstep(all_segments, params, config)
+
+            dmu = np.concatenate([segment["dmu"] for segment in new_segments], axis=0)
+            converged = (
+                norm(dmu) / (norm_mu + eps) < tol
+                and norm(params["da"]) / (norm_a + eps) < tol
+                and norm(params["db"]) / (norm_b + eps) < tol
+            )
+            if elbo_tol is not None and previous is not None:
+                converged = converged or abs(lower_bound - previous) < elbo_tol * abs(previous)
+            previous = lower_bound
+            if converged:
+                echo(config, "Converged after {} iterations".format(it + 1))
+                break
+
+        echo(config, "Inferring...")
+        infer_trials(whole_trials if reinfer else trials, params, config)
+        echo(config, "Done")
+
+        self._weight = params["a"]
+        self._bias = params["b"]
+        self._trials = whole_trials
 
         return trials
 
     def infer(self, trials):
-        if not self.isfiited:
+        """Infer the latent factors of trials given the fitted model
+
+        :param trials: list of trials
+        :return: the trials containing the latent factors
+        """
+        self.check_fitted()
+        return self._infer(trials, self._config)
+
+    def _infer(self, trials, config):
+        params = self._params
+        for trial in trials:
+            length = trial["y"].shape[0]
+            trial.setdefault("x", np.ones((length, params["xdim"], params["ydim"])))
+            if trial.get("mu") is None:
+                trial["mu"] = np.zeros((length, params["zdim"]))
+        infer_trials(trials, params, config)
+
+        return trials
+
+    def check_fitted(self):
+        if not self.isfitted:
             raise ValueError(
                 "This model is not fitted yet. Call 'fit' with "
                 "appropriate arguments before using this method."
             )
-        raise NotImplementedError()
 
     def __eq__(self, other):
         if (
@@ -0,0 +1,320 @@
+"""
+Distributed fitting by map-reduce of sufficient statistics
+
+Every worker holds a shard of the trials, possibly on another host, and runs the E step on it.
+The coordinator runs the M and H steps on the statistics reduced over the workers and broadcasts the parameters.
+Only parameters and statistics go over the connections, and their sizes do not grow with the number of trials.
+
+The M step is the line search Newton of core.optimize_loading.
+The H step is by Whittle likelihood (see gp.whittle) since the periodograms add up over trials.
+"""
+import logging
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from scipy.linalg import norm
+
+from . import gp
+from .core import (
+    HYPERPARAMETERS,
+    backtrack_hyperparameters,
+    elbo,
+    estep,
+    infer_trials,
+    constrain_loading,
+    optimize_loading,
+    stream_statistics,
+    update_v,
+)
+from .preprocess import (
+    get_config,
+    get_params,
+    fill_params,
+    initialize_latents,
+    ppca,
+    streaming_moments,
+)
+from .util import cut_trials
+
+__all__ = ["serve", "fit"]
+
+logger = logging.getLogger(__name__)
+
+# parameters broadcast to the workers before the E step
+BROADCAST_KEYS = ("a", "b", "noise", "sigma", "omega")
+
+
+def serve(address, authkey, trials):
+    """Serve a shard of trials to a coordinator
+
+    Blocks until the coordinator closes the connection.
+
+    :param address: (host, port) or path of a Unix socket to listen on
+    :param authkey: bytes shared with the coordinator
+    :param trials: list of trials of the shard
+    :return: trials with their inferred latents
+    """
+    state = {"trials": trials}
+    with Listener(address, authkey=authkey) as listener:
+        with listener.accept() as conn:
+            while True:
+                try:
+                    command, args = conn.recv()
+                except EOFError:
+                    break
+                if command == "close":
+                    break
+                try:
+                    conn.send((True, COMMANDS[command](state, *args)))
+                except Exception as e:
+                    logger.exception(repr(e), exc_info=True)
+                    conn.send((False, repr(e)))
+    return trials
+
+
+def worker_ydim(state):
+    return state["trials"][0]["y"].shape[1]
+
+
+def worker_moments(state):
+    return streaming_moments(state["trials"])
+
+
+def worker_setup(state, params, config, moments):
+    """Initialize the latents and cut the trials, see api.fit"""
+    trials = state["trials"]
+    params = dict(params)
+    transform = ppca(moments, params["zdim"], config)[3]
+    initialize_latents(trials, params, transform, config["chunk_size"])
+    infer_trials(trials, params, config, run_estep=False)
+    segments = cut_trials(trials, params, config)
+
+    state.update(params=params, config=config, segments=segments)
+
+
+def worker_estep(state, update):
+    """E step given the broadcast parameters
+
+    :return: lower bound, squared norms of the change and the latent means before the step
+    """
+    segments = state["segments"]
+    params = state["params"]
+    config = state["config"]
+
+    params.update(update)
+    mu_sq = sum(np.sum(trial["mu"] ** 2) for trial in segments)
+    constrain_loading(getattr(segments, "trials", segments), params, config)
+    gp.make_cholesky(segments, params, config)
+    lower_bound = estep(segments, params, config)
+
+    dmu_sq = sum(np.sum(trial["dmu"] ** 2) for trial in segments)
+    if lower_bound is None:
+        lower_bound = 0.0
+    return lower_bound, dmu_sq, mu_sq
+
+
+def worker_bound(state, update):
+    """Lower bound given the broadcast parameters, with the posterior variance of their prior, see core.hstep"""
+    segments = state["segments"]
+    params = state["params"]
+    config = state["config"]
+
+    params.update(update)
+    gp.make_cholesky(segments, params, config)
+    update_v(segments, params, config)
+    return elbo(segments, params, config)
+
+
+def worker_statistics(state, name, *args):
+    return stream_statistics(state["segments"], state["config"]["chunk_size"])(name, *args)
+
+
+def worker_periodogram(state):
+    params = state["params"]
+    prior = params["cholesky"] if state["config"]["method"] == "VB" else None
+    return gp.periodogram(state["segments"], prior)
+
+
+def worker_infer(state, update):
+    state["params"].update(update)
+    infer_trials(state["trials"], state["params"], state["config"])
+
+
+def worker_fetch(state):
+    return [{"mu": trial["mu"], "v": trial["v"]} for trial in state["trials"]]
+
+
+COMMANDS = {
+    "ydim": worker_ydim,
+    "moments": worker_moments,
+    "setup": worker_setup,
+    "estep": worker_estep,
+    "bound": worker_bound,
+    "statistics": worker_statistics,
+    "periodogram": worker_periodogram,
+    "infer": worker_infer,
+    "fetch": worker_fetch,
+}
+
+
+def total(results):
+    """Sum of statistics, elementwise for tuples and by key for dicts"""
+    first = results[0]
+    if isinstance(first, dict):
+        keys = {key for result in results for key in result}
+        return {
+            key: total([result[key] for result in results if key in result])
+            for key in keys
+        }
+    if isinstance(first, tuple):
+        return tuple(total(items) for items in zip(*results))
+    return sum(results[1:], first)
+
+
+class Cluster:
+    """Connections of the coordinator to the workers"""
+
+    def __init__(self, addresses, authkey, timeout=60):
+        self.connections = [connect(address, authkey, timeout) for address in addresses]
+
+    def map(self, command, *args):
+        """Run a command on all workers and collect their results"""
+        for conn in self.connections:
+            conn.send((command, args))
+        results = []
+        for conn in self.connections:
+            ok, result = conn.recv()
+            if not ok:
+                raise RuntimeError("worker failed on {}: {}".format(command, result))
+            results.append(result)
+        return results
+
+    def reduce(self, command, *args):
+        """Run a command on all workers and sum their results"""
+        return total(self.map(command, *args))
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(("close", ()))
+            finally:
+                conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def connect(address, authkey, timeout=60):
+    """Connect to a worker, retrying until it listens"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def hstep(cluster, params, config):
+    """Whittle H step, safeguarded by the lower bound reduced over the workers under monotone, see core.hstep"""
+    if not config["monotone"]:
+        gp.whittle_fit(cluster.reduce("periodogram"), params, config)
+        return
+
+    def evaluate(hyperparameters):
+        params.update({k: np.copy(value) for k, value in hyperparameters.items()})
+        return cluster.reduce("bound", {k: params[k] for k in BROADCAST_KEYS})
+
+    current = {k: np.copy(params[k]) for k in HYPERPARAMETERS}
+    lower_bound = evaluate(current)
+    gp.whittle_fit(cluster.reduce("periodogram"), params, config)
+    optimized = {k: np.copy(params[k]) for k in HYPERPARAMETERS}
+    if backtrack_hyperparameters(current, optimized, evaluate, lower_bound) is None:
+        evaluate(current)
+
+
+def fit(addresses, n_factors, authkey, **kwargs):
+    """Fit the trials sharded over workers, see serve
+
+    :param addresses: addresses of the workers
+    :param n_factors: number of latent factors
+    :param authkey: bytes shared with the workers
+    :param kwargs: options, see api.fit
+    :return: dict of params, config and the latents of trials per worker
+    """
+    import click
+
+    config = get_config(**kwargs)
+    if config["constrain_latent"] and config["constrain_latent"] != "none":
+        raise NotImplementedError("constrain_latent is not supported by distributed fitting")
+    if config["Hstep"] and config["hstep_method"] != "whittle":
+        logger.warning("Distributed fitting uses Whittle H step")
+
+    tol = config["tol"]
+    elbo_tol = config["elbo_tol"]
+
+    with Cluster(addresses, authkey) as cluster:
+        ydim = cluster.map("ydim")[0]
+        kwargs["omega_bound"] = config["omega_bound"]
+        params = get_params([{"y": np.empty((0, ydim))}], n_factors, **kwargs)
+
+        # streaming PCA over all shards
+        click.echo("Initializing")
+        moments = cluster.reduce("moments")
+        a, b, noise, _ = ppca(moments, n_factors, config)
+        if params.get("a") is None:
+            params.update(a=a)
+        if params.get("b") is None:
+            params.update(b=b)
+        if params.get("noise") is None:
+            params.update(noise=noise)
+        fill_params(params)
+        cluster.map("setup", params, config, moments)
+        click.secho("Initialized", fg="green")
+
+        runtime = {"it": 0, "elbo": [], "converged": False}
+        click.echo("Fitting")
+        for it in range(config["max_iter"]):
+            runtime["it"] += 1
+            norm_a = norm(params["a"])
+            norm_b = norm(params["b"])
+
+            # the workers constrain the loading and rescale their latents alike, hence the copies
+            update = {k: np.copy(params[k]) for k in BROADCAST_KEYS}
+            constrain_loading([], params, config)
+            lower_bound, dmu_sq, mu_sq = cluster.reduce("estep", update)
+
+            if config["Mniter"] > 0:
+                optimize_loading(
+                    params, config, lambda *args: cluster.reduce("statistics", *args)
+                )
+            if config["Hstep"]:
+                hstep(cluster, params, config)
+
+            runtime["elbo"].append(lower_bound)
+            config["runtime"] = runtime
+            click.echo("Iteration {:4d}".format(runtime["it"]))
+
+            converged = (
+                np.sqrt(dmu_sq) < tol * np.sqrt(mu_sq)
+                and norm(params["da"]) < tol * norm_a
+                and norm(params["db"]) < tol * norm_b
+            )
+            if elbo_tol is not None and len(runtime["elbo"]) > 1:
+                previous, current = runtime["elbo"][-2:]
+                converged = converged or abs(current - previous) < elbo_tol * abs(previous)
+            if converged and it + 1 >= config["min_iter"]:
+                runtime["converged"] = True
+                break
+
+        click.echo("Inferring")
+        cluster.map("infer", {k: params[k] for k in BROADCAST_KEYS})
+        trials = cluster.map("fetch")
+        click.secho("Done", fg="green")
+
+    return {"trials": trials, "params": params, "config": config}
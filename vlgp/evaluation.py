@@ -1,9 +1,187 @@
+"""
+Evaluation of fitted models
+
+The trials are evaluated in chunks of consecutive trials. The arrays of a trial are only read when its chunk is
+evaluated, hence a trial can be any mapping of array-likes, e.g. a group of a HDF5 result file.
+"""
 import time
 from contextlib import contextmanager
 
+import numpy as np
+from numpy import einsum
+
+from .math import trunc_exp
+
 
 @contextmanager
 def timer():
     tick = time.perf_counter()
     yield lambda: tock - tick
     tock = time.perf_counter()
+
+
+def expected_rate(mu, v, x, a, b, likelihood):
+    """Expected firing rate exp(mu a + x b + v a^2 / 2) of Poisson neurons and mean of Gaussian neurons"""
+    eta = mu @ a + einsum("ijk, jk -> ik", x, b)
+    rate = trunc_exp(eta + 0.5 * v @ (a ** 2))
+    gauss_mask = likelihood == "gaussian"
+    rate[:, gauss_mask] = eta[:, gauss_mask]
+    return rate
+
+
+def log_likelihood(y, mean, likelihood, noise, mask=None):
+    """Log-likelihood per neuron summed over the observed entries"""
+    from scipy.special import gammaln
+
+    if mask is not None:
+        y = np.where(mask, y, 0)
+    gauss_mask = likelihood == "gaussian"
+    poiss_mask = ~gauss_mask
+    ll = np.empty(y.shape)
+    # each term only on its own columns, the means of Gaussian neurons can be zero or negative
+    y_poiss = y[:, poiss_mask]
+    mean_poiss = mean[:, poiss_mask]
+    ll[:, poiss_mask] = y_poiss * np.log(mean_poiss) - mean_poiss - gammaln(y_poiss + 1)
+    ll[:, gauss_mask] = -0.5 * (
+        np.log(2 * np.pi * noise[gauss_mask])
+        + (y[:, gauss_mask] - mean[:, gauss_mask]) ** 2 / noise[gauss_mask]
+    )
+    if mask is not None:
+        ll *= mask
+    return np.sum(ll, axis=0)
+
+
+def chunks(trials, params, neurons=None, size=100000):
+    """Concatenate consecutive trials into chunks of at least size time bins
+
+    :param neurons: index or boolean mask of the neurons to read
+    :return: generator of the lengths of trials in the chunk and the concatenated y, x, mu, v and observed entries
+    """
+    neurons = slice(None) if neurons is None else neurons
+    xdim = params["xdim"]
+
+    buffer = []
+    total = 0
+    for i, trial in enumerate(trials):
+        y = np.asarray(trial["y"], dtype=float)[:, neurons]
+        length = y.shape[0]
+        if "x" in trial:
+            x = np.asarray(trial["x"], dtype=float)[..., neurons]
+        else:
+            x = np.ones((length, xdim, y.shape[1]))
+        mask = trial.get("mask")
+        if mask is None:
+            mask = np.ones_like(y, dtype=bool)
+        else:
+            mask = np.asarray(mask, dtype=bool)[:, neurons]
+        buffer.append(
+            (y, x, np.asarray(trial["mu"], dtype=float), np.asarray(trial["v"], dtype=float), mask)
+        )
+        total += length
+
+        if total >= size or i == len(trials) - 1:
+            lengths = [item[0].shape[0] for item in buffer]
+            yield (lengths,) + tuple(np.concatenate(arrays, axis=0) for arrays in zip(*buffer))
+            buffer = []
+            total = 0
+
+
+def subset(params, neurons=None):
+    """Parameters of a subset of neurons"""
+    neurons = slice(None) if neurons is None else neurons
+    return (
+        params["a"][:, neurons],
+        params["b"][:, neurons],
+        np.asarray(params["likelihood"]).astype(str)[neurons],
+        params["noise"][neurons],
+    )
+
+
+def predict(trials, params, neurons=None, chunk_size=100000):
+    """Expected firing rates of trials
+
+    :param trials: list of inferred trials
+    :param params: parameters
+    :param neurons: index or boolean mask of neurons to predict, all if None
+    :param chunk_size: least number of time bins evaluated at once
+    :return: list of rates (time, neuron) per trial
+    """
+    a, b, likelihood, _ = subset(params, neurons)
+
+    rates = []
+    for lengths, y, x, mu, v, mask in chunks(trials, params, neurons, chunk_size):
+        rate = expected_rate(mu, v, x, a, b, likelihood)
+        rates.extend(np.split(rate, np.cumsum(lengths)[:-1]))
+    return rates
+
+
+def evaluate(trials, params, neurons=None, chunk_size=100000):
+    """Goodness of fit per neuron in one pass over trials
+
+    The log-likelihood is of the expected rates. The null model is a constant rate (or mean) per neuron and
+    the saturated model predicts the observation itself. The pseudo-R² is the fraction of the null deviance
+    explained, which is the R² for Gaussian neurons.
+
+    :param trials: list of inferred trials
+    :param params: parameters
+    :param neurons: index or boolean mask of neurons to evaluate, e.g. held-out neurons, all if None
+    :param chunk_size: least number of time bins evaluated at once
+    :return: dict of loglik, null_loglik, pseudo_r2, bits_per_spike (NaN for Gaussian neurons) per neuron
+    """
+    from scipy.special import gammaln, xlogy
+
+    a, b, likelihood, noise = subset(params, neurons)
+    gauss_mask = likelihood == "gaussian"
+
+    count = 0  # number of observed entries
+    s1 = 0  # sum of observation
+    s2 = 0  # sum of squares
+    lgam = 0  # sum of log y!
+    ylogy = 0  # sum of y log y
+    loglik = 0
+    for lengths, y, x, mu, v, mask in chunks(trials, params, neurons, chunk_size):
+        y = np.where(mask, y, 0)
+        rate = expected_rate(mu, v, x, a, b, likelihood)
+        loglik = loglik + log_likelihood(y, rate, likelihood, noise, mask)
+        count = count + mask.sum(axis=0)
+        s1 = s1 + y.sum(axis=0)
+        s2 = s2 + np.sum(y ** 2, axis=0)
+        lgam = lgam + gammaln(y + 1).sum(axis=0)
+        ylogy = ylogy + xlogy(y, y).sum(axis=0)
+
+    count = np.maximum(count, 1)
+    mean = s1 / count
+
+    # Poisson
+    null_loglik = xlogy(s1, mean) - s1 - lgam
+    saturated_loglik = ylogy - s1 - lgam
+    # Gaussian
+    sst = s2 - s1 * mean
+    constant = -0.5 * count * np.log(2 * np.pi * noise)
+    null_loglik[gauss_mask] = (constant - 0.5 * sst / noise)[gauss_mask]
+    saturated_loglik[gauss_mask] = constant[gauss_mask]
+
+    return {
+        "loglik": loglik,
+        "null_loglik": null_loglik,
+        "pseudo_r2": (loglik - null_loglik) / (saturated_loglik - null_loglik),
+        "bits_per_spike": np.where(
+            gauss_mask, np.nan, (loglik - null_loglik) / (np.maximum(s1, 1) * np.log(2))
+        ),
+    }
+
+
+def evaluate_hdf5(path, neurons=None, chunk_size=100000):
+    """Evaluate a result saved in HDF5 reading the trials lazily
+
+    :param path: HDF5 file of a fit, see util.save
+    :return: see evaluate
+    """
+    import h5py
+    from .util import hdf5_to_dict
+
+    with h5py.File(path, "r") as fin:
+        params = hdf5_to_dict(fin["params"])
+        group = fin["trials"]
+        trials = [group[key] for key in sorted(group, key=int)]
+        return evaluate(trials, params, neurons, chunk_size)
@@ -1,12 +1,19 @@
 """
 Optimization code for Gaussian Process
 """
+from collections import OrderedDict
+
 import numpy as np
 from numpy.linalg import LinAlgError
 from scipy.linalg import cholesky, cho_solve
-from scipy.spatial.distance import pdist, squareform
 
-from .math import ichol_gauss
+from .math import ichol_gauss, toeplitz_spectrum
+from .preprocess import group_by_length
+
+# (length, omega, rank) -> incomplete Cholesky factor of unit variance
+# shared by all fits in the process and seedable for worker processes
+_prior_cache = OrderedDict()
+prior_cache_size = 256
 
 
 def elbo(params, mask, *args):
@@ -45,6 +52,8 @@ def elbo(params, mask, *args):
 
 def kernel(x, params):
     """kernel matrix and derivatives"""
+    from scipy.spatial.distance import pdist, squareform
+
     sigmasq, omega, eps = params
 
     dists = pdist(
@@ -64,6 +73,13 @@ def kernel(x, params):
 
 def optimize(trials, params, config):
     """Optimize hyperparameters"""
+    method = config["hstep_method"]
+    if method in ("whittle", "hybrid"):
+        whittle(trials, params, config)
+        if method == "whittle":
+            make_cholesky(trials, params, config)
+            return
+
     zdim = params["zdim"]
     rank = params["rank"]
     dt = params["dt"]  # binwidth, set to 1 temporarily
@@ -73,20 +89,20 @@ def optimize(trials, params, config):
     omega = params["omega"]
     gp_noise = params["gp_noise"]
 
-    # trials
-    mu = np.stack([trial["mu"] for trial in trials])
-    w = np.stack([trial["w"] for trial in trials])
-    window = config["window"]
-    t = np.arange(window) * dt  # absolute time
+    # segments stacked by length, the objective is summed over the lengths
+    groups = [
+        (np.arange(length) * dt, np.stack([trial["mu"] for trial in group]), np.stack([trial["w"] for trial in group]))
+        for length, group in group_by_length(trials).items()
+    ]
 
     for l in range(zdim):
         initial = (sigma[l] ** 2, omega[l], gp_noise)
-        bounds = ((1e-3, 1), config["omega_bound"], (gp_noise / 2, gp_noise * 2))
+        bounds = (sigma_bound(config), config["omega_bound"], (gp_noise / 2, gp_noise * 2))
         mask = np.array([0, 1, 0])
 
-        # transpose each latent dimension to (window, #trials/segments)
+        # transpose each latent dimension to (length, #trials/segments)
         (sigmasq, omega_new, _), fun = optimze1d(
-            t, mu[:, :, l].T, w[:, :, l].T, initial, bounds, mask=mask
+            [(t, mu[:, :, l].T, w[:, :, l].T) for t, mu, w in groups], initial, bounds, mask=mask
         )
         if not np.any(np.isclose(omega_new, config["omega_bound"])):
             omega[l] = omega_new
@@ -97,8 +113,116 @@ def optimize(trials, params, config):
     make_cholesky(trials, params, config)
 
 
-def optimze1d(t, mu, w, params, bounds, mask):
-    """Optimize hyperparameters of a single dimension"""
+def whittle(trials, params, config):
+    """Fit hyperparameters by Whittle likelihood
+
+    The spectral density of the squared exponential kernel,
+    S(f) = sigma^2 sqrt(pi / omega) exp(-pi^2 f^2 / omega),
+    is fit to the expected (tapered) periodogram of the latent under the posterior, see periodogram.
+    Each evaluation costs O(T) after the O(T log T) periodogram.
+    """
+    prior = params["cholesky"] if config["method"] == "VB" else None
+    whittle_fit(periodogram(trials, prior), params, config)
+
+
+def periodogram(trials, prior=None, batch_size=100):
+    """Sums of the expected (tapered) periodograms of the latents over trials of the same length
+
+    E|FFT(hz)|^2 / T = (|FFT(h mu)|^2 + sum_r |FFT(h B_r)|^2) / T, where the posterior covariance of a latent is
+    BB' = G (I + G'WG)^-1 G', B = G L^-T and LL' = I + G'WG.
+    The sums are additive over sets of trials.
+
+    :param prior: prior factors {length: (latent, time, rank)}, None for the posterior means only (MAP)
+    :return: {length: (sum of periodograms (frequency, latent), number of trials)}
+    """
+    stats = {}
+    for length, group in group_by_length(trials).items():
+        # Hann taper against the leakage that biases smooth spectra
+        h = np.hanning(length + 2)[1:-1]
+        h *= np.sqrt(length / np.sum(h ** 2))
+        mu = np.stack([trial["mu"] for trial in group])  # (trial, time, latent)
+        pgram = np.sum(np.abs(np.fft.rfft(h[:, np.newaxis] * mu, axis=1)) ** 2, axis=0)
+        if prior is not None:
+            G = prior[length]
+            Gt = np.swapaxes(G, 1, 2)
+            for start in range(0, len(group), batch_size):
+                w = np.stack([trial["w"] for trial in group[start:start + batch_size]])
+                P = Gt @ (np.swapaxes(w, 1, 2)[..., np.newaxis] * G)  # (trial, latent, rank, rank)
+                P += np.identity(G.shape[-1])
+                Gt_batch = np.broadcast_to(Gt, P.shape[:2] + Gt.shape[1:])
+                Bt = np.linalg.solve(np.linalg.cholesky(P), Gt_batch)
+                pgram += np.sum(np.abs(np.fft.rfft(h * Bt, axis=-1)) ** 2, axis=(0, 2)).T
+        stats[length] = (pgram / length, len(group))
+    return stats
+
+
+def whittle_fit(stats, params, config):
+    """Fit hyperparameters to the periodograms, see whittle and periodogram"""
+    from scipy.optimize import minimize
+
+    zdim = params["zdim"]
+    sigma = params["sigma"]
+    omega = params["omega"]
+    gp_noise = params["gp_noise"]
+
+    # periodograms averaged over trials of the same length
+    freqs = []
+    pgrams = []
+    weights = []
+    for length, (pgram, count) in stats.items():
+        weight = np.full(pgram.shape[0], 2.0 * count)  # conjugate frequencies
+        weight[0] /= 2
+        if length % 2 == 0:
+            weight[-1] /= 2  # Nyquist
+        freqs.append(np.fft.rfftfreq(length))
+        pgrams.append(pgram / count)
+        weights.append(weight)
+    f = np.concatenate(freqs)
+    pgram = np.concatenate(pgrams)  # (frequency, latent)
+    weight = np.concatenate(weights)
+
+    bounds = np.log((sigma_bound(config), config["omega_bound"]))
+
+    for l in range(zdim):
+        I = pgram[:, l]
+
+        def obj_func(x):
+            sigmasq, omega_l = np.exp(x)
+            se = sigmasq * np.sqrt(np.pi / omega_l) * np.exp(-np.pi ** 2 * f ** 2 / omega_l)
+            S = se + gp_noise
+            ll = np.sum(weight * (np.log(S) + I / S))
+            dS = weight * (1 - I / S) * se / S  # d/dlogS * dS/dlogse
+            dll = np.array([dS.sum(), dS @ (np.pi ** 2 * f ** 2 / omega_l - 0.5)])
+            return ll, dll
+
+        res = minimize(
+            obj_func, np.log([sigma[l] ** 2, omega[l]]), jac=True, bounds=bounds
+        )
+        sigmasq, omega_new = np.exp(res.x)
+        if not np.any(np.isclose(omega_new, config["omega_bound"])):
+            omega[l] = omega_new
+        elif config.get("monotone"):
+            continue  # sigma fitted along with omega at a bound is not kept either
+        sigma[l] = np.sqrt(sigmasq)
+
+    params["sigma"] = sigma
+    params["omega"] = omega
+
+
+def sigma_bound(config):
+    """Bounds of sigma^2
+
+    Under config["monotone"] the scale of the latents is set by the loading constraint (see core.constrain_loading)
+    and sigma is bounded only against overflow.
+    """
+    return (1e-3, 1e6) if config.get("monotone") else (1e-3, 1)
+
+
+def optimze1d(groups, params, bounds, mask):
+    """Optimize hyperparameters of a single dimension
+
+    :param groups: list of (time, mu, w) of the trials of the same length, the ELBO is summed over them
+    """
     from scipy.optimize import minimize
 
     log_params = np.log(params)
@@ -106,8 +230,13 @@ def optimze1d(t, mu, w, params, bounds, mask):
 
     def obj_func(x):
         expx = np.exp(x)
-        post_cov = construct_posterior_cov(t, w, expx)
-        ll, dll = elbo(expx, mask, t, mu, post_cov)
+        ll = 0.0
+        dll = np.zeros_like(expx)
+        for t, mu, w in groups:
+            post_cov = construct_posterior_cov(t, w, expx)
+            ll_group, dll_group = elbo(expx, mask, t, mu, post_cov)
+            ll += ll_group
+            dll += dll_group
         return -ll, -dll
 
     try:
@@ -155,8 +284,49 @@ def make_cholesky(trials, params, config):
     omega = params["omega"]
     lengths = np.array([trial["y"].shape[0] for trial in trials])
     unique_lengths = np.unique(lengths)
+    # one factor per distinct length (bucket)
+    params["cholesky"] = dict()
     for t in unique_lengths:
-        params["cholesky"] = dict()
         params["cholesky"][t] = np.array(
-            [ichol_gauss(t, omega[l], rank) * sigma[l] for l in range(zdim)]
+            [ichol_factor(t, omega[l], rank) * sigma[l] for l in range(zdim)]
         )
+
+
+def ichol_factor(length, omega, rank):
+    """Cached incomplete Cholesky factor of unit-variance squared exponential covariance"""
+    key = (int(length), float(omega), int(rank))
+    G = _prior_cache.get(key)
+    if G is None:
+        G = ichol_gauss(length, omega, rank)
+        G.setflags(write=False)
+        _prior_cache[key] = G
+        if len(_prior_cache) > prior_cache_size:
+            _prior_cache.popitem(last=False)  # discard the least recently used
+    else:
+        _prior_cache.move_to_end(key)
+    return G
+
+
+def get_prior_cache():
+    """Snapshot of the prior factor cache"""
+    return dict(_prior_cache)
+
+
+def set_prior_cache(cache):
+    """Seed the prior factor cache, e.g. in the initializer of worker processes"""
+    for key, G in cache.items():
+        G.setflags(write=False)
+        _prior_cache[key] = G
+
+
+def make_spectrum(lengths, params):
+    """Make the spectra of the exact prior covariance for matrix-free products"""
+    sigma = params["sigma"]
+    omega = params["omega"]
+    return {
+        t: [
+            toeplitz_spectrum(s ** 2 * np.exp(-w * np.arange(t) ** 2))
+            for s, w in zip(sigma, omega)
+        ]
+        for t in lengths
+    }
@@ -18,7 +18,7 @@ def rectify(x):
     return x.clip(0, np.inf)
 
 
-def trunc_exp(x, bound=10):
+def trunc_exp(x, bound=10, out=None):
     """
     Truncated exp
 
@@ -27,12 +27,14 @@ def trunc_exp(x, bound=10):
     x : ndarray
     bound : double
         upper bound of x
+    out : ndarray, optional
+        preallocated array to store the result
     Returns
     -------
     ndarray
         exp(min(x, bound))
     """
-    return np.exp(np.minimum(x, bound))
+    return np.exp(np.minimum(x, bound), out=out)
 
 
 def lexp(x, c=0):
@@ -215,3 +217,86 @@ def orth(x, a):
 def diagadd(m, v):
     """Add a vector to the diagonal of a matrix"""
     np.fill_diagonal(m, m.diagonal() + v)
+
+
+def pcg(matvec, b, x0=None, precond=None, tol=1e-6, maxiter=100):
+    """
+    Preconditioned conjugate gradient for a symmetric positive definite system Ax = b
+
+    Parameters
+    ----------
+    matvec : callable
+        x -> Ax
+    b : ndarray
+        right-hand side
+    x0 : ndarray
+        initial guess
+    precond : ndarray
+        diagonal of the inverse preconditioner
+    tol : double
+        relative tolerance of residual norm
+    maxiter : int
+        maximum number of iterations
+
+    Returns
+    -------
+    ndarray
+        solution
+    int
+        number of iterations
+    """
+    x = np.zeros_like(b) if x0 is None else x0.copy()
+    r = b - matvec(x)
+    bound = tol * np.linalg.norm(b)
+    z = r if precond is None else precond * r
+    p = z.copy()
+    rz = r @ z
+    for i in range(maxiter):
+        if np.linalg.norm(r) <= bound:
+            return x, i
+        Ap = matvec(p)
+        alpha = rz / (p @ Ap)
+        x += alpha * p
+        r -= alpha * Ap
+        z = r if precond is None else precond * r
+        rz_new = r @ z
+        p *= rz_new / rz
+        p += z
+        rz = rz_new
+    return x, maxiter
+
+
+def toeplitz_spectrum(c):
+    """
+    Spectrum of the circulant embedding of a symmetric Toeplitz matrix
+
+    Parameters
+    ----------
+    c : ndarray
+        first column
+
+    Returns
+    -------
+    ndarray
+        real FFT of the embedding of size 2n
+    """
+    return np.fft.rfft(np.concatenate([c, [0.0], c[:0:-1]]))
+
+
+def toeplitz_matvec(spectrum, x):
+    """
+    Product of a symmetric Toeplitz matrix and a vector in O(n log n)
+
+    Parameters
+    ----------
+    spectrum : ndarray
+        see toeplitz_spectrum
+    x : ndarray
+        vector of size n
+
+    Returns
+    -------
+    ndarray
+    """
+    n = x.shape[0]
+    return np.fft.irfft(spectrum * np.fft.rfft(x, 2 * n), 2 * n)[:n]
@@ -1,23 +1,21 @@
 import numpy as np
 
+RANK = 50  # rank of the prior factors
+
 
 def initialize(trials, params, config):
     """Make skeleton"""
-    # TODO: fast initialization for large dataset
-    from sklearn.decomposition import FactorAnalysis
-
     zdim = params["zdim"]
-    xdim = params["xdim"]
 
-    # TODO: use only a subsample of trials?
-    y = np.concatenate([trial["y"] for trial in trials], axis=0)
-    subsample = np.random.choice(y.shape[0], max(y.shape[0] // 10, 50))
-    ydim = y.shape[-1]
-    fa = FactorAnalysis(n_components=zdim, random_state=0)
-    z = fa.fit_transform(y[subsample, :])
-    a = fa.components_
-    b = np.log(np.maximum(np.mean(y, axis=0, keepdims=True), config["eps"]))
-    noise = np.var(y[subsample, :] - z @ a, ddof=0, axis=0)
+    # nothing to initialize when warm started
+    pending = [trial for trial in trials if trial.get("mu") is None]
+    if pending or any(params.get(k) is None for k in ("a", "b", "noise")):
+        if config["initialization"] == "pca":
+            a, b, noise, transform = streaming_pca(trials, zdim, config)
+        else:
+            a, b, noise, transform = factor_analysis(trials, zdim, config)
+    else:
+        a = b = noise = transform = None
 
     # stupid way of update
     # two cases
@@ -30,18 +28,142 @@ def initialize(trials, params, config):
     if params.get("noise") is None:
         params.update(noise=noise)
 
+    initialize_latents(trials, params, transform, config["chunk_size"])
+
+
+def initialize_latents(trials, params, transform, chunk_size=100000):
+    """Project the trials without latents by the transform of the initializer and reset their variance
+
+    The trials are projected in chunks of at least chunk_size time bins, one chunk in memory at a time,
+    hence their data can be lazy (e.g. h5py dataset or memmap).
+    """
+    zdim = params["zdim"]
+    xdim = params["xdim"]
+    ydim = params["ydim"]
+
+    pending = [trial for trial in trials if trial.get("mu") is None]
+    batch = []
+    total = 0
+    for i, trial in enumerate(pending):
+        batch.append(trial)
+        total += trial["y"].shape[0]
+        if total >= chunk_size or i == len(pending) - 1:
+            y = np.concatenate([np.asarray(trial["y"]) for trial in batch], axis=0)
+            mask = np.concatenate([np.asarray(observed_entries(trial)) for trial in batch], axis=0)
+            z = transform(y.reshape(-1, ydim), mask.reshape(-1, ydim))
+            boundaries = np.cumsum([trial["y"].shape[0] for trial in batch])[:-1]
+            for trial, mu in zip(batch, np.split(z.reshape(-1, zdim), boundaries)):
+                trial.update(mu=mu)
+            batch = []
+            total = 0
+
     for trial in trials:
         length = trial["y"].shape[0]
 
-        if trial.get("mu") is None:
-            trial.update(mu=fa.transform(trial["y"]))
-
         if trial.get("x") is None:
             trial.update(x=np.ones((length, xdim, ydim)))
 
         trial.update({"w": np.zeros((length, zdim)), "v": np.zeros((length, zdim))})
 
 
+def factor_analysis(trials, zdim, config):
+    """Initialize by factor analysis on a random subsample of time bins"""
+    from sklearn.decomposition import FactorAnalysis
+
+    y = np.concatenate([trial["y"] for trial in trials], axis=0)
+    if any(trial.get("mask") is not None for trial in trials):
+        # impute the missing entries by the mean of observed ones
+        mask = np.concatenate([observed_entries(trial) for trial in trials], axis=0)
+        mean = np.sum(np.where(mask, y, 0), axis=0) / np.maximum(mask.sum(axis=0), 1)
+        y = np.where(mask, y, mean)
+    subsample = np.random.choice(y.shape[0], max(y.shape[0] // 10, 50))
+    fa = FactorAnalysis(n_components=zdim, random_state=0)
+    z = fa.fit_transform(y[subsample, :])
+    a = fa.components_
+    b = np.log(np.maximum(np.mean(y, axis=0, keepdims=True), config["eps"]))
+    noise = np.var(y[subsample, :] - z @ a, ddof=0, axis=0)
+
+    def transform(y, mask):
+        return fa.transform(np.where(mask, y, fa.mean_))
+
+    return a, b, noise, transform
+
+
+def streaming_pca(trials, zdim, config):
+    """Initialize by probabilistic PCA from streamed moments
+
+    The trials are read once, one at a time, to accumulate the first and second moments of the observation.
+    Hence the observation of a trial can be any array-like (e.g. h5py dataset or memmap) that is loaded on demand.
+    The moments of the trials with missing entries are taken over the observed (pairs of) entries.
+    The loading is given by the randomized SVD of the covariance matrix.
+    """
+    return ppca(streaming_moments(trials), zdim, config)
+
+
+def streaming_moments(trials):
+    """Numbers of observed entries and pairs, and the first and second moments of the observation
+
+    The moments are additive over sets of trials.
+    """
+    n1 = 0  # number of observed entries per channel
+    n2 = 0  # number of observed pairs per pair of channels
+    s1 = 0
+    s2 = 0
+    for trial in trials:
+        y = np.asarray(trial["y"], dtype=float)
+        mask = trial.get("mask")
+        if mask is None:
+            n1 = n1 + y.shape[0]
+            n2 = n2 + y.shape[0]
+        else:
+            y = np.where(mask, y, 0)
+            mask = mask.astype(float)
+            n1 = n1 + mask.sum(axis=0)
+            n2 = n2 + mask.T @ mask
+        s1 = s1 + y.sum(axis=0)
+        s2 = s2 + y.T @ y
+
+    return n1, n2, s1, s2
+
+
+def ppca(moments, zdim, config):
+    """Probabilistic PCA of the moments, see streaming_moments"""
+    from sklearn.utils.extmath import randomized_svd
+
+    eps = config["eps"]
+    n1, n2, s1, s2 = moments
+
+    mean = s1 / np.maximum(n1, 1)
+    cov = s2 / np.maximum(n2, 1) - np.outer(mean, mean)
+    ydim = cov.shape[0]
+
+    u, s, _ = randomized_svd(cov, zdim, random_state=0)
+    if ydim > zdim:
+        sigmasq = max((np.trace(cov) - s.sum()) / (ydim - zdim), eps)
+    else:
+        sigmasq = eps
+    W = u * np.sqrt(np.maximum(s - sigmasq, eps))  # (ydim, zdim)
+
+    a = W.T
+    b = np.log(np.maximum(mean[np.newaxis, :], eps))
+    noise = np.maximum(np.diag(cov) - np.sum(W ** 2, axis=1), eps)
+    # posterior mean of PPCA, E(z|y) = (W'W + s^2 I)^-1 W'(y - m)
+    P = W @ np.linalg.inv(W.T @ W + sigmasq * np.identity(zdim))
+
+    def transform(y, mask):
+        return np.where(mask, y - mean, 0) @ P
+
+    return a, b, noise, transform
+
+
+def group_by_length(trials):
+    """Group trials by their lengths"""
+    groups = {}
+    for trial in trials:
+        groups.setdefault(trial["y"].shape[0], []).append(trial)
+    return groups
+
+
 def get_params(trials, zdim, **kwargs):
     """
     Define default initial parameters here
@@ -68,7 +190,7 @@ def get_params(trials, zdim, **kwargs):
         "noise": kwargs.get("noise", None),
         "sigma": kwargs.get("sigma", np.full(zdim, fill_value=1.0)),
         "omega": kwargs.get("omega", np.full(zdim, fill_value=kwargs["omega_bound"][1])),
-        "rank": 50,  # TODO: consider merge with window in config
+        "rank": RANK,  # TODO: consider merge with window in config
         "gp_noise": 1e-4,
         "dt": 1,
         "likelihood": lik,
@@ -85,19 +207,36 @@ def get_config(**kwargs):
         "eps": 1e-8,  # small value in the denominator
         "tol": 1e-8,  # relative tolerance to check convergence
         "min_iter": 5,  # always run at least so many iterations
+        "elbo_tol": 1e-6,  # relative change of the lower bound to check convergence, None to disable
+        "monotone": False,  # keep the lower bound from decreasing by rescaling the prior and backtracking the H step (slower)
         "method": "VB",  # VB or MAP
         "learning_rate": 1.0,  # not used for Hessian
         "max_iter": 20,  # number of iterations of EM
+        "accelerate": None,  # None or squarem (extrapolation of the vEM iteration)
         "Eniter": 25,  # number of interations inside E step
+        "estep": "coordinate",  # coordinate (one latent at a time) or joint (all latents)
+        "solver": "lowrank",  # Newton step of coordinate E step, lowrank or cg (matrix-free, MAP only)
+        "cg_tol": 1e-6,  # relative residual to stop conjugate gradient
+        "cg_maxiter": 100,  # maximum number of conjugate gradient iterations
         "Mniter": 25,  # number of interations inside M step
+        "line_search": True,  # backtracking Newton of Poisson neurons, otherwise clipped Newton
+        "grad_tol": 1e-6,  # gradient norm per observation to stop M step
+        "chunk_size": 100000,  # time bins of data concatenated at once in initialization and M step
         "Hstep": True,  # learn hyperparameters
+        "hstep_method": "elbo",  # elbo (exact), whittle (spectral) or hybrid (whittle then elbo)
         "da_bound": 5.0,  # clip the update to loading matrix
         "db_bound": 5.0,  # clip the update to bias
         "dmu_bound": 5.0,  # clip the update to posterior mean
         "omega_bound": (5e-4, 5e-2),  # limits of lengthscale
+        "initialization": "fa",  # fa or pca (streaming, for large dataset)
         "window": 50,  # window size that the trials are cut into
+        "bucket_size": None,  # pad whole trials to multiples of bucket size for inference
+        "resample_segments": False,  # redraw the overlaps of segments every iteration
+        "random_state": None,  # seed of segment sampling
         "saving_interval": 60 * 30,  # time interval of saving snapshots
         "callbacks": [],  # functions are called every iteration
+        "cancel": None,  # event (e.g. threading.Event) that stops fitting after the current iteration
+        "verbose": True,  # print progress
     }
 
     updates = {k: v for k, v in kwargs.items() if k in config}  # discard unknown args
@@ -109,6 +248,10 @@ def get_config(**kwargs):
 
 def fill_trials(trials):
     for trial in trials:
+        if trial.get("mask") is not None:
+            trial["mask"] = np.asarray(trial["mask"], dtype=bool)
+            if trial["mask"].shape != trial["y"].shape:
+                raise ValueError("mask must have the same shape as y")
         trial.setdefault("w", np.zeros_like(trial["mu"]))
         trial.setdefault("v", np.zeros_like(trial["mu"]))
         trial.setdefault("dmu", np.zeros_like(trial["mu"]))
@@ -117,3 +260,19 @@ def fill_trials(trials):
 def fill_params(params):
     params.setdefault("da", np.zeros_like(params["a"]))
     params.setdefault("db", np.zeros_like(params["b"]))
+
+
+def observed_entries(trial):
+    """Boolean array of the observed entries of a trial"""
+    mask = trial.get("mask")
+    if mask is None:
+        return np.ones(trial["y"].shape, dtype=bool)
+    return mask
+
+
+def unobserved_entries(trial):
+    """Boolean array of the missing entries of a trial, None if fully observed"""
+    mask = trial.get("mask")
+    if mask is None:
+        return None
+    return ~mask
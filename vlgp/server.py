@@ -0,0 +1,325 @@
+"""
+Resident inference server
+
+The server keeps the parameters and prior factors of a fitted model in memory and infers the latents of trials sent
+by clients over a local socket (multiprocessing.connection).
+Concurrent requests are coalesced into micro-batches, each of which is one E-step per group of trials of the same
+(padded) length, so that a failure only fails the requests of its own group.
+The requests are checked against the model before they are queued, and the queue of pending requests is bounded,
+so that a burst is rejected early rather than delaying every request.
+"""
+import collections
+import logging
+import math
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from .core import update_w, update_v, infer
+from .gp import ichol_factor
+from .preprocess import fill_trials
+from .util import pad_trials, unpad_trials
+
+__all__ = ["InferenceServer", "InferenceClient"]
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceServer:
+    """Server of the posterior of latents given a fitted model
+
+    :param params: parameters of a fit
+    :param config: config of a fit
+    :param address: (host, port) or path of a Unix socket to listen on
+    :param authkey: bytes shared with the clients
+    :param max_batch: most trials in a batch
+    :param max_wait: seconds a batch waits for more requests after its first one
+    :param max_queue: most pending requests, the others are rejected
+    :param window: number of recent requests the latency statistics are taken over
+    :param max_priors: most prior factors of distinct lengths kept, the least recently used are dropped
+    """
+
+    def __init__(
+        self,
+        params,
+        config,
+        address,
+        authkey,
+        max_batch=32,
+        max_wait=0.005,
+        max_queue=1024,
+        window=1000,
+        max_priors=64,
+    ):
+        self.params = dict(params)
+        self.params["cholesky"] = collections.OrderedDict()  # least recently used first
+        self.config = config
+        self.address = address
+        self.authkey = authkey
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_priors = max_priors
+
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.latencies = collections.deque(maxlen=window)
+        self.counts = {"requests": 0, "rejected": 0, "invalid": 0, "failed": 0, "batches": 0, "trials": 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.listener = None
+        self.threads = []
+
+    @classmethod
+    def from_model(cls, model, address, authkey, **kwargs):
+        """Server of a fitted VLGP model, e.g. loaded by VLGP.load"""
+        model.check_fitted()
+        return cls(model._params, model._config, address, authkey, **kwargs)
+
+    def start(self):
+        """Listen and serve in background threads"""
+        self.listener = Listener(self.address, authkey=self.authkey)
+        for target in (self.accept, self.work):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.listener.close()
+        for thread in self.threads:
+            thread.join(timeout=1)
+
+    def serve_forever(self):
+        self.start()
+        self.stopped.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break  # closed
+            thread = threading.Thread(target=self.read, args=(conn,), daemon=True)
+            thread.start()
+
+    def read(self, conn):
+        """Queue the requests of a client"""
+        send_lock = threading.Lock()
+
+        def reply(request_id, ok, payload):
+            with send_lock:
+                conn.send((request_id, ok, payload))
+
+        with conn:
+            while not self.stopped.is_set():
+                try:
+                    command, request_id, payload = conn.recv()
+                except (EOFError, OSError):
+                    break
+                arrival = time.perf_counter()
+                if command == "infer":
+                    try:
+                        trial = self.validate(payload)
+                    except ValueError as e:
+                        with self.lock:
+                            self.counts["invalid"] += 1
+                        reply(request_id, False, str(e))
+                        continue
+                    try:
+                        self.requests.put_nowait((arrival, trial, request_id, reply))
+                    except queue.Full:
+                        with self.lock:
+                            self.counts["rejected"] += 1
+                        reply(request_id, False, "queue is full")
+                elif command == "metrics":
+                    reply(request_id, True, self.metrics())
+                else:
+                    reply(request_id, False, "unknown command {}".format(command))
+
+    def work(self):
+        """Run the E-step on micro-batches of queued requests"""
+        while not self.stopped.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            results = self.infer_groups([trial for _, trial, _, _ in batch])
+
+            # counted before the replies, so that a client sees its own request in the metrics
+            with self.lock:
+                self.counts["requests"] += len(batch)
+                self.counts["failed"] += sum(not ok for ok, _ in results)
+                self.counts["batches"] += 1
+                self.counts["trials"] += len(batch)
+
+            now = time.perf_counter()
+            for (arrival, _, request_id, reply), (ok, payload) in zip(batch, results):
+                try:
+                    reply(request_id, ok, payload)
+                except OSError:
+                    pass  # client gone
+                with self.lock:
+                    self.latencies.append(now - arrival)
+
+    def validate(self, payload):
+        """Trial of a request checked against the model
+
+        :raise ValueError: if the trial does not fit the model
+        """
+        params = self.params
+        if not isinstance(payload, dict) or payload.get("y") is None:
+            raise ValueError("a trial must be a dict of y and optionally x, mask and mu")
+        trial = dict(payload, y=np.asarray(payload["y"], dtype=float))
+        y = trial["y"]
+        if y.ndim != 2 or y.shape[0] < 1 or y.shape[1] != params["ydim"]:
+            raise ValueError("y must be of shape (time, {}), got {}".format(params["ydim"], y.shape))
+
+        length = y.shape[0]
+        shapes = {"x": (length, params["xdim"], params["ydim"]), "mask": y.shape, "mu": (length, params["zdim"])}
+        for key, shape in shapes.items():
+            if trial.get(key) is not None:
+                trial[key] = np.asarray(trial[key], dtype=bool if key == "mask" else float)
+                if trial[key].shape != shape:
+                    raise ValueError("{} must be of shape {}, got {}".format(key, shape, trial[key].shape))
+
+        observed = trial["mask"] if trial.get("mask") is not None else True
+        if not np.all(np.isfinite(np.where(observed, y, 0))):
+            raise ValueError("y must be finite at the observed entries")
+        return trial
+
+    def infer_groups(self, trials):
+        """Inference of every group of trials of the same padded length
+
+        A group that fails is retried one trial at a time, so that a failure only fails its own request.
+
+        :return: list of (ok, posterior or error message) per trial
+        """
+        size = self.config["bucket_size"]
+        groups = collections.defaultdict(list)
+        for i, trial in enumerate(trials):
+            length = trial["y"].shape[0]
+            groups[size * math.ceil(length / size) if size else length].append(i)
+
+        results = [None] * len(trials)
+
+        def run(indices):
+            group = [trials[i] for i in indices]
+            try:
+                self.infer(group)
+            except Exception as e:
+                if len(indices) > 1:
+                    for i in indices:
+                        run([i])
+                    return
+                logger.exception(repr(e), exc_info=True)
+                results[indices[0]] = (False, repr(e))
+                return
+            for i, trial in zip(indices, group):
+                results[i] = (True, {"mu": trial["mu"], "v": trial["v"]})
+
+        for indices in groups.values():
+            run(indices)
+        return results
+
+    def infer(self, trials):
+        """Batched inference, see core.infer_trials, with the prior factors kept across batches"""
+        params = self.params
+        config = self.config
+        zdim = params["zdim"]
+
+        for trial in trials:
+            length = trial["y"].shape[0]
+            if trial.get("x") is None:
+                trial["x"] = np.ones((length, params["xdim"], params["ydim"]))
+            if trial.get("mu") is None:
+                trial["mu"] = np.zeros((length, zdim))
+        fill_trials(trials)
+
+        buckets = pad_trials(trials, config["bucket_size"])
+        cholesky = params["cholesky"]
+        lengths = {trial["y"].shape[0] for trial in buckets}
+        for length in lengths:
+            if length in cholesky:
+                cholesky.move_to_end(length)
+            else:
+                cholesky[length] = np.array(
+                    [
+                        ichol_factor(length, params["omega"][l], params["rank"]) * params["sigma"][l]
+                        for l in range(zdim)
+                    ]
+                )
+        while len(cholesky) > max(self.max_priors, len(lengths)):
+            cholesky.popitem(last=False)
+        update_w(buckets, params, config)
+        update_v(buckets, params, config)
+        infer(buckets, params, config)
+        unpad_trials(trials, buckets)
+
+    def metrics(self):
+        """Counts, queue length and latency percentiles (seconds) of recent requests"""
+        with self.lock:
+            metrics = dict(self.counts)
+            latencies = np.array(list(self.latencies))
+        metrics["queue"] = self.requests.qsize()
+        metrics["mean_batch"] = metrics["trials"] / max(metrics["batches"], 1)
+        if latencies.size > 0:
+            p50, p99 = np.percentile(latencies, [50, 99])
+            metrics.update(latency_p50=p50, latency_p99=p99, latency_max=latencies.max())
+        return metrics
+
+
+class InferenceClient:
+    """Client of InferenceServer, one request at a time per client"""
+
+    def __init__(self, address, authkey):
+        self.conn = Client(address, authkey=authkey)
+        self.counter = 0
+
+    def request(self, command, payload=None):
+        self.counter += 1
+        self.conn.send((command, self.counter, payload))
+        request_id, ok, result = self.conn.recv()
+        if request_id != self.counter:
+            raise RuntimeError("reply to request {} while waiting for {}".format(request_id, self.counter))
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def infer(self, trial):
+        """Posterior of the latents of a trial
+
+        :param trial: dict of y and optionally x, mask and mu (initial)
+        :return: dict of mu and v
+        """
+        return self.request("infer", trial)
+
+    def metrics(self):
+        return self.request("metrics")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,7 +3,6 @@ Functions of simulation
 """
 import numpy as np
 from numpy.random import multivariate_normal
-from scipy import stats
 
 from .math import trunc_exp, identity
 
@@ -27,6 +26,8 @@ def spike(x, a, b, link=trunc_exp, seed=None):
     :return: spike train, spike history, firing rate
     :rtype: ndarray, ndarray, ndarray
     """
+    from scipy import stats
+
     if seed is not None:
         np.random.seed(seed)
 
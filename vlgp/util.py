@@ -3,17 +3,15 @@ Tool functions
 """
 import functools
 import logging
-import numbers
 import pathlib
 import warnings
+from collections.abc import Sequence
 from typing import List, Optional, Callable
 
-import h5py
 import numpy as np
 from numpy import exp, column_stack, roll
 from numpy import zeros, ones, diag, arange, eye, asarray
 from scipy.linalg import svd, lstsq, toeplitz, solve
-from scipy.ndimage.filters import gaussian_filter1d
 
 from .math import ichol_gauss
 
@@ -186,6 +184,8 @@ def save(result, path, ext="npy"):
     path = pathlib.Path(path)
 
     if ext == "h5":
+        import h5py
+
         path = path.with_suffix(".h5")
         with h5py.File(path, "w") as fout:
             dict_to_hdf5(result, fout)
@@ -195,6 +195,11 @@ def save(result, path, ext="npy"):
     elif ext == "npz":
         path = path.with_suffix(".npz")
         np.savez(path, **result)
+    elif ext == "vlgp":
+        from . import artifact
+
+        path = path.with_suffix(".vlgp")
+        artifact.write(path, result)
 
 
 def load(path):
@@ -204,14 +209,20 @@ def load(path):
         raise FileNotFoundError(path.as_posix())
 
     if path.suffix == ".h5":
+        import h5py
+
         with h5py.File(path.as_posix(), "r") as fin:
             rez = hdf5_to_dict(fin)
     elif path.suffix == ".npy":
-        rez = np.load(path)
+        rez = np.load(path, allow_pickle=True)  # saved by np.save of objects
         rez = rez[()]
     elif path.suffix == ".npz":
         rez = np.load(path)
         rez = {**rez}
+    elif path.suffix == ".vlgp":
+        from . import artifact
+
+        rez = artifact.read(path)
     else:
         raise NotImplementedError("unknown file type {}".format(path.suffix))
 
@@ -363,9 +374,12 @@ def auto(y, lag):
 def sparse_prior(sigma, omega, trial_lengths, rank):
     # [diagonal(G1, G2, ..., Gq)]
     from scipy import sparse
+    from .gp import ichol_factor
 
     return [
-        sparse.block_diag([s * ichol_gauss(l, w, rank) for s, w in zip(sigma, omega)])
+        sparse.block_diag(
+            [s * ichol_factor(l, w, rank) for s, w in zip(sigma, omega)], format="csr"
+        )
         for l in trial_lengths
     ]
 
@@ -393,6 +407,8 @@ def regmat(y, x: Optional[list], lag=0):
 
 
 def smooth_1d(x, sigma=10):
+    from scipy.ndimage import gaussian_filter1d
+
     assert x.ndim == 1
     y = gaussian_filter1d(x, sigma=sigma, mode="constant", cval=0.0)
     return y
@@ -404,12 +420,22 @@ def smooth(x, sigma=10):
 
 def dict_to_hdf5(d: dict, hdf):
     for key, value in d.items():
+        key = str(key)
         if isinstance(value, dict):
             group = hdf.create_group(key)
             dict_to_hdf5(value, group)
+        elif isinstance(value, (list, tuple)) and any(
+            isinstance(item, dict) for item in value
+        ):
+            # e.g. trials, stored as a group indexed by position
+            group = hdf.create_group(key)
+            group.attrs["sequence"] = True
+            dict_to_hdf5({i: item for i, item in enumerate(value)}, group)
         else:
             try:
                 if isinstance(value, np.ndarray):
+                    if value.dtype.kind == "U":
+                        value = value.astype("S")  # HDF5 has no numpy unicode type
                     hdf.create_dataset(key, data=value, compression="gzip")
                 else:
                     hdf.create_dataset(key, data=value)
@@ -418,10 +444,14 @@ def dict_to_hdf5(d: dict, hdf):
 
 
 def hdf5_to_dict(hdf):
+    import h5py
+
     d = dict()
     for key, value in hdf.items():
         if isinstance(value, h5py.Group):
             d[key] = hdf5_to_dict(value)
+            if value.attrs.get("sequence", False):
+                d[key] = [d[key][k] for k in sorted(d[key], key=int)]
         else:
             d[key] = value[()]
     return d
@@ -468,55 +498,150 @@ def cut_trials(trials, params, config):
     """Cut all trials"""
     window = config["window"]
     if window and window is not None:
-        return np.concatenate(
-            [cut_trial(trial, window) for trial in trials]
-        )  # concatenate segments
+        return Segments(trials, window, config["random_state"])
     else:
         return trials
 
 
-def cut_trial(trial, window: int):
-    """Cut a trial into small segments"""
+def segment_table(lengths: List[int], window: int, random_state=None):
+    """Cut trials into segments of equal length
+
+    A trial shorter than the window is kept whole as a segment of its own length.
+
+    Args:
+        lengths: lengths of trials
+        window: length of segments
+        random_state: seed or RandomState of the overlaps
+
+    Returns:
+        (n_segments, 2) start and stop of segments on the concatenated time axis of the trials
+    """
     import math
 
-    y = trial["y"]
-    x = trial["x"]
-    mu = trial["mu"]
-    w = trial["w"]
-    v = trial["v"]
-
-    length = y.shape[0]
-
-    # allow overlapping segments if the trial length is not a multiplier of window
-    # random sample the segment starting points
-    num_segments = math.ceil(length / window)
-    overlap = num_segments * window - length  # number of overlapping segments
-    start = np.cumsum(np.full(num_segments, fill_value=window, dtype=int)) - window
-    offset = np.cumsum(
-        np.append(
-            [0],
-            np.random.multinomial(
-                overlap, np.ones(num_segments - 1) / (num_segments - 1)
-            ),
-        )
-    )
-    start -= offset
-    slices = [np.s_[s : s + window] for s in start]
-    segments = [
-        {"y": y[s, :], "x": x[s, ...], "mu": mu[s, :], "w": w[s, :], "v": v[s, :]}
-        for s in slices
+    random_state = check_random_state(random_state)
+
+    offsets = np.cumsum([0] + list(lengths))
+    starts = []
+    stops = []
+    for offset, length in zip(offsets, lengths):
+        if length < window:
+            starts.append([offset])
+            stops.append([offset + length])
+            continue
+
+        # allow overlapping segments if the trial length is not a multiplier of window
+        # random sample the segment starting points
+        num_segments = math.ceil(length / window)
+        overlap = num_segments * window - length  # number of overlapping segments
+        start = np.arange(num_segments) * window
+        if overlap > 0:
+            start[1:] -= np.cumsum(
+                random_state.multinomial(
+                    overlap, np.ones(num_segments - 1) / (num_segments - 1)
+                )
+            )
+        starts.append(offset + start)
+        stops.append(offset + start + window)
+
+    if not starts:
+        return np.zeros((0, 2), dtype=int)
+    return np.column_stack([np.concatenate(starts), np.concatenate(stops)])
+
+
+class Segments(Sequence):
+    """Segments of trials
+
+    The segments are kept as a table of start and stop indices over the trials.
+    A segment is a dict of views of its trial's arrays, made on access, so that
+    changes to a segment are changes to the trial.
+    """
+
+    keys = ("y", "x", "mu", "w", "v", "dmu", "mask")
+
+    def __init__(self, trials, window: int, random_state=None):
+        self.trials = trials
+        self.window = window
+        self.random_state = check_random_state(random_state)
+        self.lengths = [trial["y"].shape[0] for trial in trials]
+        self.offsets = np.cumsum([0] + self.lengths)
+        self.redraw()
+
+    def redraw(self):
+        """Resample the overlaps of segments"""
+        self.table = segment_table(self.lengths, self.window, self.random_state)
+        self.index = np.searchsorted(self.offsets, self.table[:, 0], side="right") - 1
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def __getitem__(self, i):
+        start, stop = self.table[i] - self.offsets[self.index[i]]
+        trial = self.trials[self.index[i]]
+        return {
+            key: trial[key][start:stop]
+            for key in self.keys
+            if trial.get(key) is not None
+        }
+
+
+def pad_trials(trials, size):
+    """Pad trials to the next multiple of size
+
+    Trials of similar lengths fall into the same bucket and share the prior factors.
+    The padded bins are masked as missing and hence do not change the posterior of the observed bins.
+
+    :param trials: list of trials
+    :param size: bucket size, no padding if None or 0
+    :return: list of padded trials, the same trial if no padding needed
+    """
+    import math
+
+    if not size:
+        return trials
+    return [
+        pad_trial(trial, size * math.ceil(trial["y"].shape[0] / size))
+        for trial in trials
     ]
-    return segments
+
+
+def pad_trial(trial, length: int):
+    """Pad a trial with missing bins to the given length"""
+    nbin = trial["y"].shape[0]
+    if length == nbin:
+        return trial
+
+    def pad(a, fill_value=0):
+        return np.concatenate(
+            [a, np.full((length - nbin,) + a.shape[1:], fill_value, dtype=a.dtype)]
+        )
+
+    padded = dict(trial)
+    for key in ("y", "x", "mu", "w", "v", "dmu"):
+        if trial.get(key) is not None:
+            padded[key] = pad(trial[key])
+    mask = trial.get("mask")
+    if mask is None:
+        mask = np.ones(trial["y"].shape, dtype=bool)
+    padded["mask"] = pad(mask, fill_value=False)
+
+    return padded
+
+
+def unpad_trials(trials, padded_trials):
+    """Copy the posterior of padded trials back to the original trials"""
+    for trial, padded in zip(trials, padded_trials):
+        if padded is trial:
+            continue
+        nbin = trial["y"].shape[0]
+        for key in ("mu", "w", "v", "dmu"):
+            trial[key] = padded[key][:nbin]
 
 
 def check_random_state(seed):
-    """Turn seed into a np.random.RandomState instance"""
-    if seed is None or seed is np.random:
-        return np.random.get_state()
-    if isinstance(seed, (numbers.Integral, np.integer)):
-        return np.random.RandomState(seed)
-    if isinstance(seed, np.random.RandomState):
-        return seed
-    raise ValueError(
-        "%r cannot be used to seed a numpy.random.RandomState instance" % seed
-    )
+    """Turn seed into a np.random.RandomState instance, see sklearn.utils.check_random_state
+
+    None is the global RandomState of numpy, hence seeded by np.random.seed.
+    """
+    from sklearn.utils import check_random_state
+
+    return check_random_state(seed)
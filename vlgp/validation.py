@@ -1,98 +1,199 @@
-import h5py
+"""
+Cross-validation and model selection
+"""
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+from . import gp
 from .api import fit
+from .core import update_w, update_v, infer, infer_trials
+from .evaluation import evaluate, predict
+from .preprocess import RANK, fill_trials, observed_entries
+from .util import check_random_state, dict_to_hdf5
 
+# parameters and hyperparameters that define a fitted model
+MODEL_KEYS = ("a", "b", "noise", "sigma", "omega")
 
-def cv(
-    y,
-    z_dim,
-    sigma,
-    omega,
-    rank,
-    mfold=0,
-    nfold=0,
-    path=None,
-    history=0,
-    callbacks=None,
-    random_state=None,
-    **kwargs
-):
-    np.random.seed(random_state)
 
-    ntrial, nbin, y_dim = y.shape
+def cv(trials, n_factors, nfold=5, n_jobs=1, path=None, random_state=None, **kwargs):
+    """Cross-validation over trials
 
-    mfold = mfold if mfold > 0 else ntrial
+    All trials are fit once. Every fold is then fit to its training trials in parallel worker processes,
+    warm-started from the parameters and latents of the full fit, and its test trials are inferred given the fold's
+    parameters. The workers are seeded with the prior factors of the full fit.
 
-    trial_perm = np.random.permutation(ntrial)
-    folds = np.array_split(trial_perm, mfold)  # k-fold
+    :param trials: list of trials
+    :param n_factors: number of latent factors
+    :param nfold: number of folds, leave-one-trial-out if nfold < 1
+    :param n_jobs: number of worker processes
+    :param path: HDF5 file to which the per-fold results are written
+    :param random_state: seed of fold assignment
+    :param kwargs: options of fit
+    :return: list of per-fold results
+    """
+    random_state = check_random_state(random_state)
 
-    for i, fold in enumerate(folds):
+    ntrial = len(trials)
+    nfold = nfold if nfold > 0 else ntrial
+
+    full = fit(trials, n_factors, **kwargs)
+    warm = {k: full["params"][k] for k in MODEL_KEYS}
+
+    trial_perm = random_state.permutation(ntrial)
+    folds = np.array_split(trial_perm, nfold)  # k-fold
+
+    jobs = []
+    for i, test in enumerate(folds):
         training_mask = np.ones(ntrial, dtype=bool)
-        training_mask[fold] = False
-        y_training = y[training_mask, :, :]
-        y_test = y[~training_mask, :, :]
-        lik = ["spike"] * y_training.shape[2]
-        fold_path = "{}_fold_{}".format(path, i)
-        # DEBUG
-        print(fold_path)
-        model_training = fit(
-            y=y_training,
-            z_dim=z_dim,
-            lik=lik,
-            history=history,
-            sigma=sigma,
-            omega=omega,
-            rank=rank,
-            path=fold_path,
-            callbacks=callbacks,
-            learn_param=True,
-            learn_post=True,
-            learn_hyper=True,
-            # e_niter=5, m_niter=5,
-            **kwargs
-        )
-        with h5py.File(fold_path, "a") as fout:
-            fout["fold"] = fold
-
-        leave_out(
-            y_test,
-            model_training,
-            path=fold_path,
-            leave=y_test.shape[-1] // nfold,
-            niter=50,
-            e_niter=1,
+        training_mask[test] = False
+        train = np.flatnonzero(training_mask)
+        jobs.append(
+            (
+                i,
+                train,
+                test,
+                [warm_trial(trials[j]) for j in train],
+                [warm_trial(trials[j]) for j in test],
+            )
         )
 
+    if n_jobs == 1:
+        results = [fit_fold(*job, n_factors, warm, kwargs) for job in jobs]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=gp.set_prior_cache,
+            initargs=(gp.get_prior_cache(),),
+        ) as executor:
+            futures = [
+                executor.submit(fit_fold, *job, n_factors, warm, kwargs) for job in jobs
+            ]
+            results = [future.result() for future in futures]
+
+    if path is not None:
+        import h5py
+
+        with h5py.File(path, "w") as fout:
+            for result in results:
+                dict_to_hdf5({"fold_{}".format(result["fold"]): result}, fout)
+
+    return results
+
+
+def fit_fold(fold, train, test, training_trials, test_trials, n_factors, warm, kwargs):
+    """Fit the training trials of a fold and infer its test trials"""
+    kwargs = dict(kwargs)
+    kwargs.update({k: np.copy(v) for k, v in warm.items()})  # fit modifies in place
+
+    result = fit(training_trials, n_factors, **kwargs)
+    params = result["params"]
+    config = result["config"]
+
+    infer_trials(test_trials, params, config)
 
-def leave_out(y, model, path, leave=1, **kwargs):
+    return {
+        "fold": fold,
+        "train": train,
+        "test": test,
+        "params": {k: params[k] for k in MODEL_KEYS},
+        "trials": [{"mu": trial["mu"], "v": trial["v"]} for trial in test_trials],
+    }
+
+
+def warm_trial(trial):
+    """Copy of the data and latent of a fitted trial"""
+    warm = data_trial(trial)
+    warm["mu"] = np.copy(trial["mu"])
+    return warm
+
+
+def cosmooth(trials, result, masks, **kwargs):
+    """Co-smoothing, predict the held-out neurons from the latents inferred from the other neurons
+
+    Only the E-step is run given the fitted parameters, with the likelihood terms of the held-out neurons dropped.
+    The trials of all masks are inferred together in one E-step, sharing the prior factors.
+    The given trials are not changed.
+
+    :param trials: list of trials
+    :param result: fit
+    :param masks: boolean array (#masks, ydim) or (ydim,), True for held-out neurons
+    :param kwargs: options of inference, e.g. Eniter
+    :return: list of firing rates (#trials, (time, #held-out)) and goodness of fit (#held-out,) per mask,
+        see evaluation.evaluate
     """
+    masks = np.atleast_2d(np.asarray(masks, dtype=bool))
+
+    params = dict(result["params"])  # keep the prior factors of the fit
+    config = dict(result["config"])
+    config.update({k: v for k, v in kwargs.items() if k in config})
+
+    zdim = params["zdim"]
+    xdim = params["xdim"]
+    ydim = params["ydim"]
+
+    base_trials = []
+    for trial in trials:
+        length = trial["y"].shape[0]
+        x = trial.get("x")
+        mu = trial.get("mu")
+        base_trials.append(
+            {
+                "y": trial["y"],
+                "x": np.ones((length, xdim, ydim)) if x is None else x,
+                "mu": np.zeros((length, zdim)) if mu is None else mu,
+                "mask": trial.get("mask"),
+            }
+        )
+    gp.make_cholesky(base_trials, params, config)
+
+    # drop the held-out neurons by masking instead of copying the data
+    in_trials = [
+        dict(trial, mu=np.copy(trial["mu"]), mask=observed_entries(trial) & ~mask)
+        for mask in masks
+        for trial in base_trials
+    ]
+    fill_trials(in_trials)
+    update_w(in_trials, params, config)
+    update_v(in_trials, params, config)
+    infer(in_trials, params, config)
+
+    outputs = []
+    ntrial = len(base_trials)
+    for k, mask in enumerate(masks):
+        # the held-out neurons are evaluated on their own observed entries
+        out_trials = [
+            dict(trial, mu=in_trial["mu"], v=in_trial["v"])
+            for trial, in_trial in zip(base_trials, in_trials[k * ntrial:(k + 1) * ntrial])
+        ]
+        output = evaluate(out_trials, params, mask)
+        output["rate"] = predict(out_trials, params, mask)
+        outputs.append(output)
+
+    return outputs
+
+
+def leave_out(trials, result, leave=1, random_state=None, **kwargs):
+    """Predict left-out neurons by co-smoothing
 
     Parameters
     ----------
-    y: test set
-    model: model fit by training set
+    trials: test set
+    result: fit by training set
     leave: how many neurons are left-out
 
     Returns
     -------
-
+    list of the left-out neurons, their predicted firing rates and log-likelihood
     """
-    from scipy.linalg import svd
-
-    _, nbin, z_dim = model["mu"].shape
-    y_dim = y.shape[-1]
+    random_state = check_random_state(random_state)
 
-    # Z = USV'
-    # Za = USV'a = (US)(V'a) = (USV'V)(V'a)
-    u, s, vt = svd(model["mu"].reshape(-1, z_dim), full_matrices=False)
-    a_orth = vt @ model["a"]
-    b = model["b"]
+    y_dim = result["params"]["ydim"]
 
     nfold = y_dim // leave
 
     if 0 < nfold < y_dim:
-        y_perm = np.random.permutation(y_dim)
+        y_perm = random_state.permutation(y_dim)
     elif nfold == y_dim:
         y_perm = np.arange(y_dim)
     else:
@@ -100,32 +201,172 @@ def leave_out(y, model, path, leave=1, **kwargs):
 
     folds = np.array_split(y_perm, nfold)  # k-fold
 
-    for i, fold in enumerate(folds):
-        in_mask = np.ones(y_dim, dtype=bool)
-        in_mask[fold] = False
-        y_in = y[:, :, in_mask]
-        a_in = a_orth[:, in_mask]  # orth
-        b_in = b[:, in_mask]
-        lik = ["spike"] * y_in.shape[-1]
-        fold_path = "{}_leave_{}_out_{}".format(path, leave, i)
-        # DEBUG
-        print("{}".format(fold_path))
-        fit(
-            y=y_in,
-            z_dim=z_dim,
-            lik=lik,
-            a=a_in,
-            b=b_in,
-            history=model["history"],
-            sigma=model["sigma"],
-            omega=model["omega"],
-            rank=model["rank"],
-            path=fold_path,
-            learn_param=False,
-            learn_post=True,
-            learn_hyper=False,
-            **kwargs
+    masks = np.zeros((nfold, y_dim), dtype=bool)
+    for mask, fold in zip(masks, folds):
+        mask[fold] = True
+
+    outputs = cosmooth(trials, result, masks, **kwargs)
+    for output, fold in zip(outputs, folds):
+        output["fold"] = fold
+
+    return outputs
+
+
+def sweep(
+    trials,
+    n_factors,
+    omega_bounds=None,
+    test_trials=None,
+    test_size=0.2,
+    nfold=5,
+    n_jobs=1,
+    random_state=None,
+    **kwargs
+):
+    """Model selection over a ladder of numbers of latent factors and a grid of lengthscale bounds
+
+    Along the ladder, the fit of k + 1 factors is warm-started from the fit of k factors plus one new component
+    taken from the residual (see add_component), instead of a new initialization.
+    The ladders of the lengthscale bounds run concurrently in worker processes seeded with the shared prior factors.
+    Every candidate is scored by co-smoothing the test trials (see leave_out and evaluation.evaluate).
+
+    :param trials: list of trials
+    :param n_factors: numbers of latent factors, e.g. range(1, 21)
+    :param omega_bounds: list of omega_bound, the default of fit if None
+    :param test_trials: held-out trials, a random test_size fraction of trials if None
+    :param test_size: fraction of held-out trials
+    :param nfold: number of folds of held-out neurons
+    :param n_jobs: number of worker processes
+    :param random_state: seed of the held-out trials
+    :param kwargs: options of fit
+    :return: list of candidates with n_factors, omega_bound, held-out loglik, bits_per_spike, pseudo_r2 and params
+    """
+    from .preprocess import get_config
+
+    random_state = check_random_state(random_state)
+
+    if test_trials is None:
+        perm = random_state.permutation(len(trials))
+        ntest = max(int(round(len(trials) * test_size)), 1)
+        test_trials = [trials[i] for i in perm[:ntest]]
+        trials = [trials[i] for i in perm[ntest:]]
+
+    config = get_config(**kwargs)
+    if omega_bounds is None:
+        omega_bounds = [config["omega_bound"]]
+    n_factors = sorted(n_factors)
+
+    # prior factors of the initial lengthscale shared by all ladders
+    lengths = {config["window"]} | {trial["y"].shape[0] for trial in trials + test_trials}
+    for omega_bound in omega_bounds:
+        for length in lengths:
+            gp.ichol_factor(length, omega_bound[1], RANK)
+
+    jobs = [(trials, test_trials, n_factors, omega_bound, nfold, kwargs) for omega_bound in omega_bounds]
+    if n_jobs == 1:
+        ladders = [fit_ladder(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=gp.set_prior_cache,
+            initargs=(gp.get_prior_cache(),),
+        ) as executor:
+            futures = [executor.submit(fit_ladder, *job) for job in jobs]
+            ladders = [future.result() for future in futures]
+
+    return [candidate for ladder in ladders for candidate in ladder]
+
+
+def fit_ladder(trials, test_trials, n_factors, omega_bound, nfold, kwargs):
+    """Fit the numbers of factors in increasing order, each warm-started from the previous one"""
+    kwargs = dict(kwargs, omega_bound=omega_bound)
+
+    candidates = []
+    previous = None
+    for k in n_factors:
+        if previous is None:
+            result = fit([data_trial(trial) for trial in trials], k, **kwargs)
+        else:
+            mus, warm = add_components(
+                previous["trials"], previous["params"], k - previous["params"]["zdim"], omega_bound
+            )
+            training_trials = [data_trial(trial) for trial in previous["trials"]]
+            for trial, mu in zip(training_trials, mus):
+                trial["mu"] = mu
+            result = fit(training_trials, k, **dict(kwargs, **warm))
+
+        # co-smooth the held-out neurons of the held-out trials
+        ydim = result["params"]["ydim"]
+        outputs = leave_out(
+            [data_trial(trial) for trial in test_trials],
+            result,
+            leave=max(ydim // nfold, 1),
+            random_state=0,
+        )
+        spikes = np.concatenate([output["bits_per_spike"] for output in outputs])
+        candidates.append(
+            {
+                "n_factors": k,
+                "omega_bound": omega_bound,
+                "loglik": sum(np.sum(output["loglik"]) for output in outputs),
+                "bits_per_spike": np.nanmean(spikes) if np.any(np.isfinite(spikes)) else np.nan,
+                "pseudo_r2": np.mean(np.concatenate([output["pseudo_r2"] for output in outputs])),
+                "params": {key: result["params"][key] for key in MODEL_KEYS},
+            }
         )
+        previous = result
+
+    return candidates
+
+
+def data_trial(trial):
+    """Copy of the data of a trial without latents"""
+    return {k: trial[k] for k in ("y", "x", "mask") if trial.get(k) is not None}
+
+
+def add_components(trials, params, count, omega_bound):
+    """Warm start of more latents from the leading directions of the residual
+
+    The directions are the leading eigenvectors of the covariance of the Pearson residuals under the fit.
+    The new latents are the projections of the residuals and their loadings are scaled to the link.
+
+    :param trials: fitted trials
+    :param params: fitted parameters
+    :param count: number of new latents
+    :param omega_bound: bounds of lengthscale, the new lengthscales are the upper bound as in get_params
+    :return: latent means of trials and parameters (see MODEL_KEYS) with the new latents
+    """
+    from .evaluation import expected_rate
+
+    likelihood = params["likelihood"]
+    gauss_mask = likelihood == "gaussian"
+
+    residuals = []
+    scales = []
+    for trial in trials:
+        rate = expected_rate(trial["mu"], trial["v"], trial["x"], params["a"], params["b"], likelihood)
+        scale = np.sqrt(np.maximum(rate, 1e-8))
+        scale[:, gauss_mask] = np.sqrt(params["noise"][gauss_mask])
+        residual = (trial["y"] - rate) / scale
+        if trial.get("mask") is not None:
+            residual = np.where(trial["mask"], residual, 0)
+        residuals.append(residual)
+        scales.append(scale)
+
+    cov = sum(residual.T @ residual for residual in residuals)
+    _, u = np.linalg.eigh(cov)
+    u = u[:, ::-1][:, :count]  # leading
+
+    projections = [residual @ u for residual in residuals]
+    std = np.sqrt(np.mean(np.concatenate(projections) ** 2, axis=0)) + 1e-8
+    # the Pearson residual of a Poisson neuron ~ sqrt(rate) x change of log rate
+    scale = np.mean(np.concatenate(scales, axis=0), axis=0)
+    loading = u.T * std[:, np.newaxis] / scale
+    loading[:, gauss_mask] = u[gauss_mask].T * std[:, np.newaxis] * scale[gauss_mask]
 
-        with h5py.File(fold_path, "a") as fout:
-            fout["fold"] = fold
+    mus = [np.column_stack([trial["mu"], projection / std]) for trial, projection in zip(trials, projections)]
+    warm = {key: np.copy(params[key]) for key in MODEL_KEYS}
+    warm["a"] = np.vstack([warm["a"], loading])
+    warm["sigma"] = np.append(warm["sigma"], np.ones(count))
+    warm["omega"] = np.append(warm["omega"], np.full(count, omega_bound[1]))
+    return mus, warm